@@ -1,6 +1,8 @@
+import time
+
 from tangos import parallel_tasks as pt
 
-from . import core, query
+from . import config, core, query
 from .log import logger
 from .util import proxy_object, timestep_object_cache
 
@@ -32,10 +34,83 @@ def _resolve_proxy(possibly_proxy, timestep_cache: timestep_object_cache.Timeste
         result = possibly_proxy
     return result
 
-def _insert_list_unlocked(property_list, timestep_id):
+def _resolve_proxy_id(possibly_proxy, timestep_cache: timestep_object_cache.TimestepObjectCache, session):
+    if isinstance(possibly_proxy, proxy_object.ProxyObjectBase):
+        return possibly_proxy.relative_to_timestep_cache(timestep_cache).resolve_id(session)
+    else:
+        return possibly_proxy.id
+
+def _is_link(value):
+    return isinstance(value, (proxy_object.ProxyObjectBase, core.halo.SimulationObjectBase))
+
+_property_data_columns = ('data_float', 'data_int', 'data_array')
+
+def _property_row(halo_id, name_id, creator_id, value):
+    attribute_name, packed = core.data_attribute_mapper.pack_data_of_unknown_type(value)
+    if attribute_name not in _property_data_columns:
+        raise TypeError("%r object does not have a slot for %r" % (core.HaloProperty, attribute_name))
+    row = {'halo_id': halo_id, 'name_id': name_id, 'creator_id': creator_id, 'deprecated': False}
+    for column in _property_data_columns:
+        row[column] = None
+    row[attribute_name] = packed
+    return row
+
+def _link_row(halo_id, relation_id, creator_id, target_id):
+    return {'halo_from_id': halo_id, 'halo_to_id': target_id, 'relation_id': relation_id,
+            'weight': 1.0, 'creator_id': creator_id}
+
+def _insert_list_unlocked_core(property_list, timestep):
+    """Insert properties and links using SQLAlchemy Core executemany statements, bypassing the ORM.
+
+    Dictionary items are looked up (and if necessary created) in a single batch, and rows are flushed in
+    chunks of config.PROPERTY_WRITER_BULK_INSERT_CHUNK_SIZE so that no ORM objects need to be held in memory."""
+    session = core.get_default_session()
+    timestep_cache = timestep_object_cache.TimestepObjectCache(timestep)
+    property_list = [p for p in property_list if p[2] is not None]
+
+    name_ids = core.dictionary.get_or_create_dictionary_ids(session, [p[1] for p in property_list])
+    creator_id = core.creator.get_creator_id()
+
+    property_table = core.HaloProperty.__table__
+    link_table = core.HaloLink.__table__
+
+    number = 0
+    property_rows = []
+    link_rows = []
+
+    def flush(table, rows):
+        if len(rows)>0:
+            session.execute(table.insert(), rows)
+        return len(rows)
+
+    for halo, name, value in property_list:
+        halo_id = _resolve_proxy_id(halo, timestep_cache, session)
+        if _is_link(value):
+            target_id = _resolve_proxy_id(value, timestep_cache, session)
+            if target_id is None:
+                continue
+            link_rows.append(_link_row(halo_id, name_ids[name], creator_id, target_id))
+        else:
+            property_rows.append(_property_row(halo_id, name_ids[name], creator_id, value))
+
+        if len(property_rows) >= config.PROPERTY_WRITER_BULK_INSERT_CHUNK_SIZE:
+            number += flush(property_table, property_rows)
+            property_rows = []
+        if len(link_rows) >= config.PROPERTY_WRITER_BULK_INSERT_CHUNK_SIZE:
+            number += flush(link_table, link_rows)
+            link_rows = []
+
+    number += flush(property_table, property_rows)
+    number += flush(link_table, link_rows)
+
+    core.array_store.flush()
+    session.commit()
+    return number
+
+def _insert_list_unlocked_orm(property_list, timestep):
     session = core.get_default_session()
     number = 0
-    timestep_cache = timestep_object_cache.TimestepObjectCache(query.get_timestep(timestep_id, session=session))
+    timestep_cache = timestep_object_cache.TimestepObjectCache(timestep)
     objects = []
     for p in property_list:
         p = [_resolve_proxy(pi, timestep_cache) for pi in p]
@@ -44,28 +119,84 @@ def _insert_list_unlocked(property_list, timestep_id):
             number += 1
 
     session.bulk_save_objects(objects)
+    core.array_store.flush()
     session.commit()
     return number
 
+def _insert_list_unlocked(property_list, timestep_id):
+    timestep = query.get_timestep(timestep_id, session=core.get_default_session())
+    with core.array_store.writing_for_simulation(timestep.simulation.basename):
+        if config.PROPERTY_WRITER_BULK_CORE_INSERT:
+            return _insert_list_unlocked_core(property_list, timestep)
+        else:
+            return _insert_list_unlocked_orm(property_list, timestep)
+
 def insert_list(property_list, timestep_id, commit_on_server):
+    """Insert the list of (object, name, value) tuples into the database.
+
+    If commit_on_server is True, the list is instead posted to the server process, which merges the lists from all
+    processes and commits them together (see ServerCommitQueue). The call then returns immediately, without waiting
+    for the commit; use flush_commits_on_server to be sure that the properties have reached the database."""
     if pt.backend!=None:
-        with pt.ExclusiveLock("insert_list"):
-            if commit_on_server:
-                # nb though it looks weird to have a lock when the commit will be
-                # processed on the server process, this is actually just easier than attaining
-                # the lock on the server
-                return PropertyListCommitMessage((property_list, timestep_id)).send_and_get_response(0)
-            else:
+        if commit_on_server:
+            PropertyListQueueMessage((property_list, timestep_id)).send(0)
+        else:
+            with pt.ExclusiveLock("insert_list"):
                 return _insert_list_unlocked(property_list, timestep_id)
     else:
         if commit_on_server:
             raise ValueError("insert_list called with commit_on_server=True, but no parallel backend is initialised")
         return _insert_list_unlocked(property_list, timestep_id)
 
-class PropertyListCommitMessage(pt.message.MessageWithResponse):
-    def __init__(self, contents=None):
-        super().__init__(contents)
+def flush_commits_on_server():
+    """Commit all property lists queued on the server, and return the number of rows inserted.
+
+    Lists posted by this process are guaranteed to be included; lists posted by other processes are included if
+    they reached the server before this request, e.g. if they were posted before a barrier that this process has
+    since passed."""
+    return PropertyListFlushMessage().send_and_get_response(0)
+
+class ServerCommitQueue:
+    """Accumulates the property lists posted by all processes, so that they can be committed in one transaction
+    (per timestep) rather than one per process"""
+
+    def __init__(self):
+        self._pending = {}
+        self._num_pending = 0
+        self._oldest_pending_time = None
+
+    def add(self, property_list, timestep_id):
+        if self._oldest_pending_time is None:
+            self._oldest_pending_time = time.time()
+        self._pending.setdefault(timestep_id, []).extend(property_list)
+        self._num_pending += len(property_list)
+
+    def flush_is_due(self):
+        if self._oldest_pending_time is None:
+            return False
+        return (self._num_pending >= config.PROPERTY_WRITER_SERVER_COMMIT_QUEUE_MAXIMUM_ROWS or
+                time.time() - self._oldest_pending_time > config.PROPERTY_WRITER_SERVER_COMMIT_QUEUE_MAXIMUM_TIME)
+
+    def flush(self):
+        number = 0
+        for timestep_id, property_list in self._pending.items():
+            number += _insert_list_unlocked(property_list, timestep_id)
+        if len(self._pending)>0:
+            logger.debug("Committed %d rows queued on the server", number)
+        self.__init__()
+        return number
+
+_server_commit_queue = ServerCommitQueue()
+pt.on_server_flush(_server_commit_queue.flush)
+
+class PropertyListQueueMessage(pt.message.Message):
+    def process(self):
+        _server_commit_queue.add(*self.contents)
+        # a flush must not coincide with a process reading the database under the insert_list lock; if the lock is
+        # in use, the flush is left until a later message arrives
+        if _server_commit_queue.flush_is_due() and not pt.lock.lock_is_in_use("insert_list"):
+            _server_commit_queue.flush()
 
+class PropertyListFlushMessage(pt.message.MessageWithResponse):
     def process(self):
-        result = _insert_list_unlocked(*self.contents)
-        self.respond(result)
+        self.respond(_server_commit_queue.flush())
@@ -58,6 +58,11 @@ enable_async_message_processing = False
 # in a single queue, which should be more reliable. It may be that async processing should be
 # removed from the codebase entirely, but I am leaving it like this for now.
 
+job_chunk_maximum_seconds = 1.0
+# When parallel_tasks.distributed is asked to hand out jobs in adaptive chunks, several jobs are sent in reply to
+# each request for work, so that the server is not saturated by requests for cheap jobs. The chunk size is chosen
+# from the measured time per job, so that each chunk takes at most about this long to process.
+
 
 
 # names of property modules to import; default is for backwards compatibility on systems with N-Body-Shop extensions
@@ -87,12 +92,27 @@ mergertree_max_hops = 500 # maximum number of timesteps to scan
 # relation finding paremeters for multi hop queries
 num_multihops_max_default = 100     # the maximum number of links to follow when searching for related halos
 max_relative_time_difference = 1e-4     # the maximum fractional difference in time between two contemporaneous timesteps when searching for related halos
+multihop_engine = 'iterative'   # 'iterative', 'recursive' (single WITH RECURSIVE query) or 'graph' (in-memory index); see MultiHopStrategy
+# The recursive engine needs SQLite >= 3.25, PostgreSQL, or MySQL >= 8.0 (MariaDB >= 10.2); otherwise the iterative
+# engine is used. Walks that combine routes while following several links per hop (e.g. all progenitors) take one
+# statement per hop rather than a single recursive query, because SQL forbids window functions in recursive queries.
 
 # On some network file systems, concurrency using sqlite is dodgy to say the least. After committing a transaction
 # on one node, and before attempting to open a new transaction on another node, it seems empirically helpful to
 # allow a significant time delay. This variable controls that delay.
 DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK = 1.0
-# number of seconds to sleep after a lock is released before reallocating it
+# number of seconds to sleep after a lock is released before reallocating it. The delay is only imposed for sqlite
+# databases; server-based databases (PostgreSQL, MySQL) do not need it.
+
+# Edges, in seconds, of the bins used to report how long processes waited for each named lock at the end of a
+# parallel run
+LOCK_WAIT_HISTOGRAM_BIN_EDGES = [0.001, 0.01, 0.1, 1.0, 10.0, 100.0]
+
+# If True, TimeStep.calculate_all keeps an in-process cache of scalar properties, stored as numpy arrays per
+# timestep, so that repeated requests for the same stored properties need not re-query the database. Changes by other
+# processes are only detected when they add or delete rows, not when they update existing rows in place.
+# See live_calculation/columnar_cache.py
+enable_columnar_property_cache = False
 
 # Default format to use in the webview. Can be either svg or png
 webview_default_image_format = 'svg'
@@ -116,9 +136,57 @@ DB_IMPORT_CHUNK_SIZE = 10
 # Property writer: longest to wait before trying to commit properties (even if in middle of timestep)
 PROPERTY_WRITER_MAXIMUM_TIME_BETWEEN_COMMITS = 600 # seconds
 
-# Property writer: don't bother committing even if a timestep is finished if this time hasn't elapsed:
+# Property writer: commit in the middle of a timestep once this many properties are waiting to be committed, or
+# once their data (estimated from the size of arrays) reaches this many bytes. This bounds the memory used by
+# pending results when properties are cheap to calculate.
+PROPERTY_WRITER_MAXIMUM_PENDING_ROWS = 100000
+PROPERTY_WRITER_MAXIMUM_PENDING_BYTES = 256 * 1024**2
+
+# Property writer: in the middle of a timestep, don't commit because of the number of pending properties unless this
+# time has elapsed since the last commit, to avoid many small transactions when properties are cheap to calculate.
+# Results are always committed at the end of each timestep, and once their data reach the byte budget above.
 PROPERTY_WRITER_MINIMUM_TIME_BETWEEN_COMMITS = 300 # seconds
 
+# Property writer: number of objects to query from the database (and, in halo-parallel modes, transmit to other
+# processes) at a time. The memory needed for the object list is proportional to this, rather than to the number of
+# objects in the timestep. Set to None to query all objects in a timestep at once.
+PROPERTY_WRITER_OBJECT_WINDOW_SIZE = 10000
+
+# Property writer: insert properties using SQLAlchemy Core executemany statements rather than constructing ORM
+# objects. This greatly reduces the time for which the insert_list lock is held, and the memory needed for each
+# commit. Set to False to revert to the older ORM-based insertion.
+PROPERTY_WRITER_BULK_CORE_INSERT = True
+
+# Property writer: number of rows to send to the database in each executemany statement when using the above
+PROPERTY_WRITER_BULK_INSERT_CHUNK_SIZE = 10000
+
+# Property writer: in halo-parallel modes (e.g. --load-mode=server), properties from all processes are queued on the
+# server and committed together. The queue is committed at the end of each timestep, or sooner if it holds this many
+# rows or its oldest rows have waited this many seconds
+PROPERTY_WRITER_SERVER_COMMIT_QUEUE_MAXIMUM_ROWS = 100000
+PROPERTY_WRITER_SERVER_COMMIT_QUEUE_MAXIMUM_TIME = 60 # seconds
+
+# Property writer: with --prefetch, the next timestep is loaded in the background only if the estimated memory needed
+# for it and the current timestep together stays within this budget (see HandlerBase.estimate_timestep_memory)
+PROPERTY_WRITER_PREFETCH_MEMORY_BUDGET = 8 * 1024**3 # bytes
+
+# If True, plain numerical numpy arrays are stored in a native binary format that can be decoded without unpickling
+# (see core/data_attribute_mapper.py). Versions of tangos that predate this format cannot read such arrays, so switching
+# it on (or running 'tangos migrate-arrays') is a one-way migration for the database.
+array_native_format = False
+
+# Property writer: if not None, numerical arrays larger than array_store_threshold_bytes are stored in per-simulation
+# sidecar files in this folder, and read back via memory-mapping, rather than being pickled into the database.
+# See core/array_store.py
+array_store_folder = os.environ.get("TANGOS_ARRAY_STORE_FOLDER", None)
+array_store_threshold_bytes = 65536
+# If True, arrays in sidecar files are returned as read-only views onto the memory-mapped file, rather than as copies
+array_store_return_memmap = False
+
+# Folder for the per-timestep particle membership cache built by 'tangos build-membership'. If None, the cache is kept
+# in a .tangos-membership folder within each simulation folder. See input_handlers/membership_cache.py
+membership_cache_folder = os.environ.get("TANGOS_MEMBERSHIP_CACHE_FOLDER", None)
+
 # Minimum time between providing updates to the user during tangos write, when running in parallel
 # Note that this is a 'polling' interval, for checking whether to update the display. Internally, the
 # statistics are updated whenever a commit is made by any process (and the frequency of such commits
@@ -0,0 +1,159 @@
+"""Storage of large numerical arrays in per-simulation sidecar files, rather than inside the database.
+
+When config.array_store_folder is set, numerical arrays larger than config.array_store_threshold_bytes that are
+written by the property writer are appended in raw form to a file <array_store_folder>/<simulation>.tangos-arrays.
+The database then stores only a short reference (file, offset, dtype and shape) in the data_array column. On
+retrieval, the array is read from a np.memmap of the sidecar file, so that no decompression or unpickling is required.
+By default a copy is returned, as for arrays stored in the database. If config.array_store_return_memmap is True,
+a read-only view onto the memmap is returned instead, which avoids the copy and allows the operating system to share
+pages between readers.
+
+If the database transaction fails after arrays have been appended, the sidecar file is truncated back to its length
+before the transaction, so that no unreferenced bytes are left behind. Appends are protected by an exclusive lock on
+the sidecar file where the platform supports it (fcntl); elsewhere, only one process may write to a given simulation
+at a time, which is in any case ensured by the property writer's database lock.
+
+Note that sidecar files must be kept alongside the database; copying the database alone (e.g. with
+tangos import) will leave dangling references.
+"""
+
+import contextlib
+import json
+import os
+
+import numpy as np
+
+from .. import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# References are padded such that their length is never a multiple of 8 bytes, so that they cannot be confused with
+# the oldest array format (raw float64 bytes); see data_attribute_mapper
+REFERENCE_HEADER = b"MX\x01"
+SIDECAR_EXTENSION = ".tangos-arrays"
+_ALIGNMENT = 64
+_STORABLE_DTYPE_KINDS = "biufc"
+
+_active_writer = None
+_open_memmaps = {}
+
+
+class SidecarArrayWriter:
+    """Appends arrays to a sidecar file, holding an exclusive lock on it until closed"""
+    def __init__(self, folder, filename):
+        self._filename = filename
+        os.makedirs(folder, exist_ok=True)
+        self._file = open(os.path.join(folder, filename), "ab")
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._offset = self._initial_offset = self._file.seek(0, os.SEEK_END)
+
+    def append(self, array):
+        """Append the array to the sidecar file and return the reference to be stored in the database"""
+        padding = (-self._offset) % _ALIGNMENT
+        self._file.write(b"\0"*padding)
+        self._offset += padding
+
+        array = np.ascontiguousarray(array)
+        reference = {'file': self._filename, 'offset': self._offset,
+                     'dtype': array.dtype.str, 'shape': list(array.shape)}
+        self._file.write(array.tobytes())
+        self._offset += array.nbytes
+        packed = REFERENCE_HEADER + json.dumps(reference).encode('ascii')
+        if len(packed) % 8 == 0:
+            packed += b" "
+        return packed
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def discard(self):
+        """Remove all arrays appended since the file was opened, e.g. because the references were not committed"""
+        self._file.truncate(self._initial_offset)
+        self._offset = self._initial_offset
+
+    def close(self):
+        self.flush()
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def sidecar_filename(simulation_basename):
+    return simulation_basename.replace("/", "%") + SIDECAR_EXTENSION
+
+@contextlib.contextmanager
+def writing_for_simulation(simulation_basename):
+    """Within this context, large arrays that are packed for storage are appended to the simulation's sidecar file.
+
+    If the context exits with an exception, the arrays appended within it are removed again, since the database
+    transaction storing their references cannot have been committed. If config.array_store_folder is None, this
+    context does nothing."""
+    global _active_writer
+    if config.array_store_folder is None or _active_writer is not None:
+        yield
+        return
+
+    _active_writer = SidecarArrayWriter(config.array_store_folder, sidecar_filename(simulation_basename))
+    try:
+        yield
+    except:
+        _active_writer.discard()
+        raise
+    finally:
+        writer, _active_writer = _active_writer, None
+        writer.close()
+
+def flush():
+    """Ensure all arrays appended so far are on disk; call before committing references to the database"""
+    if _active_writer is not None:
+        _active_writer.flush()
+
+def store_if_appropriate(data):
+    """If a sidecar file is open for writing and data is a large numerical array, store it and return the reference.
+
+    Otherwise, return None to indicate the data should be stored in the database itself."""
+    if _active_writer is None or not isinstance(data, np.ndarray):
+        return None
+    if data.dtype.kind not in _STORABLE_DTYPE_KINDS or data.nbytes < config.array_store_threshold_bytes:
+        return None
+    return _active_writer.append(data)
+
+def is_reference(packed):
+    """Return True if the packed data_array value is a reference generated by SidecarArrayWriter.append"""
+    return packed.startswith(REFERENCE_HEADER) and len(packed) % 8 != 0
+
+def _get_memmap(filename, minimum_size):
+    path = os.path.join(config.array_store_folder, filename)
+    mm = _open_memmaps.get(path, None)
+    if mm is None or len(mm) < minimum_size:
+        # (re)open, since the file may have grown since it was last mapped
+        mm = np.memmap(path, dtype=np.uint8, mode='r')
+        _open_memmaps[path] = mm
+    return mm
+
+def load(packed):
+    """Return the array given a reference generated by SidecarArrayWriter.append
+
+    The array is a copy unless config.array_store_return_memmap is True, in which case it is a read-only view
+    onto the sidecar file."""
+    if config.array_store_folder is None:
+        raise OSError("This property is stored in a sidecar file, but config.array_store_folder is not set")
+    reference = json.loads(packed[len(REFERENCE_HEADER):].decode('ascii'))
+    dtype = np.dtype(reference['dtype'])
+    shape = tuple(reference['shape'])
+    nbytes = dtype.itemsize * int(np.prod(shape))
+    mm = _get_memmap(reference['file'], reference['offset'] + nbytes)
+    view = np.ndarray(shape, dtype=dtype, buffer=mm, offset=reference['offset'])
+    if config.array_store_return_memmap:
+        return view
+    else:
+        return view.copy()
+
+def close_all():
+    """Release all memory maps held by this process"""
+    _open_memmaps.clear()
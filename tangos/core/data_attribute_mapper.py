@@ -5,12 +5,16 @@ of different types has to be stored in different attributes.
 import datetime
 import functools
 import pickle
+import struct
 import sys
 import time
 import zlib
 
 import numpy as np
 
+from .. import config
+from . import array_store
+
 pickle_loads = pickle.loads
 if int(sys.version[0])==3:
     pickle_loads = functools.partial(pickle.loads, encoding='latin1')
@@ -18,6 +22,19 @@ if int(sys.version[0])==3:
 
 _THRESHOLD_FOR_COMPRESSION = 1000
 
+# Native array format ("NX"): header and version, codec byte, dtype string, shape, padding, then the raw
+# little-endian array bytes (possibly zlib-compressed). Unlike the pickled "PX"/"ZX" formats, this can be decoded
+# without unpickling. The padding ensures that the total length is never a multiple of 8 bytes, whereas the oldest
+# format (raw float64 bytes, with no header) always is; so old data cannot be mistaken for the native format.
+# The native format is only written if config.array_native_format is True, since older versions of tangos cannot
+# read it.
+_NATIVE_HEADER = b"NX\x01"
+_NATIVE_CODEC_RAW = b"R"
+_NATIVE_CODEC_ZLIB = b"Z"
+_NATIVE_DTYPE_KINDS = "biufc"
+_NATIVE_ZLIB_LEVEL = 1
+_NATIVE_MINIMUM_COMPRESSION_RATIO = 0.9 # only keep compressed data if it saves at least 10% of the space
+
 def get_data_of_unknown_type(obj):
     """Starting from the ORM object, extract data which may be stored in a variety of attributes depending on its type"""
     mapper = DataAttributeMapper(db_object=obj)
@@ -29,6 +46,14 @@ def set_data_of_unknown_type(obj, data):
     mapper.set(obj,data)
 
 
+def pack_data_of_unknown_type(data):
+    """Return (attribute_name, packed_value) for storing the given data, without needing an ORM object.
+
+    This is used for bulk inserts that bypass the ORM. attribute_name is None if the data is None."""
+    mapper = DataAttributeMapper(data=data)
+    return mapper._attribute_name, mapper.pack(data)
+
+
 class DataAttributeMapper:
     _order = 0
     # this can be used to force a subclass to be 'found' last
@@ -166,17 +191,116 @@ class ArrayAttributeMapper(DataAttributeMapper):
     def _unpack_old_format(self, packed):
         return np.frombuffer(packed)
 
+    @staticmethod
+    def _native_format_applies(data):
+        return type(data) is np.ndarray and data.dtype.kind in _NATIVE_DTYPE_KINDS
+
+    @staticmethod
+    def _pack_native(data):
+        dtype = data.dtype.newbyteorder('<') if data.dtype.byteorder == '>' else data.dtype
+        raw = np.ascontiguousarray(data, dtype=dtype).tobytes()
+        codec = _NATIVE_CODEC_RAW
+        if len(raw) > _THRESHOLD_FOR_COMPRESSION:
+            compressed = zlib.compress(raw, _NATIVE_ZLIB_LEVEL)
+            if len(compressed) < _NATIVE_MINIMUM_COMPRESSION_RATIO*len(raw):
+                raw = compressed
+                codec = _NATIVE_CODEC_ZLIB
+        dtype_str = dtype.str.encode('ascii')
+        header = _NATIVE_HEADER + codec + struct.pack("<B%dsB%dq" % (len(dtype_str), data.ndim), len(dtype_str),
+                                                      dtype_str, data.ndim, *data.shape)
+        padding = 1 if (len(header) + 1 + len(raw)) % 8 == 0 else 0
+        return header + struct.pack("<B", padding) + b"\0"*padding + raw
+
+    @staticmethod
+    def _is_native(packed):
+        return packed.startswith(_NATIVE_HEADER) and len(packed) % 8 != 0
+
+    @staticmethod
+    def _unpack_native_header(packed):
+        """Return (dtype, shape, codec, offset of payload) for data in the native format"""
+        offset = len(_NATIVE_HEADER)
+        codec = packed[offset:offset+1]
+        if codec not in (_NATIVE_CODEC_RAW, _NATIVE_CODEC_ZLIB):
+            raise ValueError("Unknown codec %r in native array data" % codec)
+        offset += 1
+        dtype_len, = struct.unpack_from("<B", packed, offset)
+        offset += 1
+        dtype = np.dtype(bytes(packed[offset:offset+dtype_len]).decode('ascii'))
+        offset += dtype_len
+        ndim, = struct.unpack_from("<B", packed, offset)
+        offset += 1
+        shape = struct.unpack_from("<%dq" % ndim, packed, offset)
+        offset += 8*ndim
+        padding, = struct.unpack_from("<B", packed, offset)
+        offset += 1 + padding
+        return dtype, shape, codec, offset
+
+    def _unpack_native_payload(self, packed):
+        dtype, shape, codec, offset = self._unpack_native_header(packed)
+        if codec == _NATIVE_CODEC_ZLIB:
+            return dtype, shape, zlib.decompress(memoryview(packed)[offset:])
+        else:
+            return dtype, shape, memoryview(packed)[offset:]
+
+    def _unpack_native(self, packed):
+        dtype, shape, payload = self._unpack_native_payload(packed)
+        # copy so that the caller receives a writable array, as from the pickled formats
+        return np.frombuffer(payload, dtype=dtype).reshape(shape).astype(dtype.newbyteorder('='))
+
+    def _unpack_without_copy(self, packed):
+        """As unpack, but native-format data is returned as a (possibly read-only) view onto the packed buffer"""
+        if packed is not None and self._is_native(packed):
+            dtype, shape, payload = self._unpack_native_payload(packed)
+            return np.frombuffer(payload, dtype=dtype).reshape(shape)
+        else:
+            return self.unpack(packed)
+
+    def get_stacked(self, db_objects):
+        """Return the data from all the db_objects as a single array with one row per object.
+
+        The data are decoded straight into the preallocated output. If the objects do not all hold plain numpy
+        arrays of the same dtype and shape, return None; the caller should then fall back to get()."""
+        if len(db_objects)==0:
+            return None
+        arrays = []
+        for db_object in db_objects:
+            packed = getattr(db_object, self._attribute_name)
+            if packed is None:
+                return None
+            arrays.append(self._unpack_without_copy(packed))
+
+        first = arrays[0]
+        if type(first) is not np.ndarray:
+            return None
+        for a in arrays:
+            if type(a) is not np.ndarray or a.dtype != first.dtype or a.shape != first.shape:
+                return None
+
+        result = np.empty((len(arrays),)+first.shape, dtype=first.dtype.newbyteorder('='))
+        for i, a in enumerate(arrays):
+            result[i] = a
+        return result
+
     def unpack(self, packed):
         if len(packed)==0:
             return None
+        elif self._is_native(packed):
+            return self._unpack_native(packed)
         elif packed.startswith(b"ZX"):
             return self._unpack_compressed(packed)
         elif packed.startswith(b"PX"):
             return self._unpack_uncompressed(packed)
+        elif array_store.is_reference(packed):
+            return array_store.load(packed)
         else:
             return self._unpack_old_format(packed)
 
     def pack(self, data):
+        reference = array_store.store_if_appropriate(data)
+        if reference is not None:
+            return reference
+        if config.array_native_format and self._native_format_applies(data):
+            return self._pack_native(data)
         dumped_st = pickle.dumps(data)
         if len(dumped_st) > _THRESHOLD_FOR_COMPRESSION:
             dumped_st = b"ZX" + zlib.compress(dumped_st)
@@ -185,6 +309,23 @@ class ArrayAttributeMapper(DataAttributeMapper):
         return dumped_st
 
 
+def repack_array_in_native_format(packed):
+    """Given a packed data_array value, return the equivalent in the native (NX) format.
+
+    This is used by 'tangos migrate-arrays', regardless of config.array_native_format.
+
+    Returns None if no conversion is needed or possible (e.g. the data is already in the native format or is
+    stored in a sidecar file, or the unpickled data is not a plain numerical numpy array)."""
+    if packed is None or len(packed)==0 or ArrayAttributeMapper._is_native(packed) \
+            or array_store.is_reference(packed):
+        return None
+    mapper = object.__new__(ArrayAttributeMapper)
+    data = mapper.unpack(packed)
+    if not mapper._native_format_applies(data):
+        return None
+    return mapper._pack_native(data)
+
+
 # Following must be defined last to act as a fall-through:
 class NullAttributeMapper(DataAttributeMapper):
     _handled_types = [type(None)]
@@ -198,4 +339,4 @@ class NullAttributeMapper(DataAttributeMapper):
     def get(self, db_object):
         return None
 
-__all__ = ['get_data_of_unknown_type', 'set_data_of_unknown_type']
+__all__ = ['get_data_of_unknown_type', 'set_data_of_unknown_type', 'pack_data_of_unknown_type']
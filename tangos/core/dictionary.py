@@ -103,6 +103,30 @@ def get_or_create_dictionary_item(session, name):
     _dict_obj[session][name] = obj
     return obj
 
+def get_or_create_dictionary_ids(session, names):
+    """Map each of the given names to a DictionaryItem id, creating any that are missing.
+
+    Unlike get_or_create_dictionary_item, this issues a single query for all names and commits any newly
+    created items straight away, so that the returned ids are all valid. As with get_or_create_dictionary_item,
+    it must be called *while the database is locked under the specified session*."""
+
+    names = set(names)
+    result = {}
+    if len(names)==0:
+        return result
+
+    for obj_id, text in session.query(DictionaryItem.id, DictionaryItem.text).filter(DictionaryItem.text.in_(names)):
+        result[text] = obj_id
+
+    missing = [DictionaryItem(name) for name in names if name not in result]
+    if len(missing)>0:
+        session.add_all(missing)
+        session.commit()
+        for obj in missing:
+            result[obj.text] = obj.id
+
+    return result
+
 def _get_dict_cache_for_session(session):
     session_dict = _dict_id.get(session, None)
     if session_dict is None:
@@ -52,13 +52,24 @@ class HaloPropertyGetter:
         :type halo: SimulationObjectBase
         :type property_id: int"""
 
-        return_vals = []
+        return self.postprocess_data_objects(self._get_objects_from_cache(halo, property_id))
 
-        for x in halo.all_properties:
-            if x.name_id == property_id:
-                return_vals.append(x)
+    def get_first_from_cache_for_halos(self, halos, property_id):
+        """For each halo, get the first value of the specified property from its existing in-memory cache
 
-        return self.postprocess_data_objects(return_vals)
+        Returns a list with one entry per halo, which is None if the halo has no such property. This is equivalent
+        to calling get_from_cache(halo, property_id)[0] for each halo, but allows the data to be processed in a batch.
+
+        :type halos: list of SimulationObjectBase
+        :type property_id: int"""
+        first_objects = []
+        for halo in halos:
+            objects = self._get_objects_from_cache(halo, property_id)
+            first_objects.append(objects[0] if len(objects)>0 else None)
+        return self.postprocess_first_data_objects(first_objects)
+
+    def _get_objects_from_cache(self, halo, property_id):
+        return list(halo._get_collection_index('all_properties', 'name_id').get(property_id, []))
 
 
     def get_from_session(self, halo, property_id, session):
@@ -91,16 +102,16 @@ class HaloPropertyGetter:
         :type halo: SimulationObjectBase
         :type property_id: int"""
 
-        for x in halo.all_properties:
-            if x.name_id == property_id:
-                return True
-
-        return False
+        return property_id in halo._get_collection_index('all_properties', 'name_id')
 
     def postprocess_data_objects(self, objects):
         """Post-process the ORM data objects to pull out the data in the form required"""
         return objects
 
+    def postprocess_first_data_objects(self, objects):
+        """Post-process ORM data objects, one (or None) per halo, to pull out the data in the form required"""
+        return [None if o is None else self.postprocess_data_objects([o])[0] for o in objects]
+
 
 
 class HaloPropertyValueGetter(HaloPropertyGetter):
@@ -113,6 +124,18 @@ class HaloPropertyValueGetter(HaloPropertyGetter):
     def postprocess_data_objects(self, outputs):
         return [self._postprocess_one_result(o) for o in outputs]
 
+    def postprocess_first_data_objects(self, objects):
+        present = [o for o in objects if o is not None]
+        if len(present)>1 and not self._uses_reassembly(present[0]):
+            # Optimisation: where all the data are arrays of the same shape, decode them into a single array
+            self._setup_data_mapper(present[0])
+            if hasattr(self._mapper, 'get_stacked'):
+                stacked = self._mapper.get_stacked(present)
+                if stacked is not None:
+                    rows = iter(stacked)
+                    return [None if o is None else next(rows) for o in objects]
+        return super().postprocess_first_data_objects(objects)
+
     def _setup_data_mapper(self, property_object):
         if self._mapper is None:
             # Optimisation: figure out a mapper for the first output and assume it's ok for all of them
@@ -126,10 +149,12 @@ class HaloPropertyValueGetter(HaloPropertyGetter):
             except (NameError, AttributeError):
                 pass
 
-    def _postprocess_one_result(self, property_object):
+    def _uses_reassembly(self, property_object):
         self._infer_property_class(property_object)
+        return hasattr(self._providing_class, 'reassemble')
 
-        if hasattr(self._providing_class, 'reassemble'):
+    def _postprocess_one_result(self, property_object):
+        if self._uses_reassembly(property_object):
             instance = self._providing_class(property_object.halo.timestep.simulation)
             return instance.reassemble(property_object, *self._options)
         else:
@@ -146,21 +171,15 @@ class HaloPropertyValueWithReassemblyOptionsGetter(HaloPropertyValueGetter):
 
 class HaloPropertyRawValueGetter(HaloPropertyValueGetter):
     """As HaloPropertyValueGetter, but never invoke an automatic reassembly; always retrieve the raw data"""
-    def _postprocess_one_result(self, property_object):
-        self._setup_data_mapper(property_object)
-        return self._mapper.get(property_object)
+    def _uses_reassembly(self, property_object):
+        return False
 
 
 
 class HaloLinkGetter(HaloPropertyGetter):
     """As HaloPropertyGetter, but retrieve HaloLinks instead of HaloProperties"""
-    def get_from_cache(self, halo, property_id):
-        return_vals = []
-        for x in halo.all_links:
-            if x.relation_id == property_id:
-                return_vals.append(x)
-
-        return self.postprocess_data_objects(return_vals)
+    def _get_objects_from_cache(self, halo, property_id):
+        return list(halo._get_collection_index('all_links', 'relation_id').get(property_id, []))
 
     def get_from_session(self, halo, property_id, session):
         from . import halo_data
@@ -169,11 +188,7 @@ class HaloLinkGetter(HaloPropertyGetter):
         return self.postprocess_data_objects(query_links.all())
 
     def cache_contains(self, halo, property_id):
-        for x in halo.all_links:
-            if x.relation_id == property_id:
-                return True
-
-        return False
+        return property_id in halo._get_collection_index('all_links', 'relation_id')
 
     def keys_from_cache(self, halo):
         """Return a list of keys from an existing in-memory cache"""
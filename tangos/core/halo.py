@@ -118,6 +118,25 @@ class SimulationObjectBase(Base):
     def init_on_load(self):
         self._dict_is_complete = False
         self._d = {}
+        self._collection_indices = {}
+
+    def _get_collection_index(self, collection_name, key_name):
+        """Return a dictionary mapping values of key_name to lists of objects in an eagerly-loaded collection.
+
+        For example, _get_collection_index('all_properties', 'name_id') maps each dictionary id to the
+        HaloProperty objects with that name. The index is built lazily and rebuilt if the collection is replaced
+        or changes size."""
+        collection = getattr(self, collection_name)
+        if not hasattr(self, '_collection_indices'):
+            self._collection_indices = {}
+        cached = self._collection_indices.get(collection_name, None)
+        if cached is None or cached[0] is not collection or cached[1] != len(collection):
+            index = {}
+            for x in collection:
+                index.setdefault(getattr(x, key_name), []).append(x)
+            cached = (collection, len(collection), index)
+            self._collection_indices[collection_name] = cached
+        return cached[2]
 
     def __repr__(self):
 
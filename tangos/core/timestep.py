@@ -1,6 +1,8 @@
+import numbers
 import os
 import os.path
 
+import numpy as np
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, Text, and_
 from sqlalchemy.orm import Session, aliased, backref, relationship
 
@@ -151,6 +153,15 @@ class TimeStep(Base):
         else:
             property_description = live_calculation.parser.parse_property_names(*plist)
 
+        if config.enable_columnar_property_cache and sanitize and not limit:
+            from ..live_calculation import columnar_cache
+            names = property_description.stored_property_names()
+            if names is not None:
+                calculation_results = columnar_cache.get_cache().calculate_all(self, names, object_typecode,
+                                                                               order_by_halo_number)
+                if calculation_results is not None:
+                    return calculation_results
+
         # must be performed in its own session as we intentionally load in a lot of
         # objects with incomplete lazy-loaded properties
         session = Session()
@@ -178,6 +189,79 @@ class TimeStep(Base):
             session.close()
         return calculation_results
 
+    def calculate_all_for_progenitors(self, *plist, **kwargs):
+        """Run the specified calculations along the major progenitor branch of every object in this timestep.
+
+        The major progenitor branches of all objects are followed simultaneously, taking one database round trip
+        per hop rather than one series of round trips per object. For example
+        m, = ts.calculate_all_for_progenitors("mass") returns a 2D array m where m[i,j] is the mass of the
+        j-th major progenitor of the i-th object in the timestep (and m[i,0] is the mass of the object itself).
+
+        Each returned array has one row per object, ordered by halo number, and one column per hop. Histories that
+        are shorter than the longest one (or values that cannot be calculated) are padded with NaN for numerical
+        results and None otherwise.
+
+        :param object_type: integer or string representing the particular object type
+                            (e.g. 'halo', 'BH' or 'group'). If None (default), all
+                            types are included.
+
+        :param nmax: the maximum number of hops to follow (default 1000)
+        """
+        from .. import live_calculation, relation_finding, temporary_halolist as thl
+        from . import Session
+        from .halo import SimulationObjectBase
+
+        object_typetag = kwargs.get('object_type', kwargs.get('object_typetag', None))
+        nmax = kwargs.get('nmax', 1000)
+
+        if isinstance(plist[0], live_calculation.Calculation):
+            property_description = plist[0]
+        else:
+            property_description = live_calculation.parser.parse_property_names(*plist)
+
+        # must be performed in its own session as we intentionally load in a lot of
+        # objects with incomplete lazy-loaded properties
+        session = Session()
+        try:
+            halos_query = session.query(SimulationObjectBase).filter_by(timestep_id=self.id)
+            if object_typetag:
+                halos_query = halos_query.filter_by(
+                    object_typecode=SimulationObjectBase.object_typecode_from_tag(object_typetag))
+            halos = halos_query.order_by(SimulationObjectBase.halo_number, SimulationObjectBase.id).all()
+
+            if len(halos)==0:
+                return [np.empty((0, 0), dtype=object) for _ in range(property_description.n_columns())]
+
+            strategy = relation_finding.multi_source.MultiSourceAllMajorProgenitorsStrategy(halos, nhops_max=nmax)
+            sources = np.asarray(strategy.sources(), dtype=int)
+            nhops = np.asarray(strategy.nhops(), dtype=int)
+
+            with strategy.temp_table() as tt:
+                # as in find_progenitor, the query must include the row id so that rows referring to the same
+                # halo are not de-duplicated
+                query = property_description.supplement_halo_query(thl.enumerated_halo_query(tt))
+                progenitors = [x[1] for x in query.all()]
+                values = property_description.values(progenitors, Session.object_session(self))
+        finally:
+            session.close()
+
+        assert values.shape[1] == len(sources) == len(nhops)
+
+        shape = (len(halos), nhops.max()+1)
+        return [self._pad_progenitor_values(v, sources, nhops, shape) for v in values]
+
+    @staticmethod
+    def _pad_progenitor_values(values, rows, columns, shape):
+        present = [v is not None for v in values]
+        if all(isinstance(v, numbers.Real) for v, p in zip(values, present) if p):
+            result = np.full(shape, np.nan)
+        else:
+            result = np.full(shape, None, dtype=object)
+        for v, r, c, p in zip(values, rows, columns, present):
+            if p:
+                result[r, c] = v
+        return result
+
     def gather_property(self, *args, **kwargs):
         """The old alias for calculate_all, retained for compatibility"""
         return self.calculate_all(*args, **kwargs)
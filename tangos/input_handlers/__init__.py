@@ -7,6 +7,7 @@ overriding the functionality.
 For an introduction, see https://pynbody.github.io/tangos/input_handlers.html
 """
 
+import glob
 import importlib
 import os
 import os.path
@@ -127,6 +128,31 @@ class HandlerBase:
             _loaded_timesteps[ts_hash] = data
             return data
 
+    def prefetch_timestep(self, ts_extension, mode=None, object_typetag='halo'):
+        """Load the data for a timestep ahead of it being needed, for example from a background thread.
+
+        Returns an object (or tuple of objects) that must be kept alive for as long as the prefetched data should
+        remain in the cache, so that subsequent calls to load_timestep etc. can return it without reading from disk.
+        Subclasses may also prepare anything else that will be needed to load objects, such as halo catalogues."""
+        return self.load_timestep(ts_extension, mode)
+
+    def estimate_timestep_memory(self, ts_extension):
+        """Returns a rough estimate, in bytes, of the memory that loading the timestep will occupy.
+
+        The default implementation returns the size on disk of the timestep file or folder, together with any
+        auxiliary files sharing its name."""
+        filename = self._extension_to_filename(ts_extension)
+        total = 0
+        for path in [filename] + glob.glob(glob.escape(filename) + ".*"):
+            if not os.path.exists(path):
+                continue
+            elif os.path.isdir(path):
+                for folder, _, files in os.walk(path):
+                    total += sum(os.path.getsize(os.path.join(folder, f)) for f in files)
+            else:
+                total += os.path.getsize(path)
+        return total
+
     def load_region(self, ts_extension, region_specification, mode=None, expected_number_of_queries=None):
         """Returns an object that connects to the data for a timestep on disk, filtered using the
         specified region specification. Acceptable region specifications are output handler dependent.
@@ -169,6 +195,36 @@ class HandlerBase:
         :arg mode - sets a method for loading the tracked region; see load_object mode for more information"""
         raise NotImplementedError
 
+    def get_object_membership(self, ts_extension, object_typetag='halo', dm_only=False):
+        """Returns a particle_matching.ObjectMembership listing the particle IDs belonging to each object.
+
+        This allows objects to be linked (see the membership engine of the crosslink tools) without loading
+        full snapshots. The information is read from the membership cache if it has been built (see
+        'tangos build-membership'), or otherwise from the halo catalogue."""
+        from . import membership_cache
+        membership = membership_cache.load(self, ts_extension, object_typetag, dm_only)
+        if membership is None:
+            membership = self.get_object_membership_without_caching(ts_extension, object_typetag, dm_only)
+        return membership
+
+    def get_object_membership_without_caching(self, ts_extension, object_typetag='halo', dm_only=False):
+        """Reads and returns the ObjectMembership from the halo catalogue. Handlers that cannot provide the
+        information raise NotImplementedError."""
+        raise NotImplementedError("Object membership is not available for %s" % type(self).__name__)
+
+    def match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max, dm_only=False, threshold=0.005,
+                                    object_typetag='halo', output_handler_for_ts2=None):
+        """Returns (matches from ts1 to ts2, matches from ts2 to ts1), each in the format returned by match_objects.
+
+        The default implementation simply calls match_objects in each direction; handlers able to share the work
+        between the two directions should override it."""
+        other_handler = output_handler_for_ts2 or self
+        forward = self.match_objects(ts1, ts2, halo_min, halo_max, dm_only, threshold, object_typetag,
+                                     output_handler_for_ts2=other_handler)
+        backward = other_handler.match_objects(ts2, ts1, halo_min, halo_max, dm_only, threshold, object_typetag,
+                                               output_handler_for_ts2=self)
+        return forward, backward
+
 
     @classmethod
     def handler_class_name(cls):
@@ -0,0 +1,70 @@
+"""Persistent on-disk cache of which particles belong to which object, for each timestep and object type.
+
+Each cache entry is a folder containing .npy files that are memory-mapped on retrieval:
+
+ * particle_ids.npy: the IDs of all particles belonging to any object, sorted
+ * object_index.npy: the catalogue offset of the object to which each of those particles belongs
+ * object_numbers.npy: the halo finder's number for the object at each catalogue offset
+ * members_by_object.npy, object_start.npy: positions in particle_ids of the particles belonging to each object,
+   grouped so that those belonging to the object at offset i are members_by_object[object_start[i]:object_start[i+1]]
+
+Entries are stored in config.membership_cache_folder if set, or otherwise in a .tangos-membership folder within the
+simulation folder. They are created by the 'tangos build-membership' command and are then used by
+HandlerBase.get_object_membership in place of reading the halo catalogue.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .. import config
+from .particle_matching import ObjectMembership
+
+CACHE_FOLDER_NAME = ".tangos-membership"
+_ARRAY_NAMES = ("particle_ids", "object_index", "object_numbers", "members_by_object", "object_start")
+
+
+def _cache_folder(handler):
+    if config.membership_cache_folder is None:
+        return os.path.join(config.base, handler.basename, CACHE_FOLDER_NAME)
+    else:
+        return os.path.join(config.membership_cache_folder, handler.basename.replace("/", "%"))
+
+def cache_path(handler, ts_extension, object_typetag, dm_only):
+    """Return the path of the folder holding the cache entry for the given timestep and object type"""
+    name = ts_extension.replace("/", "%") + "." + object_typetag
+    if dm_only:
+        name += ".dm"
+    return os.path.join(_cache_folder(handler), name)
+
+def load(handler, ts_extension, object_typetag, dm_only):
+    """Return the cached ObjectMembership for the given timestep and object type, or None if it is not cached"""
+    path = cache_path(handler, ts_extension, object_typetag, dm_only)
+    if not os.path.exists(path):
+        return None
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in _ARRAY_NAMES}
+    return ObjectMembership.from_sorted(**arrays)
+
+def save(handler, ts_extension, object_typetag, dm_only, membership):
+    """Store the ObjectMembership in the cache, replacing any existing entry"""
+    path = cache_path(handler, ts_extension, object_typetag, dm_only)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+
+    # write into a temporary folder first, so that readers never see a partially-written entry
+    temporary_path = tempfile.mkdtemp(dir=parent, prefix=".incomplete-")
+    try:
+        members_by_object, object_start = membership.members_by_object()
+        arrays = {'particle_ids': membership.particle_ids, 'object_index': membership.object_index,
+                  'object_numbers': membership.object_numbers, 'members_by_object': members_by_object,
+                  'object_start': object_start}
+        for name in _ARRAY_NAMES:
+            np.save(os.path.join(temporary_path, name + ".npy"), np.asarray(arrays[name]))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(temporary_path, path)
+    except:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        raise
@@ -0,0 +1,170 @@
+"""Helpers to turn counts of particles shared between objects into the weighted matches used for linking.
+
+Counts are held as sparse triples (row, column, count): the object at offset row in the first catalogue shares
+count particles with the object at offset column in the second catalogue. Only nonzero counts are stored.
+
+The counts are either taken from the dense matrix returned by a pynbody bridge (see sparse_counts_from_matrix), or
+derived directly from the particle IDs belonging to each object (see ObjectMembership) by a sorted merge. The latter
+never requires a dense matrix over all pairs of objects, and the memberships can be read without loading the
+snapshots in full.
+"""
+
+import numpy as np
+
+
+def sparse_counts_from_matrix(matrix):
+    """Convert a dense matrix of particles in common into sparse (rows, columns, counts) triples"""
+    rows, columns = np.nonzero(matrix)
+    return rows, columns, matrix[rows, columns]
+
+def transpose(sparse_counts):
+    """Return the sparse counts for matching in the opposite direction"""
+    rows, columns, counts = sparse_counts
+    return columns, rows, counts
+
+def fuzzy_matches(sparse_counts, n_sources, threshold, source_number=None, target_number=None):
+    """Return the possible matches for each source object, in the format returned by match_objects.
+
+    The weight of each match is the fraction of the source's particles held in common with any target that are
+    held in common with that particular target. Matches with weight at or below threshold are discarded.
+
+    :param sparse_counts: (rows, columns, counts) as returned by sparse_counts_from_matrix or
+                          sparse_counts_from_membership
+    :param n_sources: the number of objects in the source catalogue; every source appears in the output
+    :param threshold: the minimum weight for a match to be retained
+    :param source_number: function mapping an offset in the source catalogue to the number returned as the key
+    :param target_number: function mapping an offset in the target catalogue to the number returned in the matches
+    :return: dictionary mapping each source number to a list of (target number, weight), strongest match first.
+             Matches of equal weight are listed in descending order of target offset, as by pynbody's
+             fuzzy_match_halos.
+    """
+    rows, columns, counts = sparse_counts
+    if source_number is None:
+        source_number = lambda x: x
+    if target_number is None:
+        target_number = lambda x: x
+
+    in_range = rows < n_sources
+    rows, columns, counts = rows[in_range], columns[in_range], counts[in_range]
+
+    row_sums = np.bincount(rows, weights=counts, minlength=n_sources)
+    weights = counts / row_sums[rows]
+
+    keep = weights > threshold
+    rows, columns, weights = rows[keep], columns[keep], weights[keep]
+
+    ordering = np.lexsort((-columns, -weights, rows))
+    rows, columns, weights = rows[ordering], columns[ordering], weights[ordering]
+    boundaries = np.searchsorted(rows, np.arange(n_sources+1))
+
+    output = {}
+    for source in range(n_sources):
+        start, end = boundaries[source], boundaries[source+1]
+        output[source_number(source)] = [(target_number(column), weight)
+                                         for column, weight in zip(columns[start:end], weights[start:end])]
+    return output
+
+def restrict_to_range(matches, halo_min, halo_max):
+    """Remove matches from source objects with numbers outside the range halo_min to halo_max (inclusive)"""
+    if halo_max is None:
+        halo_max = np.inf
+
+    del_keys = []
+    for k in matches:
+        if k < halo_min or k > halo_max:
+            del_keys.append(k)
+
+    for k in del_keys:
+        del matches[k]
+
+    return matches
+
+
+class ObjectMembership:
+    """The IDs of the particles belonging to each object in a catalogue, sorted by particle ID.
+
+    object_index gives, for each particle, the offset of the object it belongs to in the catalogue;
+    object_numbers maps from those offsets to the object numbers used by the halo finder."""
+
+    def __init__(self, particle_ids, object_index, object_numbers):
+        particle_ids = np.asarray(particle_ids)
+        ordering = np.argsort(particle_ids, kind='stable')
+        self.particle_ids = particle_ids[ordering]
+        self.object_index = np.asarray(object_index)[ordering]
+        self.object_numbers = np.asarray(object_numbers)
+        self._members_by_object = None
+
+    @classmethod
+    def from_group_array(cls, particle_ids, group_index, object_numbers):
+        """Construct from the ID and group offset of every particle, where particles in no group have offset -1"""
+        group_index = np.asarray(group_index)
+        in_group = group_index >= 0
+        return cls(np.asarray(particle_ids)[in_group], group_index[in_group], object_numbers)
+
+    @classmethod
+    def from_sorted(cls, particle_ids, object_index, object_numbers, members_by_object=None, object_start=None):
+        """Construct from arrays that are already sorted by particle ID (e.g. memory-mapped from a cache)"""
+        self = object.__new__(cls)
+        self.particle_ids = particle_ids
+        self.object_index = object_index
+        self.object_numbers = object_numbers
+        if members_by_object is None:
+            self._members_by_object = None
+        else:
+            self._members_by_object = members_by_object, object_start
+        return self
+
+    def __len__(self):
+        return len(self.object_numbers)
+
+    def number_of(self, index):
+        return self.object_numbers[index]
+
+    def members_by_object(self):
+        """Return (members, start) such that the particles in the object at offset i are at positions
+        members[start[i]:start[i+1]] of particle_ids"""
+        if self._members_by_object is None:
+            members = np.argsort(self.object_index, kind='stable')
+            start = np.searchsorted(self.object_index[members], np.arange(len(self)+1))
+            self._members_by_object = members, start
+        return self._members_by_object
+
+    def particle_ids_of(self, index):
+        """Return the IDs of the particles belonging to the object at the given catalogue offset"""
+        members, start = self.members_by_object()
+        return self.particle_ids[members[start[index]:start[index+1]]]
+
+    def object_index_of(self, particle_ids):
+        """Return the catalogue offset of the object to which each given particle belongs, or -1 if none"""
+        particle_ids = np.asarray(particle_ids)
+        if len(self.particle_ids) == 0:
+            return np.full(particle_ids.shape, -1, dtype=np.int64)
+        position = np.searchsorted(self.particle_ids, particle_ids)
+        position[position == len(self.particle_ids)] = 0
+        return np.where(self.particle_ids[position] == particle_ids, self.object_index[position], -1)
+
+
+def sparse_counts_from_membership(membership_1, membership_2):
+    """Count the particles in common between each pair of objects, by a sorted merge on particle IDs"""
+    ids_2 = membership_2.particle_ids
+    if len(ids_2) == 0 or len(membership_1.particle_ids) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    position = np.searchsorted(ids_2, membership_1.particle_ids)
+    position[position == len(ids_2)] = 0
+    found = ids_2[position] == membership_1.particle_ids
+
+    rows = membership_1.object_index[found].astype(np.int64)
+    columns = membership_2.object_index[position[found]].astype(np.int64)
+
+    pairs, counts = np.unique(rows * len(membership_2) + columns, return_counts=True)
+    return pairs // len(membership_2), pairs % len(membership_2), counts
+
+def match_memberships(membership_1, membership_2, threshold):
+    """Returns (matches from 1 to 2, matches from 2 to 1), each in the format returned by match_objects"""
+    counts = sparse_counts_from_membership(membership_1, membership_2)
+    forward = fuzzy_matches(counts, len(membership_1), threshold, membership_1.number_of, membership_2.number_of)
+    backward = fuzzy_matches(transpose(counts), len(membership_2), threshold,
+                             membership_2.number_of, membership_1.number_of)
+    return forward, backward
@@ -19,7 +19,7 @@ from typing import TYPE_CHECKING
 
 from .. import config
 from ..log import logger
-from . import HandlerBase, finding
+from . import HandlerBase, finding, particle_matching
 
 if TYPE_CHECKING:
     import pynbody
@@ -37,6 +37,49 @@ class DummyTimeStep:
     pass
 
 
+class _ParticleIdIndex:
+    """The iord of every dm, star and gas particle in a snapshot, sorted so that particles can be found by binary search.
+
+    The index is built once per snapshot and shared by all trackers in the timestep, so that selecting k particles
+    costs O(k log N) rather than the O(N) of a np.isin over the whole snapshot."""
+
+    _families = ('dm', 'star', 'gas')
+
+    def __init__(self, f):
+        iords = []
+        indices = []
+        for family in self._families:
+            try:
+                family_snap = getattr(f, family)
+                iords.append(np.asarray(family_snap['iord']))
+            except KeyError:
+                continue
+            indices.append(family_snap.get_index_list(f))
+
+        iords = np.concatenate(iords) if len(iords)>0 else np.zeros(0, dtype=np.int64)
+        indices = np.concatenate(indices) if len(indices)>0 else np.zeros(0, dtype=np.intp)
+        ordering = np.argsort(iords, kind='stable')
+        self._sorted_iords = iords[ordering]
+        self._indices = indices[ordering]
+
+    @classmethod
+    def for_snapshot(cls, f):
+        index = getattr(f, '_tangos_particle_id_index', None)
+        if index is None:
+            index = cls(f)
+            f._tangos_particle_id_index = index
+        return index
+
+    def indices_of(self, iords):
+        """Return the sorted indices (within the snapshot) of all particles with any of the given iords"""
+        iords = np.unique(np.asarray(iords))
+        start = np.searchsorted(self._sorted_iords, iords, side='left')
+        end = np.searchsorted(self._sorted_iords, iords, side='right')
+        counts = end - start
+        positions = np.repeat(start - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return np.sort(self._indices[positions])
+
+
 class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
     pynbody_halo_class_name = None
 
@@ -97,6 +140,16 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         else:
             raise NotImplementedError("Load mode %r is not implemented"%mode)
 
+    def prefetch_timestep(self, ts_extension, mode=None, object_typetag='halo'):
+        f = self.load_timestep(ts_extension, mode)
+        if mode is None or mode == 'partial':
+            # objects are loaded via the catalogue in these modes (see load_object), so construct it now too
+            try:
+                return f, self.get_catalogue(ts_extension, object_typetag)
+            except ValueError:
+                pass # not an object type with a catalogue, e.g. trackers
+        return f
+
     def _build_kdtree(self, timestep, mode):
         timestep.build_tree()
 
@@ -200,27 +253,7 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
             return np.array([], dtype=np.intp)
         pt = track_data.particles
         if track_data.use_iord is True:
-
-            dm_part = f.dm[np.isin(f.dm['iord'], pt)]
-
-            try:
-                star_part = f.star[np.isin(f.star['iord'], pt)]
-            except KeyError:
-                star_part = f[0:0]
-
-            try:
-                gas_part = f.gas[np.isin(f.gas['iord'], pt)]
-            except KeyError:
-                gas_part = f[0:0]
-
-            # fx = dm_part.union(star_part)
-            # fx = fx.union(gas_part)
-            # return fx
-            ilist = np.hstack((dm_part.get_index_list(f),
-                               star_part.get_index_list(f),
-                               gas_part.get_index_list(f)))
-            ilist = np.sort(ilist)
-            return ilist
+            return _ParticleIdIndex.for_snapshot(f).indices_of(pt)
         else:
             return pt
 
@@ -244,15 +277,7 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         return h  # pynbody.halo.AmigaGrpCatalogue(f)
 
 
-    def match_objects(self, ts1, ts2, halo_min, halo_max,
-                      dm_only=False, threshold=0.005, object_typetag='halo',
-                      output_handler_for_ts2=None,
-                      fuzzy_match_kwa={}):
-        if dm_only:
-            only_family=pynbody.family.dm
-        else:
-            only_family=None
-
+    def _load_for_matching(self, ts1, ts2, object_typetag, output_handler_for_ts2):
         f1 = self.load_timestep(ts1)
         h1 = self.get_catalogue(ts1, object_typetag)
 
@@ -264,23 +289,83 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
             f2 = self.load_timestep(ts2)
             h2 = self.get_catalogue(ts2, object_typetag)
 
-        if halo_max is None:
-            halo_max = np.inf
+        return f1, h1, f2, h2
+
+    def match_objects(self, ts1, ts2, halo_min, halo_max,
+                      dm_only=False, threshold=0.005, object_typetag='halo',
+                      output_handler_for_ts2=None,
+                      fuzzy_match_kwa={}):
+        if dm_only:
+            only_family=pynbody.family.dm
+        else:
+            only_family=None
+
+        f1, h1, f2, h2 = self._load_for_matching(ts1, ts2, object_typetag, output_handler_for_ts2)
 
         matches = self.create_bridge(f1, f2).fuzzy_match_halos(
             h1, h2, threshold=threshold, use_family=only_family,
             **fuzzy_match_kwa,
         )
 
-        del_keys = []
-        for k in matches:
-            if k < halo_min or k > halo_max:
-                del_keys.append(k)
+        return particle_matching.restrict_to_range(matches, halo_min, halo_max)
 
-        for k in del_keys:
-            del matches[k]
+    def match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max,
+                                    dm_only=False, threshold=0.005, object_typetag='halo',
+                                    output_handler_for_ts2=None,
+                                    fuzzy_match_kwa={}):
+        """Returns the matches in both directions, as match_objects, counting the particles in common only once.
 
-        return matches
+        The particles in common are counted by a single bridge (see create_bridge), and the matches in each direction
+        are then derived from the same counts. To match without loading the snapshots, see
+        particle_matching.match_memberships."""
+        if dm_only:
+            only_family=pynbody.family.dm
+        else:
+            only_family=None
+
+        f1, h1, f2, h2 = self._load_for_matching(ts1, ts2, object_typetag, output_handler_for_ts2)
+
+        counts = particle_matching.sparse_counts_from_matrix(
+            self.create_bridge(f1, f2).count_particles_in_common(h1, h2, use_family=only_family))
+
+        number1, number2 = self._numbering_for_matches(h1, h2, **fuzzy_match_kwa)
+        forward = particle_matching.fuzzy_matches(counts, len(h1), threshold, number1, number2)
+        backward = particle_matching.fuzzy_matches(particle_matching.transpose(counts), len(h2), threshold,
+                                                   number2, number1)
+
+        return particle_matching.restrict_to_range(forward, halo_min, halo_max), \
+               particle_matching.restrict_to_range(backward, halo_min, halo_max)
+
+    @staticmethod
+    def _numbering_for_matches(h1, h2, use_halo_indexes=False):
+        """Return the functions mapping catalogue offsets to the numbers in the matches, accepting the same keywords
+        as pynbody's fuzzy_match_halos"""
+        if use_halo_indexes:
+            return None, None
+        else:
+            return h1.number_mapper.index_to_number, h2.number_mapper.index_to_number
+
+    def get_object_membership_without_caching(self, ts_extension, object_typetag='halo', dm_only=False):
+        """Reads the particle IDs belonging to each object, loading only the IDs and the halo finder's groups"""
+        f = self.load_timestep(ts_extension)
+        h = self.get_catalogue(ts_extension, object_typetag)
+
+        if dm_only:
+            family = pynbody.family.dm
+            particles = f[family]
+        else:
+            family = None
+            particles = f
+
+        if 'iord' in particles.loadable_keys() or 'iord' in particles.keys():
+            particle_ids = particles['iord'].view(np.ndarray)
+        else:
+            # without unique IDs, particles can only be identified by their position in the file
+            particle_ids = particles.get_index_list(f)
+
+        return particle_matching.ObjectMembership.from_group_array(
+            particle_ids, h.get_group_array(family=family, use_index=True),
+            h.number_mapper.index_to_number(np.arange(len(h))))
 
 
     @classmethod
@@ -559,6 +644,18 @@ class Gadget4HBTPlusInputHandler(Gadget4HDFSubfindInputHandler):
             return super().match_objects(ts1, ts2, halo_min, halo_max, dm_only, threshold, object_typetag,
                                          output_handler_for_ts2, fuzzy_match_kwa)
 
+    def match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max,
+                                    dm_only=False, threshold=0.005, object_typetag='halo',
+                                    output_handler_for_ts2=None,
+                                    fuzzy_match_kwa={}):
+        if object_typetag=='halo' and output_handler_for_ts2 is self:
+            # TrackId matching is cheap, so there is nothing to share between the two directions
+            return HandlerBase.match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max, dm_only, threshold,
+                                                           object_typetag, output_handler_for_ts2)
+        else:
+            return super().match_objects_bidirectional(ts1, ts2, halo_min, halo_max, dm_only, threshold,
+                                                       object_typetag, output_handler_for_ts2, fuzzy_match_kwa)
+
 
 
 class GadgetRockstarInputHandler(PynbodyInputHandler):
@@ -603,6 +700,31 @@ class RamsesCatalogueMixin:
             output_handler_for_ts2=output_handler_for_ts2
         )
 
+    def match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max, dm_only=True, threshold=0.005,
+                                    object_typetag="halo", output_handler_for_ts2=None, fuzzy_match_kwa={}):
+        if not dm_only:
+            logger.warning(
+                "`match_objects_bidirectional` was called with dm_only=%s, but %s only supports DM-only"
+                " catalogues at the moment. Falling back to DM-only.", dm_only, self.__class__.__name__
+            )
+            dm_only = True
+
+        return super().match_objects_bidirectional(
+            ts1,
+            ts2,
+            halo_min,
+            halo_max,
+            dm_only=dm_only,
+            threshold=threshold,
+            object_typetag=object_typetag,
+            output_handler_for_ts2=output_handler_for_ts2,
+            fuzzy_match_kwa=fuzzy_match_kwa
+        )
+
+    def get_object_membership(self, ts_extension, object_typetag='halo', dm_only=True):
+        # only DM-only catalogues are supported, as for match_objects
+        return super().get_object_membership(ts_extension, object_typetag, dm_only=True)
+
 
 class AHFInputHandler(PynbodyInputHandler):
     pynbody_halo_class_name = "AHFCatalogue"
@@ -124,6 +124,11 @@ class Calculation:
             finally:
                 session.close()
 
+    def stored_property_names(self):
+        """Return the list of stored property names this calculation returns directly, or None if the calculation
+        does anything other than retrieve stored properties (with default extraction)"""
+        return None
+
     def values_and_description(self, halos):
         """Return the values of this calculation, as well as a PropertyCalculation object describing the
         properties of these values (if possible)"""
@@ -210,11 +215,39 @@ class Calculation:
 
 
 
+    @staticmethod
+    def _rows_of_common_array(x):
+        """If every element of x is a row of the same array, return that array and the row indices; otherwise None.
+
+        This is the case for array properties that were decoded together by the extraction pattern, allowing the
+        final array to be produced without copying each row separately."""
+        base = x[0].base
+        if not isinstance(base, np.ndarray) or base.ndim!=x[0].ndim+1 or not base.flags.c_contiguous:
+            return None
+        base_address = base.__array_interface__['data'][0]
+        row_bytes = base.strides[0]
+        indices = np.empty(len(x), dtype=np.intp)
+        for i, row in enumerate(x):
+            if not isinstance(row, np.ndarray) or row.base is not base:
+                return None
+            offset = row.__array_interface__['data'][0] - base_address
+            if row_bytes==0 or offset%row_bytes!=0:
+                return None
+            indices[i] = offset//row_bytes
+        return base, indices
+
     @staticmethod
     def _make_numpy_array(x):
         if len(x)==0:
             return x
         if isinstance(x[0], np.ndarray):
+            rows = Calculation._rows_of_common_array(x)
+            if rows is not None:
+                base, indices = rows
+                if len(indices)==len(base) and np.all(indices==np.arange(len(base))):
+                    return base
+                else:
+                    return base[indices]
             try:
                 return np.array(list(x), dtype=x[0].dtype)
             except ValueError:
@@ -345,6 +378,15 @@ class MultiCalculation(Calculation):
     def n_columns(self):
         return sum(c.n_columns() for c in self.calculations)
 
+    def stored_property_names(self):
+        names = []
+        for c in self.calculations:
+            c_names = c.stored_property_names()
+            if c_names is None:
+                return None
+            names += c_names
+        return names
+
 
 class FixedInput(Calculation):
     """Represents a calculation that returns a fixed value"""
@@ -702,6 +744,11 @@ class StoredProperty(Calculation):
     def retrieves(self):
         return {self._name}
 
+    def stored_property_names(self):
+        if self._multivalued or type(self._extraction_pattern) is not extraction_patterns.HaloPropertyValueGetter:
+            return None
+        return [self._name]
+
     def set_multivalued(self, multivalued=True):
         """Set multivalued flag; if True, returns all matches for the property, in a list.
 
@@ -711,13 +758,16 @@ class StoredProperty(Calculation):
     def values(self, halos):
         self._name_id = tangos.core.dictionary.get_dict_id(self._name, default=None)
         ret = np.empty((1,len(halos)),dtype=object)
-        if self._name_id is not None:
+        if self._name_id is None:
+            return ret
+        if self._multivalued:
             for i, h in enumerate(halos):
                 if self._extraction_pattern.cache_contains(h, self._name_id):
-                    if self._multivalued:
-                        ret[0,i]=self._extraction_pattern.get_from_cache(h, self._name_id)
-                    else:
-                        ret[0, i] = self._extraction_pattern.get_from_cache(h, self._name_id)[0]
+                    ret[0,i]=self._extraction_pattern.get_from_cache(h, self._name_id)
+        else:
+            # processed as a batch, so that arrays of equal shape can be decoded together (see _make_numpy_array)
+            for i, value in enumerate(self._extraction_pattern.get_first_from_cache_for_halos(halos, self._name_id)):
+                ret[0,i] = value
         return ret
 
     def values_and_description(self, halos):
@@ -0,0 +1,207 @@
+"""An optional in-process cache of scalar halo properties, stored as numpy columns per timestep.
+
+When config.enable_columnar_property_cache is True, TimeStep.calculate_all serves requests consisting only of
+stored scalar properties from this cache. Each column, keyed by (timestep_id, name_id), is populated by a single
+aggregated query and then re-used by subsequent calls (e.g. repeated calls from a notebook or the web server).
+
+The cache is invalidated whenever a session in this process commits a change to halos, properties or links. Changes
+made by other processes are detected by the largest id and number of rows of the halo, property and creator tables,
+so adding or deleting rows (e.g. tangos write, or tangos remove-runs) invalidates the cache. Rows updated in place by
+another process, without any being added or removed, are not detected; the cache therefore assumes that other
+processes only add to and delete from the database. If that is not the case, call invalidate() after such changes.
+"""
+
+import threading
+
+import numpy as np
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import func
+
+from .. import core
+
+
+class _PropertyColumn:
+    """The values of a single property across all halos in a timestep.
+
+    halo_ids is sorted; values[i] and first_property_ids[i] belong to halo_ids[i]"""
+    def __init__(self, halo_ids, values, first_property_ids):
+        self.halo_ids = halo_ids
+        self.values = values
+        self.first_property_ids = first_property_ids
+
+    def lookup(self, halo_ids):
+        """Return (found, values, first_property_ids) for the given halo ids"""
+        if len(self.halo_ids)==0:
+            return np.zeros(len(halo_ids), dtype=bool), self.values, self.first_property_ids
+        positions = np.searchsorted(self.halo_ids, halo_ids)
+        positions[positions==len(self.halo_ids)] = 0
+        found = self.halo_ids[positions] == halo_ids
+        return found, self.values[positions], self.first_property_ids[positions]
+
+
+class ColumnarPropertyCache:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._generation = None
+        self.invalidate()
+
+    def invalidate(self):
+        """Discard all cached data"""
+        with self._lock:
+            self._halo_index = {}  # timestep_id -> (halo_ids, halo_numbers, typecodes)
+            self._columns = {}     # (timestep_id, name_id) -> _PropertyColumn, or None if not cacheable
+            self._reassembling_names = {}  # (simulation_id, name) -> True if property class defines reassemble
+
+    def _check_generation(self, session):
+        # the row counts, as well as the largest ids, are needed to spot rows deleted by another process (whose ids
+        # may then be re-used)
+        generation = tuple(session.execute(sqlalchemy.select(
+            *(sqlalchemy.select(aggregate(table.id)).scalar_subquery()
+              for table in (core.HaloProperty, core.SimulationObjectBase, core.Creator)
+              for aggregate in (func.max, func.count)))).one())
+        if generation != self._generation:
+            self.invalidate()
+            self._generation = generation
+
+    def _get_halo_index(self, session, timestep_id):
+        if timestep_id not in self._halo_index:
+            rows = session.query(core.SimulationObjectBase.id, core.SimulationObjectBase.halo_number,
+                                 core.SimulationObjectBase.object_typecode).\
+                filter_by(timestep_id=timestep_id).order_by(core.SimulationObjectBase.id).all()
+            if len(rows)>0:
+                halo_ids, halo_numbers, typecodes = (np.asarray(x) for x in zip(*rows))
+            else:
+                halo_ids, halo_numbers, typecodes = (np.zeros(0, dtype=int) for _ in range(3))
+            self._halo_index[timestep_id] = halo_ids, halo_numbers, typecodes
+        return self._halo_index[timestep_id]
+
+    def _get_column(self, session, timestep_id, name_id):
+        key = (timestep_id, name_id)
+        if key not in self._columns:
+            self._columns[key] = self._query_column(session, timestep_id, name_id)
+        return self._columns[key]
+
+    @staticmethod
+    def _query_column(session, timestep_id, name_id):
+        rows = session.query(core.HaloProperty.id, core.HaloProperty.halo_id,
+                             core.HaloProperty.data_float, core.HaloProperty.data_int).\
+            join(core.SimulationObjectBase, core.HaloProperty.halo_id == core.SimulationObjectBase.id).\
+            filter(core.SimulationObjectBase.timestep_id == timestep_id, core.HaloProperty.name_id == name_id).\
+            order_by(core.HaloProperty.id).all()
+
+        if len(rows)==0:
+            return _PropertyColumn(np.zeros(0, dtype=int), np.zeros(0), np.zeros(0, dtype=int))
+
+        property_ids, halo_ids, data_float, data_int = zip(*rows)
+
+        # as for the ORM route, only the earliest property stored for each halo is returned
+        halo_ids, first_occurrence = np.unique(np.asarray(halo_ids), return_index=True)
+        data_float = [data_float[i] for i in first_occurrence]
+        data_int = [data_int[i] for i in first_occurrence]
+
+        if all(x is not None for x in data_float):
+            values = np.array(data_float, dtype=float)
+        elif all(x is not None for x in data_int):
+            values = np.array(data_int, dtype=int)
+        else:
+            # arrays, or a mixture of types, which must be returned via the ORM route
+            return None
+
+        return _PropertyColumn(halo_ids, values, np.asarray(property_ids)[first_occurrence])
+
+    def _is_reassembled(self, timestep, name):
+        from .. import properties
+        key = (timestep.simulation_id, name)
+        if key not in self._reassembling_names:
+            providing_class = properties.providing_class(name, timestep.simulation.output_handler_class,
+                                                         silent_fail=True)
+            self._reassembling_names[key] = hasattr(providing_class, 'reassemble')
+        return self._reassembling_names[key]
+
+    def calculate_all(self, timestep, names, object_typecode=None, order_by_halo_number=False):
+        """Return sanitized arrays of the named properties for all objects in the timestep, as for
+        TimeStep.calculate_all, or None if the request cannot be served from the cache."""
+        session = core.Session()
+        try:
+            with self._lock:
+                return self._calculate_all(session, timestep, names, object_typecode, order_by_halo_number)
+        finally:
+            session.close()
+
+    def _calculate_all(self, session, timestep, names, object_typecode, order_by_halo_number):
+        self._check_generation(session)
+
+        name_ids = []
+        for name in names:
+            name_id = core.dictionary.get_dict_id(name, None)
+            if name_id is None or self._is_reassembled(timestep, name):
+                return None
+            name_ids.append(name_id)
+
+        columns = [self._get_column(session, timestep.id, name_id) for name_id in name_ids]
+        if any(c is None for c in columns):
+            return None
+
+        halo_ids, halo_numbers, typecodes = self._get_halo_index(session, timestep.id)
+        if object_typecode is not None:
+            select = typecodes == object_typecode
+            halo_ids, halo_numbers = halo_ids[select], halo_numbers[select]
+
+        present = np.ones(len(halo_ids), dtype=bool)
+        first_property_id = np.full(len(halo_ids), np.iinfo(np.int64).max, dtype=np.int64)
+        values = []
+        for c in columns:
+            found, column_values, column_property_ids = c.lookup(halo_ids)
+            present &= found
+            first_property_id = np.minimum(first_property_id, column_property_ids)
+            values.append(column_values)
+
+        if not present.any():
+            return [np.empty(0, dtype=object) for _ in columns]
+
+        # Reproduce the ordering generated by the joined query in the ORM route, i.e. by halo number (if requested)
+        # then by the earliest property row retrieved for each halo
+        first_property_id = first_property_id[present]
+        if order_by_halo_number:
+            ordering = np.lexsort((first_property_id, halo_numbers[present]))
+        else:
+            ordering = np.argsort(first_property_id)
+
+        return [v[present][ordering] for v in values]
+
+
+_cache = ColumnarPropertyCache()
+
+def get_cache():
+    """Return the process-wide columnar property cache"""
+    return _cache
+
+def invalidate():
+    """Discard all data in the process-wide columnar property cache"""
+    _cache.invalidate()
+
+
+_writes_pending_key = 'tangos_columnar_cache_writes_pending'
+
+def _after_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (core.HaloProperty, core.HaloLink, core.SimulationObjectBase, core.Creator)):
+            session.info[_writes_pending_key] = True
+            return
+
+def _do_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[_writes_pending_key] = True
+
+def _after_commit(session):
+    if session.info.pop(_writes_pending_key, False):
+        invalidate()
+
+def _after_rollback(session):
+    session.info.pop(_writes_pending_key, None)
+
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_flush', _after_flush)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'do_orm_execute', _do_orm_execute)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit', _after_commit)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_rollback', _after_rollback)
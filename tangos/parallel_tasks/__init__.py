@@ -10,6 +10,7 @@ _backend_name = config.default_backend
 _num_procs = None # only for multiprocessing backend
 
 _on_exit = [] # list of functions to call when parallelism is shutting down
+_on_server_flush = [] # list of functions to call when the server must commit work held for other processes
 
 from .. import log
 from . import accumulative_statistics, jobs, message
@@ -84,13 +85,21 @@ def launch(function, args=None, backend_kwargs=None):
 
     return result
 
-def distributed(items, allow_resume=False, resumption_id=None):
+def distributed(items, allow_resume=False, resumption_id=None, costs=None, adaptive_chunks=False):
     """Return an iterator that consumes the items, distributed across all processors
     (i.e. each item is consumed by only one processor, in a dynamic way).
 
     Optionally, if allow_resume is True, then the iterator will resume from the last point it reached
     provided argv and the stack trace are unchanged. If resumption_id is not None, then
-    the stack trace is ignored and only resumption_id needs to match."""
+    the stack trace is ignored and only resumption_id needs to match.
+
+    If costs is not None, it must be a sequence giving an estimate of the relative cost of processing
+    each item. The most expensive items are then handed out first, so that they do not hold up the end
+    of the iteration. The estimates must be the same on all processors.
+
+    If adaptive_chunks is True, several items may be handed to a processor at once, with the number chosen
+    from the measured time per item. This reduces the communication overhead when there are many cheap items,
+    at the expense of only recording completion (for allow_resume) once a whole chunk is done."""
 
     if type(items) == set:
         items = list(items)
@@ -99,7 +108,7 @@ def distributed(items, allow_resume=False, resumption_id=None):
         return items
     else:
         from . import jobs
-        return jobs.distributed_iterate(items, allow_resume, resumption_id)
+        return jobs.distributed_iterate(items, allow_resume, resumption_id, costs, adaptive_chunks)
 
 def synchronized(items, allow_resume=False, resumption_id=None):
     """Return an iterator that consumes all items on all processors.
@@ -152,10 +161,24 @@ def _server_thread():
         else:
             obj.process()
 
+    _flush_server()
+    lock.report_lock_wait_statistics()
+
 def on_exit_parallelism(function):
     global _on_exit
     _on_exit.append(function)
 
+def on_server_flush(function):
+    """Register a function that the server calls to commit any work it is holding on behalf of other processes.
+
+    The function is called before a job in a synchronized loop is recorded as complete (so that resuming cannot skip
+    work that was never committed), and before the server exits while the database is still open."""
+    _on_server_flush.append(function)
+
+def _flush_server():
+    for fn in _on_server_flush:
+        fn()
+
 def _shutdown_parallelism():
     global backend, _on_exit
     log.logger.debug("Clearing up process")
@@ -37,6 +37,21 @@ def receive_numpy_array(source):
     comm.Recv(ar,source=source,tag=2)
     return ar
 
+_group_communicators = {}
+
+def broadcast(data, root, destinations):
+    """Send data from the root process to each of the destination processes, all of which must call broadcast with
+    the same root and destinations. Returns the data on all processes.
+
+    The other processes (in particular the server) need not take part, since the broadcast takes place within a
+    communicator created for just the root and destinations."""
+    ranks = tuple(sorted(set(destinations) | {root}))
+    if ranks not in _group_communicators:
+        group = comm.Get_group().Incl(ranks)
+        _group_communicators[ranks] = comm.Create_group(group)
+        group.Free()
+    return _group_communicators[ranks].bcast(data, root=ranks.index(root))
+
 def rank():
     return comm.Get_rank()
 
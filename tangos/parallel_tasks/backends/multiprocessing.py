@@ -1,21 +1,35 @@
 """An implementation of a multiprocessing backend for parallel tasks in Tangos.
 
-This implements an MPI-like interface using a 'manager' process which relays messages between worker processes.
-Messages are thus sent and received using a star-like topology, but this should be transparent to the user.
+This implements an MPI-like interface. Each process listens on a unix domain socket, created by the 'manager' process
+before the others are forked; a process sending a message connects directly to the socket of the destination on first
+use. The manager process only receives control messages (completion, errors and logs) from the other processes.
+
+Messages are pickled with protocol 5. Any large buffers (typically the contents of numpy arrays), and any pickled
+message that is itself large, are sent out-of-band through shared memory segments, so that only a small description
+of them needs to pass through the sockets. The receiving process unpickles directly from the segments, without
+copying them.
 """
 
+import io
 import multiprocessing
+import multiprocessing.connection
 import multiprocessing.resource_tracker
 import os
 import pickle
 import select
+import shutil
 import signal
+import socket
 import struct
 import sys
+import tempfile
 import threading
 import time
+import weakref
+from multiprocessing import shared_memory
 from typing import Optional
 
+import numpy as np
 import tblib.pickling_support
 
 from ...log import logger
@@ -26,6 +40,10 @@ _size = None
 _pipe = None
 _recv_lock = None
 _recv_buffer = []
+_socket_folder = None
+_listener = None
+_outgoing_connections = {}
+_incoming_connections = []
 
 _print_exceptions = True
 
@@ -43,11 +61,115 @@ class NoMatchingItem(Exception):
     pass
 
 
+OUT_OF_BAND_THRESHOLD_BYTES = 65536 # buffers at least this large are sent through shared memory
+
+class _Pickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # numpy sends the data of plain arrays out-of-band with protocol 5, but not that of subclasses which override
+        # __reduce__ (such as pynbody's SimArray). Send those as a plain view, plus an empty template from which
+        # the subclass and its attributes can be restored.
+        if isinstance(obj, np.ndarray) and type(obj) is not np.ndarray and obj.ndim > 0 \
+                and obj.nbytes >= OUT_OF_BAND_THRESHOLD_BYTES and (obj.flags.c_contiguous or obj.flags.f_contiguous):
+            return _rebuild_array_subclass, (obj.view(np.ndarray), obj[:0])
+        return NotImplemented
+
+def _rebuild_array_subclass(array, template):
+    result = array.view(type(template))
+    for cls in type(template).__mro__:
+        slots = getattr(cls, '__slots__', ())
+        for name in ((slots,) if isinstance(slots, str) else slots):
+            if name not in ('__dict__', '__weakref__') and hasattr(template, name):
+                setattr(result, name, getattr(template, name))
+    if hasattr(template, '__dict__'):
+        result.__dict__.update(template.__dict__)
+    return result
+
+class _SharedMemoryPayload:
+    """A pickled message, the large buffers of which are held in shared memory segments"""
+
+    def __init__(self, pickled, buffers):
+        if len(pickled) >= OUT_OF_BAND_THRESHOLD_BYTES:
+            buffers = [pickle.PickleBuffer(pickled)] + list(buffers)
+            self._pickled = None
+        else:
+            self._pickled = pickled
+        self._segments = []
+        for buffer in buffers:
+            raw = buffer.raw()
+            segment = shared_memory.SharedMemory(create=True, size=max(raw.nbytes, 1))
+            segment.buf[:raw.nbytes] = raw
+            self._segments.append((segment.name, raw.nbytes))
+            segment.close()
+
+    def load(self):
+        """Unpickle the message without copying the buffers, which stay in shared memory for as long as any object
+        unpickled from them is alive"""
+        _close_released_segments()
+        buffers = []
+        for name, nbytes in self._segments:
+            segment = shared_memory.SharedMemory(name=name)
+            # the name is no longer needed; the memory itself is released once the segment is also closed
+            segment.unlink()
+            buffer = np.frombuffer(segment.buf, dtype=np.uint8, count=nbytes)
+            # objects unpickled from the buffer keep a reference to it. The segment cannot be closed until the buffer
+            # itself has been deleted, so it is closed on the next call instead (see _close_released_segments)
+            weakref.finalize(buffer, _released_segments.append, segment)
+            buffers.append(buffer)
+        pickled = buffers.pop(0) if self._pickled is None else self._pickled
+        return pickle.loads(pickled, buffers=buffers)
+
+_released_segments = []
+
+def _close_released_segments():
+    while len(_released_segments) > 0:
+        _released_segments.pop().close()
+
+def _dumps(data):
+    out_of_band = []
+    def buffer_callback(buffer):
+        if buffer.raw().nbytes < OUT_OF_BAND_THRESHOLD_BYTES:
+            return True # pickle in-band
+        out_of_band.append(buffer)
+        return False
+
+    stream = io.BytesIO()
+    _Pickler(stream, protocol=5, buffer_callback=buffer_callback).dump(data)
+    if len(out_of_band) == 0 and stream.tell() < OUT_OF_BAND_THRESHOLD_BYTES:
+        return stream.getvalue()
+    else:
+        return pickle.dumps(_SharedMemoryPayload(stream.getvalue(), out_of_band), protocol=5)
+
+def _loads(payload):
+    data = pickle.loads(payload)
+    if isinstance(data, _SharedMemoryPayload):
+        data = data.load()
+    return data
+
+
+def _socket_path(socket_folder, rank):
+    return os.path.join(socket_folder, "%d" % rank)
+
+def _listen(socket_folder, rank):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(_socket_path(socket_folder, rank))
+    listener.listen()
+    return listener
+
+def _connection_to(destination):
+    if destination not in _outgoing_connections:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(_socket_path(_socket_folder, destination))
+        _outgoing_connections[destination] = multiprocessing.connection.Connection(sock.detach())
+    return _outgoing_connections[destination]
+
 def send(data, destination, tag=0):
     with send_lock:
-        payload = pickle.dumps(data)
-        header = struct.pack("ii", destination, tag)
-        _pipe.send_bytes(header+payload)
+        payload = _dumps(data)
+        if destination == -1:
+            # special message for the manager process
+            _pipe.send_bytes(struct.pack("ii", destination, tag) + payload)
+        else:
+            _connection_to(destination).send_bytes(struct.pack("ii", _rank, tag) + payload)
 
 def receive_any(source=None):
     return receive(source,None,True)
@@ -67,6 +189,10 @@ def receive(source=None, tag=0, return_tag=False):
 
 
 NUMPY_SPECIAL_TAG = 1515
+BROADCAST_SPECIAL_TAG = 1516
+
+# messages with these tags are only ever received by explicitly asking for the tag, never by receive_any
+_SPECIAL_TAGS = (NUMPY_SPECIAL_TAG, BROADCAST_SPECIAL_TAG)
 
 def send_numpy_array(data, destination):
     send(data,destination,tag=NUMPY_SPECIAL_TAG)
@@ -74,9 +200,49 @@ def send_numpy_array(data, destination):
 def receive_numpy_array(source):
     return receive(source,tag=NUMPY_SPECIAL_TAG)
 
+def broadcast(data, root, destinations):
+    """Send data from the root process to each of the destination processes, all of which must call broadcast with
+    the same root and destinations. Returns the data on all processes.
+
+    The data are pickled only once. If large, the pickle is placed in a single shared memory segment that all
+    destinations read from, which the root removes once every destination has acknowledged reading it."""
+    if _rank == root:
+        payload = pickle.dumps(data, protocol=5)
+        if len(payload) < OUT_OF_BAND_THRESHOLD_BYTES:
+            for destination in destinations:
+                send(payload, destination, tag=BROADCAST_SPECIAL_TAG)
+            return data
+
+        segment = shared_memory.SharedMemory(create=True, size=len(payload))
+        try:
+            segment.buf[:len(payload)] = payload
+            for destination in destinations:
+                send((segment.name, len(payload)), destination, tag=BROADCAST_SPECIAL_TAG)
+            for destination in destinations:
+                receive(destination, tag=BROADCAST_SPECIAL_TAG)
+        finally:
+            segment.close()
+            segment.unlink()
+        return data
+    else:
+        received = receive(root, tag=BROADCAST_SPECIAL_TAG)
+        if isinstance(received, bytes):
+            return pickle.loads(received)
+
+        name, nbytes = received
+        segment = shared_memory.SharedMemory(name=name)
+        try:
+            with segment.buf[:nbytes] as view:
+                data = pickle.loads(view)
+        finally:
+            segment.close()
+        send(None, root, tag=BROADCAST_SPECIAL_TAG) # acknowledge, so that the root can remove the segment
+        return data
+
 def _pop_first_match_from_reception_buffer(source, tag):
     for item in _recv_buffer:
-        if ((item[2] == tag or tag is None) and (item[1] == source or source is None)):
+        if ((item[2] == tag or (tag is None and item[2] not in _SPECIAL_TAGS))
+                and (item[1] == source or source is None)):
             # consume item
             _recv_buffer.remove(item)
             return item
@@ -86,10 +252,24 @@ def _pop_first_match_from_reception_buffer(source, tag):
 def _receive_item_into_buffer():
     if _recv_lock.acquire(False):
         try:
-            message = _pipe.recv_bytes()
-            source, tag = struct.unpack("ii", message[:8])
-            payload = pickle.loads(message[8:])
-            _recv_buffer.append((payload, source, tag))
+            received = False
+            while not received:
+                for connection in multiprocessing.connection.wait([_listener] + _incoming_connections):
+                    if connection is _listener:
+                        sock, _ = _listener.accept()
+                        _incoming_connections.append(multiprocessing.connection.Connection(sock.detach()))
+                        continue
+                    try:
+                        message = connection.recv_bytes()
+                    except EOFError:
+                        # the sending process has finished
+                        _incoming_connections.remove(connection)
+                        connection.close()
+                        continue
+                    source, tag = struct.unpack("ii", message[:8])
+                    payload = _loads(message[8:])
+                    _recv_buffer.append((payload, source, tag))
+                    received = True
         finally:
             _recv_lock.release()
     else:
@@ -111,14 +291,19 @@ def barrier():
 def finalize():
     pass
 
-def launch_wrapper(target_fn, rank_in, size_in, pipe_in, args_in, capture_log):
+def launch_wrapper(target_fn, rank_in, size_in, pipe_in, socket_folder, listeners, args_in, capture_log):
     tblib.pickling_support.install()
 
-    global _slave, _rank, _size, _pipe, _recv_lock
+    global _slave, _rank, _size, _pipe, _recv_lock, _socket_folder, _listener
     _rank = rank_in
     _size = size_in
     _pipe = pipe_in
     _recv_lock = threading.Lock()
+    _socket_folder = socket_folder
+    _listener = listeners[rank_in]
+    for rank, listener in enumerate(listeners):
+        if rank != rank_in:
+            listener.close()
 
     result = None
 
@@ -148,7 +333,9 @@ def launch_wrapper(target_fn, rank_in, size_in, pipe_in, args_in, capture_log):
             send(("log", result), -1, -1)
         send(("error", exc_value, exc_traceback), -1, -1)
 
-
+    for connection in list(_outgoing_connections.values()) + _incoming_connections:
+        connection.close()
+    _listener.close()
     _pipe.close()
 
 class RemoteException(Exception):
@@ -168,13 +355,22 @@ def launch_functions(functions, args, capture_log=False):
 
 
     child_connections, parent_connections = list(zip(*[mp_context.Pipe() for rank in range(num_procs)]))
-    processes = [mp_context.Process(target=launch_wrapper, args=(function, rank, num_procs, pipe, args_i, capture_log))
+
+    # the sockets are created before forking, so that any process can connect to any other as soon as it starts
+    socket_folder = tempfile.mkdtemp(prefix="tangos-")
+    listeners = [_listen(socket_folder, rank) for rank in range(num_procs)]
+
+    processes = [mp_context.Process(target=launch_wrapper, args=(function, rank, num_procs, pipe, socket_folder,
+                                                                 listeners, args_i, capture_log))
                  for rank, (pipe, function, args_i) in
                  enumerate(zip(child_connections, functions, args))]
 
     for proc_i in processes:
         proc_i.start()
 
+    for listener in listeners:
+        listener.close()
+
     running = [True for rank in range(num_procs)]
     error: Optional[Exception] = None
 
@@ -189,7 +385,7 @@ def launch_functions(functions, args, capture_log=False):
                 destination, tag = struct.unpack("ii", message[:8])
                 if destination == -1:
                     # special message, not for a specific process
-                    message = pickle.loads(message[8:])
+                    message = _loads(message[8:])
                     if message=='exit':
                         running[source]=False
                     elif isinstance(message[0], str) and message[0]=='error':
@@ -199,10 +395,6 @@ def launch_functions(functions, args, capture_log=False):
                         break
                     elif isinstance(message[0], str) and message[0]=='log':
                         log+=message[1]
-                else:
-                    new_header = struct.pack("ii", source, tag)
-                    payload = message[8:]
-                    parent_connections[destination].send_bytes(new_header + payload)
 
     for pipe_i in parent_connections:
         pipe_i.close()
@@ -216,6 +408,8 @@ def launch_functions(functions, args, capture_log=False):
             os.kill(proc_i.pid, signal.SIGKILL)
             proc_i.join()
 
+    shutil.rmtree(socket_folder, ignore_errors=True)
+
     if error is not None:
         raise error.with_traceback(traceback)
 
@@ -4,10 +4,13 @@ import pathlib
 import pickle
 import shlex
 import sys
+import time
 import traceback
 import zlib
 
-from .. import log
+import numpy as np
+
+from .. import config, log
 from . import message
 
 
@@ -18,31 +21,72 @@ class InconsistentContext(RuntimeError):
     pass
 
 class IterationState:
-    _this_run_iteration_states = {}
+    """Tracks which jobs in a parallel loop have been completed, and which rank is running each of the others.
+
+    So that loops can be resumed, the completion state is persisted in a folder in the user's home directory (see
+    _resume_state_folder_path). Each run writes a snapshot of all its loops to a .pickle file, and then appends
+    records of completed jobs to a .log file alongside it. The log is compacted into a new snapshot once it holds
+    more records than there are jobs, so that the bytes written stay proportional to the number of jobs completed.
+    """
+
+    _this_run_iteration_states = {} # context -> IterationState, for all loops that have stored state in this run
+    _this_run_log_numbers = {} # context -> number identifying it in the log file
+    _log_records_since_compaction = 0
+
     def __init__(self, context, jobs_complete, /, backend_size=None):
         from . import backend
         self._context = context
         self._jobs_complete = jobs_complete
         self._rank_running_job = {i: None for i in range(1,backend_size or backend.size())}
+        self._num_ranks = len(self._rank_running_job)
+        self._job_order = range(len(jobs_complete))
+        self._next_job_position = 0 # all jobs before this position in _job_order are complete or running
+        self._adaptive_chunks = False
+        self._rank_assignment_time = {}
+        self._seconds_per_job = None
+
+    def set_job_order(self, job_order):
+        """Hand out jobs in the specified order, rather than in order of their index"""
+        assert sorted(job_order) == list(range(len(self._jobs_complete)))
+        self._job_order = job_order
+
+    def set_adaptive_chunks(self, adaptive_chunks):
+        """If True, next_jobs hands out several jobs at a time, with the number chosen from the measured job time"""
+        self._adaptive_chunks = adaptive_chunks
+
+    @staticmethod
+    def job_order_from_costs(costs):
+        """Return a job order that hands out the most expensive jobs first, given an estimated cost for each job.
+
+        Because jobs are handed out dynamically as ranks become free, this is a longest-processing-time-first
+        schedule, which avoids the most expensive jobs being left until the end of the iteration."""
+        return [int(i) for i in np.argsort(-np.asarray(costs, dtype=float), kind='stable')]
 
     def __len__(self):
         return len(self._jobs_complete)
 
     def to_string(self):
+        return self._encode_jobs_complete(self._jobs_complete)
+
+    @classmethod
+    def from_string(cls, string, context=None, backend_size=None):
+        return cls(context, cls._decode_jobs_complete(string), backend_size=backend_size)
+
+    @staticmethod
+    def _encode_jobs_complete(jobs_complete):
         return base64.a85encode(
             zlib.compress(
-                pickle.dumps(self._jobs_complete)
+                pickle.dumps(jobs_complete)
             )
         ).decode('ascii')
 
-    @classmethod
-    def from_string(cls, string, context=None, backend_size=None):
-        jobs_complete = pickle.loads(
+    @staticmethod
+    def _decode_jobs_complete(string):
+        return pickle.loads(
             zlib.decompress(
                 base64.a85decode(string.encode('ascii'))
             )
         )
-        return cls(context, jobs_complete, backend_size=backend_size)
 
     @classmethod
     def from_context(cls, num_jobs, argv=None, stack_hash=None, allow_resume=None, backend_size=None):
@@ -50,7 +94,7 @@ class IterationState:
         if allow_resume:
             cmap = cls._get_stored_completion_map_from_context(context)
             if cmap is not None:
-                r = cls.from_string(cmap, context)
+                r = cls.from_string(cmap, context, backend_size=backend_size)
                 log.logger.info(
                     f"Resuming from previous run. {r.count_complete()} of {len(r)} jobs are already complete.")
                 log.logger.info(
@@ -93,8 +137,42 @@ class IterationState:
                 except (OSError, EOFError):
                     log.logger.warn(f"Error reading resume state from {str(filename):s}. Skipped.")
                     pass
+                cls._apply_completion_log(filename.with_suffix(".log"), maps)
 
         return maps
+
+    @classmethod
+    def _apply_completion_log(cls, log_path, maps):
+        """Update the completion maps with the jobs recorded in an append-only log file"""
+        if not log_path.exists():
+            return
+
+        contexts = {}
+        completed = {}
+        with log_path.open('rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError):
+                    # most likely the final record was only partly written when the run ended
+                    log.logger.warn(f"Error reading resume log {str(log_path):s}. Remaining records skipped.")
+                    break
+                kind, number, contents = record
+                if kind == 'context':
+                    contexts[number] = contents
+                else:
+                    completed.setdefault(contexts[number], []).extend(contents)
+
+        for context, jobs in completed.items():
+            if context in maps:
+                jobs_complete = cls._decode_jobs_complete(maps[context])
+            else:
+                jobs_complete = [False] * context[2]
+            for job in jobs:
+                jobs_complete[job] = True
+            maps[context] = cls._encode_jobs_complete(jobs_complete)
     @classmethod
     def _get_stored_completion_map_from_context(cls, context):
         maps = cls._get_stored_completion_maps()
@@ -106,26 +184,102 @@ class IterationState:
             f.unlink()
 
     def _store_completion_map(self):
-        self._this_run_iteration_states[self._context] = self.to_string()
-        with open(self._resume_state_path(), "wb") as f:
-            pickle.dump(self._this_run_iteration_states, f)
+        """Write a snapshot of the state of all loops in this run, replacing any log of completions"""
+        states = IterationState._this_run_iteration_states
+        states[self._context] = self
+        path = self._resume_state_path()
+        temporary_path = path.with_suffix(".pickle.tmp")
+        with open(temporary_path, "wb") as f:
+            pickle.dump({context: state.to_string() for context, state in states.items()}, f)
+        temporary_path.replace(path)
+
+        path.with_suffix(".log").unlink(missing_ok=True)
+        IterationState._this_run_log_numbers = {}
+        IterationState._log_records_since_compaction = 0
+
+    def _log_completion(self, jobs):
+        """Record that the jobs are complete, by appending to the log or, if it is due for compaction, by
+        writing a new snapshot"""
+        states = IterationState._this_run_iteration_states
+        if states.get(self._context, None) is not self or \
+                IterationState._log_records_since_compaction >= sum(len(s) for s in states.values()):
+            self._store_completion_map()
+            return
+
+        numbers = IterationState._this_run_log_numbers
+        with open(self._resume_state_path().with_suffix(".log"), "ab") as f:
+            if self._context not in numbers:
+                numbers[self._context] = len(numbers)
+                pickle.dump(('context', numbers[self._context], self._context), f)
+            pickle.dump(('complete', numbers[self._context], jobs), f)
+        IterationState._log_records_since_compaction += 1
 
     def mark_complete(self, job):
         if job is None:
             return
         self._jobs_complete[job] = True
-        self._store_completion_map()
+        self._log_completion([job])
+
+    def _mark_chunk_complete(self, jobs):
+        if jobs is None:
+            return
+        for job in jobs:
+            self._jobs_complete[job] = True
+        self._log_completion(jobs)
 
     def next_job(self, for_rank):
+        """Mark any jobs previously handed to the rank as complete, and return the next job for it (or None)"""
+        jobs = self._assign_jobs(for_rank, 1)
+        return None if jobs is None else jobs[0]
+
+    def next_jobs(self, for_rank, current_time=None):
+        """Mark any jobs previously handed to the rank as complete, and return a list of jobs for it (or None).
+
+        Unless adaptive chunks are enabled, the list has a single entry. Otherwise, in the style of guided
+        scheduling, the list is longer when many jobs remain, but limited so that it is expected to take no longer
+        than config.job_chunk_maximum_seconds given the time per job measured so far."""
+        if current_time is None:
+            current_time = time.time()
+        self._update_seconds_per_job(for_rank, current_time)
+        jobs = self._assign_jobs(for_rank, self._chunk_size())
+        self._rank_assignment_time[for_rank] = current_time
+        return jobs
+
+    def _assign_jobs(self, for_rank, max_jobs):
         if for_rank in self._rank_running_job:
-            self.mark_complete(self._rank_running_job[for_rank])
+            self._mark_chunk_complete(self._rank_running_job[for_rank])
             del self._rank_running_job[for_rank]
 
-        for i in range(len(self._jobs_complete)):
-            if not self._jobs_complete[i] and i not in self._rank_running_job.values():
-                self._rank_running_job[for_rank] = i
-                return i
-        return None
+        jobs = []
+        while len(jobs) < max_jobs and self._next_job_position < len(self._job_order):
+            i = self._job_order[self._next_job_position]
+            self._next_job_position += 1
+            if not self._jobs_complete[i]:
+                jobs.append(i)
+
+        if len(jobs) == 0:
+            return None
+        self._rank_running_job[for_rank] = jobs
+        return jobs
+
+    def _update_seconds_per_job(self, for_rank, current_time):
+        running = self._rank_running_job.get(for_rank, None)
+        if running is None or for_rank not in self._rank_assignment_time:
+            return
+        seconds_per_job = (current_time - self._rank_assignment_time[for_rank]) / len(running)
+        if self._seconds_per_job is None:
+            self._seconds_per_job = seconds_per_job
+        else:
+            self._seconds_per_job = 0.5 * (self._seconds_per_job + seconds_per_job)
+
+    def _chunk_size(self):
+        if not self._adaptive_chunks or self._seconds_per_job is None:
+            return 1
+        remaining = len(self._job_order) - self._next_job_position
+        guided = remaining // (2 * max(self._num_ranks, 1))
+        if self._seconds_per_job > 0:
+            guided = min(guided, int(config.job_chunk_maximum_seconds / self._seconds_per_job))
+        return max(guided, 1)
 
     def finished(self):
         # not enough for all jobs to be complete, must also have notified all ranks (this matters
@@ -154,6 +308,18 @@ class SynchronizedIterationState(IterationState):
                 return True
         return False
 
+    def next_jobs(self, for_rank, current_time=None):
+        job = self.next_job(for_rank)
+        return None if job is None else [job]
+
+    def mark_complete(self, job):
+        if job is not None:
+            # every rank has now finished the job, so anything the server holds for it must be committed before
+            # it is recorded as complete
+            from . import _flush_server
+            _flush_server()
+        super().mark_complete(job)
+
     def next_job(self, for_rank):
         previous_job = self._rank_running_job[for_rank]
         my_next_job = self._first_incomplete_job_after(previous_job)
@@ -177,7 +343,7 @@ _iteration_states = {}
 class MessageStartIteration(message.BarrierMessageWithResponse):
     def process_global(self):
         global _next_iteration_state_id, _iteration_states
-        req_jobs, req_hash, allow_resume, synchronized = self.contents
+        req_jobs, req_hash, allow_resume, synchronized, job_order, adaptive_chunks = self.contents
 
         argv_string = shlex.join(sys.argv)
 
@@ -187,6 +353,9 @@ class MessageStartIteration(message.BarrierMessageWithResponse):
         _iteration_states[my_id] = IteratorClass.from_context(req_jobs, argv=argv_string,
                                                               stack_hash=req_hash,
                                                               allow_resume=allow_resume)
+        if job_order is not None:
+            _iteration_states[my_id].set_job_order(job_order)
+        _iteration_states[my_id].set_adaptive_chunks(adaptive_chunks)
         _next_iteration_state_id += 1
 
         self.respond(my_id)
@@ -218,40 +387,51 @@ class MessageRequestJob(message.MessageWithResponse):
 
         assert current_iteration_state is not None # should not be requesting jobs if we are not in a loop
 
-        job = current_iteration_state.next_job(source)
+        jobs = current_iteration_state.next_jobs(source)
 
-        if job is not None:
-            log.logger.debug("Send job %d of %d to node %d", job, len(current_iteration_state), source)
+        if jobs is not None:
+            log.logger.debug("Send %d job(s) starting with %d of %d to node %d", len(jobs), jobs[0],
+                             len(current_iteration_state), source)
         else:
             log.logger.debug("Finished jobs; notify node %d", source)
 
         if current_iteration_state.finished():
             del _iteration_states[iterator_id]
 
-        self.respond(job)
+        self.respond(jobs)
 
-def distributed_iterate(task_list, allow_resume=False, resumption_id=None):
+def distributed_iterate(task_list, allow_resume=False, resumption_id=None, costs=None, adaptive_chunks=False):
     """Sets up an iterator returning items of task_list.
 
     If allow_resume is True, then the iterator will resume from the last point it reached
     provided argv and the stack trace are unchanged. If resumption_id is not None, then
     the stack trace is ignored and only resumption_id needs to match.
+
+    If costs is not None, it gives an estimate of the relative cost of each task, and the most
+    expensive tasks are handed out first.
+
+    If adaptive_chunks is True, the server may hand out several tasks in response to each request,
+    reducing the number of messages needed for large numbers of cheap tasks. The tasks are then marked
+    complete (for the purposes of resuming) only when the whole chunk is finished. See IterationState.next_jobs.
     """
     from . import backend, barrier
 
     resumption_id = resumption_id or _autogenerate_resume_id()
 
     assert backend is not None, "Parallelism is not initialised"
-    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, False)).send_and_get_response(0)
+    job_order = None if costs is None else IterationState.job_order_from_costs(costs)
+    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, False,
+                                          job_order, adaptive_chunks)).send_and_get_response(0)
     barrier()
 
     while True:
-        job = MessageRequestJob(iteration_id).send_and_get_response(0)
-        if job is None:
+        jobs = MessageRequestJob(iteration_id).send_and_get_response(0)
+        if jobs is None:
             barrier()
             return
         else:
-            yield task_list[job]
+            for job in jobs:
+                yield task_list[job]
 
 
 def _autogenerate_resume_id():
@@ -271,16 +451,17 @@ def synchronized_iterate(task_list, allow_resume=False, resumption_id=None):
 
     assert backend is not None, "Parallelism is not initialised"
 
-    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, True)).send_and_get_response(0)
+    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, True,
+                                          None, False)).send_and_get_response(0)
     barrier()
 
     while True:
-        job = MessageRequestJob(iteration_id).send_and_get_response(0)
+        jobs = MessageRequestJob(iteration_id).send_and_get_response(0)
         barrier() # this is crucial to keep things in sync (see comment in SynchronizedIterationState.next_job)
-        if job is None:
+        if jobs is None:
             return
 
-        yield task_list[job]
+        yield task_list[jobs[0]]
 
 
 
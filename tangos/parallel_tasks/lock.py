@@ -1,6 +1,7 @@
+import bisect
 import time
 
-from ..config import DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK
+from ..config import DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK, LOCK_WAIT_HISTOGRAM_BIN_EDGES
 from . import log, message, parallelism_is_active
 
 
@@ -23,11 +24,12 @@ class MessageRequestLock(message.Message):
         log.logger.debug("Received request for lock %r for proc %d, shared=%r", lock_id, self.source, self.shared)
         queue = _get_lock_queue(lock_id)
         queue.append((self.source, self.shared))
+        _lock_request_times[(lock_id, self.source)] = time.time()
         if len(queue) == 1:
             _issue_next_lock(lock_id)
         elif _lock_in_shared_mode(lock_id) and self.shared:
             log.logger.debug("Issue shared lock %r to proc %d", lock_id, self.source)
-            MessageGrantLock((lock_id, False)).send(self.source)
+            _grant_lock(lock_id, self.source, False)
             _increment_lock_num_shared(lock_id,1)
 
 class MessageRelinquishLock(message.Message):
@@ -46,8 +48,41 @@ class MessageGrantLock(message.Message):
     pass
 
 
+class LockWaitHistogram:
+    """Histogram of the time processes spent waiting to be granted a named lock"""
+
+    def __init__(self, bin_edges=LOCK_WAIT_HISTOGRAM_BIN_EDGES):
+        self.bin_edges = list(bin_edges)
+        self.counts = [0] * (len(self.bin_edges) + 1)
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def add(self, wait):
+        self.counts[bisect.bisect_right(self.bin_edges, wait)] += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @property
+    def num_grants(self):
+        return sum(self.counts)
+
+    def _bin_labels(self):
+        edges = ["%gs" % e for e in self.bin_edges]
+        return ["<" + edges[0]] + [a + "-" + b for a, b in zip(edges[:-1], edges[1:])] + [">" + edges[-1]]
+
+    def report_to_log(self, logger, lock_id):
+        if self.num_grants == 0:
+            return
+        logger.info("Lock %r was granted %d times; waited %.1fs in total, %.2fs maximum", lock_id, self.num_grants,
+                    self.total_wait, self.max_wait)
+        logger.info("  Wait times: %s", ", ".join("%s: %d" % (label, count)
+                                                  for label, count in zip(self._bin_labels(), self.counts)))
+
+
 _lock_queues = {}
 _lock_num_sharers = {}
+_lock_request_times = {}
+_lock_wait_histograms = {}
 
 def _get_lock_queue(lock_id):
     lock_queue = _lock_queues.get(lock_id,[])
@@ -66,6 +101,37 @@ def _increment_lock_num_shared(lock_id, increment_by):
 def _lock_in_shared_mode(lock_id):
     return _get_lock_num_sharers(lock_id)>0
 
+def _database_needs_filesystem_delay():
+    """Returns True if the database is held in a file (i.e. SQLite), in which case a process that takes over an
+    exclusive lock must give the filesystem time to settle. Server-based databases such as PostgreSQL and MySQL
+    handle concurrent connections themselves, so no delay is needed."""
+    from .. import core
+    if core._engine is None:
+        return True
+    return core._engine.dialect.name == 'sqlite'
+
+def _add_lock_wait(lock_id, wait):
+    if lock_id not in _lock_wait_histograms:
+        _lock_wait_histograms[lock_id] = LockWaitHistogram()
+    _lock_wait_histograms[lock_id].add(wait)
+
+def _record_lock_wait(lock_id, proc):
+    requested = _lock_request_times.pop((lock_id, proc), None)
+    if requested is not None:
+        _add_lock_wait(lock_id, time.time() - requested)
+
+def _grant_lock(lock_id, proc, impose_filesystem_delay):
+    _record_lock_wait(lock_id, proc)
+    MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
+
+def report_lock_wait_statistics():
+    """Log the histogram of wait times for each named lock since the last report, then clear them.
+
+    Only meaningful on the server process, which is where the locks are administered."""
+    for lock_id in sorted(_lock_wait_histograms):
+        _lock_wait_histograms[lock_id].report_to_log(log.logger, lock_id)
+    _lock_wait_histograms.clear()
+
 def _issue_next_lock(lock_id, impose_filesystem_delay=False):
     queue = _get_lock_queue(lock_id)
     if len(queue)>0:
@@ -75,7 +141,7 @@ def _issue_next_lock(lock_id, impose_filesystem_delay=False):
             _issue_shared_locks(lock_id, impose_filesystem_delay)
         elif proc!=0:
             log.logger.debug("Issue lock %r to proc %d", lock_id, proc)
-            MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
+            _grant_lock(lock_id, proc, impose_filesystem_delay)
         else:
             pass # the server has to handle being at the top of the queue directly
 
@@ -85,7 +151,7 @@ def _issue_shared_locks(lock_id, impose_filesystem_delay=False):
     for proc, shared in queue:
         if shared:
             log.logger.debug("Issue shared lock %r to proc %d",lock_id, proc)
-            MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
+            _grant_lock(lock_id, proc, impose_filesystem_delay)
             sharers_notified += 1
     _increment_lock_num_shared(lock_id,sharers_notified)
     log.logger.debug("Lock %r is currently in shared mode, with %d process(es) sharing it",
@@ -97,7 +163,7 @@ def _release_lock_exclusive(lock_id, proc):
     queue.pop(0)
     log.logger.debug("Finished with lock %r for proc %d", lock_id, proc)
     if len(queue) > 0:
-        _issue_next_lock(lock_id, True)
+        _issue_next_lock(lock_id, _database_needs_filesystem_delay())
 
 def _release_lock_shared(lock_id, proc):
     queue = _get_lock_queue(lock_id)
@@ -111,6 +177,10 @@ def _release_lock_shared(lock_id, proc):
         _issue_next_lock(lock_id)
 
 
+def lock_is_in_use(lock_id):
+    """Returns True if any process holds, or is waiting for, the named lock. Only meaningful on the server process."""
+    return len(_get_lock_queue(lock_id))>0
+
 def _any_locks_alive():
     return any([len(v)>0 for v in _lock_queues.values()])
 
@@ -179,6 +249,7 @@ class ExclusiveLock:
         if len(queue) == 1:
             if self._shared:
                 _increment_lock_num_shared(lock_id, 1)
+            _add_lock_wait(lock_id, time.time()-start)
             log.logger.debug("Server acquired lock %r immediately in %.1fs", self.name, time.time()-start)
             return
 
@@ -192,6 +263,7 @@ class ExclusiveLock:
             # Wait a short time before polling again
             time.sleep(0.001)
             
+        _add_lock_wait(lock_id, time.time()-start)
         log.logger.debug("Server acquired lock %r in %.1fs", self.name, time.time()-start)
 
     def _release_on_server(self):
@@ -97,9 +97,9 @@ class Message(metaclass=MessageMetaClass):
 
         if reception_timing_monitor is not None:
             with reception_timing_monitor(cls):
-                msg, source, tag = backend.receive_any(source=None)
+                msg, source, tag = backend.receive_any(source=source)
         else:
-            msg, source, tag = backend.receive_any(source=None)
+            msg, source, tag = backend.receive_any(source=source)
 
         obj = Message.interpret_and_deserialize(tag, source, msg)
 
@@ -110,6 +110,32 @@ class Message(metaclass=MessageMetaClass):
                 raise RuntimeError("Unexpected message of type %r received"%type(obj))
         return obj
 
+    def broadcast(self, destinations):
+        """Send this message to all the destination processes, each of which must call receive_broadcast.
+
+        Where the backend supports it, the message is serialised only once and distributed efficiently; otherwise
+        it is sent to each destination in turn."""
+        from . import backend
+        if hasattr(backend, 'broadcast'):
+            backend.broadcast((self._tag, self.serialize()), backend.rank(), destinations)
+        else:
+            for destination in destinations:
+                self.send(destination)
+
+    @classmethod
+    def receive_broadcast(cls, source, destinations):
+        """Receive a message sent with broadcast from the source process to the destinations (which must include
+        this process)"""
+        from . import backend
+        if not hasattr(backend, 'broadcast'):
+            return cls.receive(source)
+
+        tag, msg = backend.broadcast(None, source, destinations)
+        obj = Message.interpret_and_deserialize(tag, source, msg)
+        if not isinstance(obj, cls):
+            raise RuntimeError("Unexpected message of type %r received"%type(obj))
+        return obj
+
     def process(self):
         raise NotImplementedError(f"No process implemented for this message of type {type(self)}")
 
@@ -0,0 +1,180 @@
+"""An optional in-memory index of the links within each simulation, used by the 'graph' engine of MultiHopStrategy.
+
+All links between objects in a simulation are loaded once into CSR-style numpy arrays: the links originating from
+the object at position i of the index (in order of database id) are found at positions indptr[i] to indptr[i+1] of
+the link arrays. Progenitor and descendant walks can then be performed entirely in numpy, which is particularly
+useful in long-running processes (such as the web server) that repeatedly walk the same merger trees.
+
+The index is discarded whenever a session in this process writes a change to objects, timesteps or links, and
+whenever the database reports a new object, timestep or link (e.g. because another process has written to it).
+Modifications to existing rows made by other processes are not detected.
+"""
+
+import threading
+
+import numpy as np
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import func
+
+from .. import core
+
+
+class MergerGraphIndex:
+    """The objects in a simulation and the links between them, stored as numpy arrays"""
+
+    def __init__(self, session, simulation_id):
+        self.simulation_id = simulation_id
+        self._derived = {}
+        self._load_objects(session)
+        self._load_links(session)
+
+    def _load_objects(self, session):
+        rows = session.query(core.SimulationObjectBase.id, core.SimulationObjectBase.halo_number,
+                             core.SimulationObjectBase.timestep_id, core.TimeStep.time_gyr).\
+            join(core.TimeStep, core.SimulationObjectBase.timestep_id == core.TimeStep.id).\
+            filter(core.TimeStep.simulation_id == self.simulation_id).\
+            order_by(core.SimulationObjectBase.id).all()
+
+        self.halo_ids = np.array([r[0] for r in rows], dtype=np.int64)
+        self.halo_numbers = np.array([r[1] for r in rows], dtype=np.int64)
+        self.timestep_ids = np.array([r[2] for r in rows], dtype=np.int64)
+        self.times = np.array([np.nan if r[3] is None else r[3] for r in rows], dtype=np.float64)
+
+    def _load_links(self, session):
+        halo_from = sqlalchemy.orm.aliased(core.SimulationObjectBase)
+        timestep_from = sqlalchemy.orm.aliased(core.TimeStep)
+        rows = session.query(core.HaloLink.halo_from_id, core.HaloLink.halo_to_id,
+                             core.HaloLink.weight, core.HaloLink.relation_id).\
+            join(halo_from, core.HaloLink.halo_from_id == halo_from.id).\
+            join(timestep_from, halo_from.timestep_id == timestep_from.id).\
+            filter(timestep_from.simulation_id == self.simulation_id).\
+            order_by(core.HaloLink.id).all()
+
+        link_from = self.indices_of(np.array([r[0] for r in rows], dtype=np.int64))
+        link_to = self.indices_of(np.array([r[1] for r in rows], dtype=np.int64))
+        weight = np.array([np.nan if r[2] is None else r[2] for r in rows], dtype=np.float64)
+        relation_id = np.array([r[3] for r in rows], dtype=np.int64)
+
+        # links to objects in other simulations are never followed by the graph engine
+        within_simulation = link_to >= 0
+        link_from, link_to = link_from[within_simulation], link_to[within_simulation]
+        weight, relation_id = weight[within_simulation], relation_id[within_simulation]
+
+        ordering = np.argsort(link_from, kind='stable')
+        self.link_to = link_to[ordering]
+        self.link_weight = weight[ordering]
+        self.link_relation_id = relation_id[ordering]
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(link_from, minlength=len(self.halo_ids)))))
+        self.link_reverse_weight = self._max_reverse_weights(link_from[ordering], self.link_to, self.link_weight)
+
+    def _max_reverse_weights(self, link_from, link_to, weight):
+        """For each link a->b, return the maximum weight of any link b->a, or -inf if there is none"""
+        if len(link_from) == 0:
+            return np.zeros(0, dtype=np.float64)
+        n = len(self.halo_ids)
+        keys = link_from * n + link_to
+        ordering = np.lexsort((weight, keys))
+        sorted_keys = keys[ordering]
+        is_last_of_key = np.append(sorted_keys[1:] != sorted_keys[:-1], True)
+        unique_keys = sorted_keys[is_last_of_key]
+        max_weights = weight[ordering][is_last_of_key]
+
+        reverse_keys = link_to * n + link_from
+        positions = np.searchsorted(unique_keys, reverse_keys)
+        positions[positions == len(unique_keys)] = 0
+        found = unique_keys[positions] == reverse_keys
+        return np.where(found, max_weights[positions], -np.inf)
+
+    def get_derived(self, key, calculate):
+        """Return data derived from this index, calculating it as calculate(self) if not already cached under key"""
+        if key not in self._derived:
+            self._derived[key] = calculate(self)
+        return self._derived[key]
+
+    def indices_of(self, halo_ids):
+        """Return the positions of the given database ids in this index, or -1 where an id is not present"""
+        halo_ids = np.asarray(halo_ids, dtype=np.int64)
+        if len(self.halo_ids) == 0:
+            return np.full(halo_ids.shape, -1, dtype=np.int64)
+        positions = np.searchsorted(self.halo_ids, halo_ids)
+        positions[positions == len(self.halo_ids)] = 0
+        return np.where(self.halo_ids[positions] == halo_ids, positions, -1)
+
+    def links_from(self, indices):
+        """Return (parent, link) arrays enumerating all links from the objects at the given positions.
+
+        parent gives the offset into indices from which each link originates; link gives the position of the
+        link in the link arrays."""
+        starts = self.indptr[indices]
+        counts = self.indptr[np.asarray(indices) + 1] - starts
+        parent = np.repeat(np.arange(len(indices)), counts)
+        first_link_of_parent = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        link = np.arange(counts.sum()) + first_link_of_parent
+        return parent, link
+
+
+class MergerGraphIndexCache:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._generation = None
+        self._indices = {}
+
+    def invalidate(self):
+        """Discard all indices"""
+        with self._lock:
+            self._indices = {}
+
+    def _check_generation(self, session):
+        generation = tuple(session.execute(sqlalchemy.select(
+            *(sqlalchemy.select(func.max(table.id)).scalar_subquery()
+              for table in (core.HaloLink, core.SimulationObjectBase, core.TimeStep)))).one())
+        if generation != self._generation:
+            self.invalidate()
+            self._generation = generation
+
+    def get_index(self, session, simulation_id):
+        """Return the index for the given simulation, loading it from the database if required"""
+        with self._lock:
+            self._check_generation(session)
+            index = self._indices.get(simulation_id, None)
+            if index is None:
+                index = MergerGraphIndex(session, simulation_id)
+                self._indices[simulation_id] = index
+            return index
+
+
+_cache = MergerGraphIndexCache()
+
+def get_index(session, simulation_id):
+    """Return the process-wide index of links within the given simulation"""
+    return _cache.get_index(session, simulation_id)
+
+def invalidate():
+    """Discard all indices held by this process"""
+    _cache.invalidate()
+
+
+_writes_pending_key = 'tangos_merger_graph_writes_pending'
+
+def _after_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (core.HaloLink, core.SimulationObjectBase, core.TimeStep)):
+            # the index may be rebuilt from the flushed (but uncommitted) state, so must be discarded again
+            # once the transaction ends, whether it is committed or rolled back
+            session.info[_writes_pending_key] = True
+            invalidate()
+            return
+
+def _do_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[_writes_pending_key] = True
+
+def _after_transaction_end(session):
+    if session.info.pop(_writes_pending_key, False):
+        invalidate()
+
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_flush', _after_flush)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'do_orm_execute', _do_orm_execute)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit', _after_transaction_end)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_rollback', _after_transaction_end)
@@ -3,6 +3,7 @@ import random
 import string
 import sys
 
+import numpy as np
 import sqlalchemy
 import sqlalchemy.exc
 import sqlalchemy.orm
@@ -30,7 +31,7 @@ class MultiHopStrategy(HopStrategy):
     def __init__(self, halo_from, nhops_max=None, directed=None, target=None,
                  order_by=None, combine_routes=True, min_aggregated_weight=0.0,
                  min_onehop_weight=0.0, min_onehop_reverse_weight=None,
-                 include_startpoint=False, one_simulation=None):
+                 include_startpoint=False, one_simulation=None, engine=None):
         """Construct a strategy for finding Halos via multiple "hops" along HaloLinks
 
         :param halo_from:   The halo to start hopping from
@@ -74,6 +75,27 @@ class MultiHopStrategy(HopStrategy):
                                           is no reverse link at all, the result will be dropped.
 
         :param include_startpoint:    Return the starting halo in the results (default False)
+
+        :param engine:      The method used to follow the links, which can be
+              'iterative' - issue a separate set of SQL statements for each hop, pruning the routes as they go
+              'recursive' - follow all hops within a single WITH RECURSIVE query
+              'graph'     - follow the hops in memory, using an index of all links in the simulation
+                            (see graph_index.py)
+              None        - use config.multihop_engine. If that specifies an engine that cannot be used for this
+                            strategy, the iterative engine is used instead.
+
+              The recursive engine avoids several round trips to the database per hop, so is much faster for walks
+              along long merger trees. It is available with SQLite (3.25 or later), PostgreSQL and MySQL (8.0 or
+              later, or MariaDB 10.2 or later) databases, when routes cannot loop back on themselves (i.e. when
+              directed is 'backwards' or 'forwards', or combine_routes is False). SQL does not allow aggregate or
+              window functions within a recursive query, so routes cannot be combined there. When combine_routes is
+              True and more than one link may be followed per hop (e.g. for all progenitors), the recursive engine
+              therefore issues a single INSERT ... SELECT statement per hop, rather than the several statements
+              per hop of the iterative engine.
+
+              The graph engine loads all links in the simulation the first time it is used, and then keeps them in
+              memory until links are next written. It is therefore suited to long-running processes such as the web
+              server. It is only available for 'backwards' or 'forwards' walks within a single simulation.
         """
         super().__init__(halo_from, target, order_by)
         if nhops_max is None:
@@ -90,10 +112,59 @@ class MultiHopStrategy(HopStrategy):
         self._connection = self.session.connection()
         self._combine_routes = combine_routes
         self._debug_output = False # set to True to see information about discovered links as hops progress
+        self._engine = self._choose_engine(engine)
 
         self.timing_monitor = TimingMonitor()
+
+    _engines = ('iterative', 'recursive', 'graph')
+
+    def _choose_engine(self, engine):
+        if engine is None:
+            engine = config.multihop_engine
+            if engine in self._engines and not self._engine_applicable(engine):
+                engine = 'iterative'
+        if engine not in self._engines:
+            raise ValueError("Unknown multi-hop engine %r" % engine)
+        if not self._engine_applicable(engine):
+            raise ValueError(f"The {engine} engine cannot be used with {type(self).__name__} for these parameters")
+        return engine
+
+    def _engine_applicable(self, engine):
+        directed_in_time = self.directed in ('backwards', 'forwards')
+        if engine == 'recursive':
+            return self._database_supports_recursive_engine() and (directed_in_time or not self._combine_routes)
+        elif engine == 'graph':
+            return directed_in_time and self._one_simulation and \
+                self._target_simulation_id() in (None, self._simulation_id())
+        else:
+            return True
+
+    def _database_supports_recursive_engine(self):
+        """Return True if the database supports recursive common table expressions and window functions"""
+        dialect = self._connection.dialect
+        version = dialect.server_version_info or ()
+        if dialect.name == 'sqlite':
+            return version >= (3, 25)
+        elif dialect.name in ('mysql', 'mariadb'):
+            return version >= ((10, 2) if getattr(dialect, 'is_mariadb', False) else (8, 0))
+        else:
+            return dialect.name == 'postgresql'
+
+    def _simulation_id(self):
+        return self.halo_from.timestep.simulation_id
+
+    def _target_simulation_id(self):
+        if isinstance(self._target, core.timestep.TimeStep):
+            return self._target.simulation_id
+        elif isinstance(self._target, core.simulation.Simulation):
+            return self._target.id
+        else:
+            return None
+
     def temp_table(self):
         """Execute the strategy and return results as a temp_table (see temporary_halolist module)"""
+        if self._engine == 'graph':
+            self._get_query_all()
         if self._all is None:
             return self._temp_table_without_leaving_sql()
         else:
@@ -119,6 +190,10 @@ class MultiHopStrategy(HopStrategy):
         self._make_hops()
 
     def _execute_query(self):
+        if self._engine == 'graph':
+            self._all = self._find_routes_in_graph()
+            return
+
         with self._manage_temp_table():
             self._generate_multihop_results()
             try:
@@ -144,17 +219,31 @@ class MultiHopStrategy(HopStrategy):
                 join(self.timestep_old, self.halo_old.timestep). \
                 join(self.timestep_new, self.halo_new.timestep)
 
-        filter = self._generate_link_filter(self.timestep_old, self.timestep_new, table)
+        filter = self._generate_link_filter(self.timestep_old, self.timestep_new, table.c.weight)
         query = query.filter(filter)
 
+        ordering = self._single_link_per_hop_ordering(self.timestep_new, self.halo_new, table.c.weight)
+        if ordering is not None:
+            query = query.order_by(*ordering).limit(1)
+
         return query
 
     def _needs_join_for_link_filter(self):
         return self.directed is not None
 
-    def _generate_link_filter(self, timestep_old, timestep_new, table):
+    def _single_link_per_hop_ordering(self, timestep_new, halo_new, weight):
+        """Return None to follow all links at each hop, or a list of order_by clauses that select the single link to
+        follow. The clauses may refer to the timestep and halo at the end of the link, and its aggregated weight."""
+        return None
+
+    def _single_link_per_hop_sort_keys(self, time_new, halo_number_new, weight):
+        """As _single_link_per_hop_ordering, but for the graph engine: return None or a list of numpy arrays,
+        most significant first, such that the link to follow is the first in ascending order"""
+        return None
 
-        recursion_filter = table.c.weight > self._min_aggregated_weight
+    def _generate_link_filter(self, timestep_old, timestep_new, weight):
+
+        recursion_filter = weight > self._min_aggregated_weight
 
         if self.directed is not None:
             directed = self.directed.lower()
@@ -258,6 +347,12 @@ class MultiHopStrategy(HopStrategy):
         self._connection.execute(insert_statement)
 
     def _make_hops(self):
+        if self._engine == 'recursive':
+            self._make_hops_recursive()
+        else:
+            self._make_hops_iterative()
+
+    def _make_hops_iterative(self):
         for i in range(0, self.nhops_max):
             with self.timing_monitor(self):
                 self._nhops_taken = i
@@ -276,6 +371,257 @@ class MultiHopStrategy(HopStrategy):
     def _hopping_finished(self, filtered_count):
         return filtered_count==0
 
+    def _make_hops_recursive(self):
+        if self._combine_routes and not self._follows_single_link_per_hop():
+            self._make_hops_combining_each_level()
+        else:
+            self._make_hops_in_recursive_query()
+
+    _route_columns = ['halo_from_id', 'halo_to_id', 'weight', 'nhops', 'source_id']
+
+    def _make_hops_in_recursive_query(self):
+        with self.timing_monitor(self):
+            self.timing_monitor.mark('recursive-insert')
+            columns = self._route_columns
+            routes = sqlalchemy.select(*[self._table.c[c] for c in columns]). \
+                where(self._table.c.nhops == 0).cte(name='multihop_routes', recursive=True)
+
+            link, candidate_links, single_link = self._recursive_candidate_links(routes)
+            if single_link:
+                # the candidate query selects the one link to follow from each route, via a correlated subquery
+                followed_link = sqlalchemy.orm.aliased(core.halo_data.HaloLink)
+                recursion = sqlalchemy.select(followed_link.id).select_from(routes). \
+                    join(followed_link, followed_link.id == candidate_links.scalar_subquery())
+            else:
+                followed_link = link
+                recursion = candidate_links
+
+            recursion = recursion.with_only_columns(followed_link.halo_from_id, followed_link.halo_to_id,
+                                                    routes.c.weight * followed_link.weight,
+                                                    routes.c.nhops + 1, routes.c.source_id)
+            routes = routes.union_all(recursion.where(routes.c.nhops < self.nhops_max))
+            results = sqlalchemy.select(*[routes.c[c] for c in columns]).where(routes.c.nhops > 0)
+            self._connection.execute(self._table.insert().from_select(columns, results))
+
+    def _make_hops_combining_each_level(self):
+        """Take each hop in a single statement, keeping only the strongest route to each halo before filtering the
+        links in the same way as the iterative engine"""
+        columns = self._route_columns
+        for i in range(0, self.nhops_max):
+            with self.timing_monitor(self):
+                self.timing_monitor.mark('level-insert')
+                link = sqlalchemy.orm.aliased(core.halo_data.HaloLink)
+                weight = self._table.c.weight * link.weight
+                candidates = sqlalchemy.select(
+                    link.halo_from_id, link.halo_to_id, weight.label('weight'),
+                    (self._table.c.nhops + 1).label('nhops'), self._table.c.source_id,
+                    sqlalchemy.func.max(weight).over(partition_by=[link.halo_to_id, self._table.c.source_id]).
+                        label('max_weight')). \
+                    select_from(self._table). \
+                    join(link, link.halo_from_id == self._table.c.halo_to_id). \
+                    where(self._table.c.nhops == i, link.weight > self._min_onehop_weight).subquery()
+
+                query = sqlalchemy.select(*[candidates.c[c] for c in columns]). \
+                    where(candidates.c.weight >= candidates.c.max_weight)
+                query, _, _ = self._filter_candidate_links(query, candidates.c.halo_from_id,
+                                                           candidates.c.halo_to_id, candidates.c.weight)
+                added_rows = self._connection.execute(self._table.insert().from_select(columns, query)).rowcount
+
+            if added_rows == 0:
+                break
+
+    def _find_routes_in_graph(self):
+        from . import graph_index
+        with self.timing_monitor(self):
+            self.timing_monitor.mark('graph-index')
+            index = graph_index.get_index(self.session, self._simulation_id())
+
+            self.timing_monitor.mark('graph-walk')
+            start, = index.indices_of([self.halo_from.id])
+            if start < 0:
+                return []
+
+            if self._follows_single_link_per_hop() and self._min_aggregated_weight == 0.0:
+                routes = self._walk_graph_along_best_links(index, start)
+            else:
+                routes = self._walk_graph(index, start)
+            route_from, route_to, route_weight, route_nhops = (np.asarray(x) for x in routes)
+
+            keep = np.ones(len(route_to), dtype=bool)
+            if not self._include_startpoint:
+                keep &= route_nhops > 0
+            if isinstance(self._target, core.timestep.TimeStep):
+                keep &= index.timestep_ids[route_to] == self._target.id
+
+            route_from, route_to = route_from[keep], route_to[keep]
+            route_weight, route_nhops = route_weight[keep], route_nhops[keep]
+
+            ordering = np.lexsort([np.arange(len(route_to))] +
+                                  [self._graph_sort_key(name, index, route_to, route_weight, route_nhops)
+                                   for name in self._order_by_names[::-1]])
+
+            halos = _HaloLoader(self.session)
+            return [_GraphRoute(halos, index.halo_ids[route_from[i]], index.halo_ids[route_to[i]],
+                                route_weight[i], route_nhops[i]) for i in ordering]
+
+    def _follows_single_link_per_hop(self):
+        empty = np.zeros(0)
+        return self._single_link_per_hop_sort_keys(empty, empty, empty) is not None
+
+    def _graph_link_filter(self, index, halo_from, halo_to, link):
+        """Return a boolean mask selecting the links that may be followed, excluding the aggregated weight threshold"""
+        time_old, time_new = index.times[halo_from], index.times[halo_to]
+        if self.directed == 'backwards':
+            keep = time_new < time_old * (1.0 - config.max_relative_time_difference)
+        else:
+            keep = time_new > time_old * (1.0 + config.max_relative_time_difference)
+        if self._min_onehop_reverse_weight is not None:
+            keep &= index.link_reverse_weight[link] > self._min_onehop_reverse_weight
+        return keep
+
+    def _walk_graph(self, index, start):
+        """Follow all links from start, hop by hop, as for the SQL engines. Returns arrays of
+        (halo_from, halo_to, weight, nhops) for each route, where the halos are positions in the index."""
+        route_from = [np.array([start])]
+        route_to = [np.array([start])]
+        route_weight = [np.array([1.0])]
+        route_nhops = [np.array([0])]
+
+        frontier, frontier_weight = route_to[0], route_weight[0]
+        for nhops in range(1, self.nhops_max+1):
+            parent, link = index.links_from(frontier)
+            keep = index.link_weight[link] > self._min_onehop_weight
+            parent, link = parent[keep], link[keep]
+            halo_from = frontier[parent]
+            halo_to = index.link_to[link]
+            weight = frontier_weight[parent] * index.link_weight[link]
+
+            if self._combine_routes:
+                keep = _is_group_maximum(halo_to, weight)
+                halo_from, halo_to, weight, link = halo_from[keep], halo_to[keep], weight[keep], link[keep]
+
+            keep = (weight > self._min_aggregated_weight) & self._graph_link_filter(index, halo_from, halo_to, link)
+            halo_from, halo_to, weight = halo_from[keep], halo_to[keep], weight[keep]
+
+            sort_keys = self._single_link_per_hop_sort_keys(index.times[halo_to], index.halo_numbers[halo_to], weight)
+            if sort_keys is not None and len(halo_to) > 0:
+                first = np.lexsort(sort_keys[::-1])[:1]
+                halo_from, halo_to, weight = halo_from[first], halo_to[first], weight[first]
+
+            if len(halo_to) == 0:
+                break
+
+            route_from.append(halo_from)
+            route_to.append(halo_to)
+            route_weight.append(weight)
+            route_nhops.append(np.full(len(halo_to), nhops))
+            frontier, frontier_weight = halo_to, weight
+
+        return (np.concatenate(route_from), np.concatenate(route_to),
+                np.concatenate(route_weight), np.concatenate(route_nhops))
+
+    def _walk_graph_along_best_links(self, index, start):
+        """As _walk_graph, for strategies that follow a single link per hop. The link to follow from each object
+        is calculated once for the whole index, so that the walk itself is only a lookup per hop."""
+        best_links = index.get_derived((type(self)._single_link_per_hop_sort_keys, self.directed,
+                                        self._min_onehop_weight, self._min_onehop_reverse_weight),
+                                       self._best_link_from_each_object)
+        route_from, route_to, route_weight, route_nhops = [start], [start], [1.0], [0]
+        halo, weight = start, 1.0
+        for nhops in range(1, self.nhops_max+1):
+            link = best_links[halo]
+            if link < 0:
+                break
+            weight *= index.link_weight[link]
+            route_from.append(halo)
+            halo = index.link_to[link]
+            route_to.append(halo)
+            route_weight.append(weight)
+            route_nhops.append(nhops)
+        return route_from, route_to, route_weight, route_nhops
+
+    def _best_link_from_each_object(self, index):
+        link_from = np.repeat(np.arange(len(index.halo_ids)), np.diff(index.indptr))
+        candidates = np.arange(len(index.link_to))
+        weight = index.link_weight
+        # given that all route weights are positive, the aggregated weight threshold of zero is equivalent to
+        # requiring a positive link weight
+        keep = (weight > self._min_onehop_weight) & (weight > 0.0) & \
+               self._graph_link_filter(index, link_from, index.link_to, candidates)
+        candidates = candidates[keep]
+        link_from, link_to, weight = link_from[keep], index.link_to[keep], weight[keep]
+
+        sort_keys = self._single_link_per_hop_sort_keys(index.times[link_to], index.halo_numbers[link_to], weight)
+        ordering = np.lexsort(sort_keys[::-1] + [link_from])
+        sorted_from = link_from[ordering]
+        first_from_object = np.append(True, sorted_from[1:] != sorted_from[:-1])
+
+        best_links = np.full(len(index.halo_ids), -1, dtype=np.int64)
+        best_links[sorted_from[first_from_object]] = candidates[ordering][first_from_object]
+        return best_links
+
+    def _graph_sort_key(self, name, index, route_to, route_weight, route_nhops):
+        if name == 'weight':
+            return -route_weight
+        elif name == 'time_asc':
+            return index.times[route_to]
+        elif name == 'time_desc':
+            return -index.times[route_to]
+        elif name == 'halo_number_asc':
+            return index.halo_numbers[route_to]
+        elif name == 'halo_number_desc':
+            return -index.halo_numbers[route_to]
+        elif name == 'nhops':
+            return route_nhops
+        else:
+            raise ValueError("Unknown ordering method %r" % name)
+
+    def _recursive_candidate_links(self, routes):
+        """Return (link, query, single_link) for the recursive engine.
+
+        The query selects the ids of the links (aliased as link) that may be followed from the end of the routes
+        found so far. If single_link is True, it is ordered and limited such that only the first should be followed."""
+        link = sqlalchemy.orm.aliased(core.halo_data.HaloLink)
+
+        query = sqlalchemy.select(link.id).select_from(link). \
+            where(link.halo_from_id == routes.c.halo_to_id, link.weight > self._min_onehop_weight)
+        query, timestep_new, halo_new = self._filter_candidate_links(query, link.halo_from_id, link.halo_to_id,
+                                                                     routes.c.weight * link.weight)
+
+        # Within the subquery, the weight of the route so far is constant; SQLite does not allow it to be referred to
+        # by the ORDER BY clause, so order by the weight of the link itself
+        ordering = self._single_link_per_hop_ordering(timestep_new, halo_new, link.weight)
+        if ordering is not None:
+            query = query.order_by(*ordering).limit(1)
+
+        return link, query, ordering is not None
+
+    def _filter_candidate_links(self, query, halo_from_id, halo_to_id, weight):
+        """Restrict a select() of candidate links, for the recursive engine, to those that may be followed.
+
+        Returns the query, together with the aliases of the timestep and halo at the end of the links."""
+        halo_old = sqlalchemy.orm.aliased(core.halo.SimulationObjectBase)
+        halo_new = sqlalchemy.orm.aliased(core.halo.SimulationObjectBase)
+        timestep_old = sqlalchemy.orm.aliased(core.timestep.TimeStep)
+        timestep_new = sqlalchemy.orm.aliased(core.timestep.TimeStep)
+
+        if self._needs_join_for_link_filter():
+            query = query. \
+                join(halo_old, halo_from_id == halo_old.id). \
+                join(halo_new, halo_to_id == halo_new.id). \
+                join(timestep_old, halo_old.timestep_id == timestep_old.id). \
+                join(timestep_new, halo_new.timestep_id == timestep_new.id)
+
+        query = query.where(self._generate_link_filter(timestep_old, timestep_new, weight))
+
+        if self._min_onehop_reverse_weight is not None:
+            reverse_link = sqlalchemy.orm.aliased(core.halo_data.HaloLink)
+            query = query.where(sqlalchemy.exists().where(reverse_link.halo_from_id == halo_to_id,
+                                                          reverse_link.halo_to_id == halo_from_id,
+                                                          reverse_link.weight > self._min_onehop_reverse_weight))
+
+        return query, timestep_new, halo_new
+
     def _generate_next_level_prelim_links(self, from_nhops=0):
         self.timing_monitor.mark('prelim-insert')
         new_weight = self._table.c.weight * core.halo_data.HaloLink.weight
@@ -418,3 +764,57 @@ class MultiHopStrategy(HopStrategy):
             return self._link_orm_class.c.nhops
         else:
             return super()._generate_order_arg_from_name(name, halo_alias, timestep_alias)
+
+
+def _is_group_maximum(groups, values):
+    """Return a boolean mask selecting the elements of values that are the maximum (or equal maximum) of their group"""
+    unique_groups, group_index = np.unique(groups, return_inverse=True)
+    group_max = np.full(len(unique_groups), -np.inf)
+    np.maximum.at(group_max, group_index, values)
+    return values >= group_max[group_index]
+
+
+class _HaloLoader:
+    """Loads the halos for a set of _GraphRoutes in a single query, the first time any of them is needed"""
+    def __init__(self, session):
+        self._session = session
+        self._routes = []
+        self._halos = None
+
+    def register(self, route):
+        self._routes.append(route)
+
+    def get(self, halo_id):
+        if self._halos is None:
+            # Often only the first result is required, so only load that
+            self._halos = {}
+            self._load([halo_id])
+        elif halo_id not in self._halos:
+            self._load(list({r.halo_from_id for r in self._routes} | {r.halo_to_id for r in self._routes}))
+        return self._halos[halo_id]
+
+    def _load(self, halo_ids):
+        for start in range(0, len(halo_ids), 1000):
+            for halo in self._session.query(core.halo.SimulationObjectBase).\
+                    filter(core.halo.SimulationObjectBase.id.in_(halo_ids[start:start+1000])):
+                self._halos[halo.id] = halo
+
+
+class _GraphRoute:
+    """A route found by the graph engine, standing in for the link objects returned by the SQL engines"""
+    def __init__(self, halo_loader, halo_from_id, halo_to_id, weight, nhops):
+        self._halo_loader = halo_loader
+        self.halo_from_id = int(halo_from_id)
+        self.halo_to_id = int(halo_to_id)
+        self.weight = float(weight)
+        self.nhops = int(nhops)
+        self.source_id = 0
+        halo_loader.register(self)
+
+    @property
+    def halo_from(self):
+        return self._halo_loader.get(self.halo_from_id)
+
+    @property
+    def halo_to(self):
+        return self._halo_loader.get(self.halo_to_id)
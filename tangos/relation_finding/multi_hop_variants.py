@@ -5,7 +5,7 @@ from .multi_hop import MultiHopStrategy
 class MultiHopAllProgenitorsStrategy(MultiHopStrategy):
     """Finds all progenitors for a halo at every step"""
     def __init__(self, halo_from, nhops_max=NHOPS_MAX_DEFAULT, include_startpoint=False, target='auto',
-                 combine_routes=True, order_by=None, one_simulation=None):
+                 combine_routes=True, order_by=None, one_simulation=None, engine=None):
         if order_by is None:
             order_by = ['time_desc', 'halo_number_asc']
         self.sim_id = halo_from.timestep.simulation_id
@@ -18,27 +18,33 @@ class MultiHopAllProgenitorsStrategy(MultiHopStrategy):
                                                                order_by=order_by,
                                                                combine_routes=combine_routes,
                                                              min_onehop_reverse_weight=0.1,
-                                                             one_simulation=one_simulation)
+                                                             one_simulation=one_simulation,
+                                                             engine=engine)
 
-    def _supplement_halolink_query_with_filter(self, query, table):
-        query = super()._supplement_halolink_query_with_filter(query, table)
+    def _generate_link_filter(self, timestep_old, timestep_new, weight):
+        link_filter = super()._generate_link_filter(timestep_old, timestep_new, weight)
         if self._target is None:
-            return query
+            return link_filter
         else:
-            return query.filter(self.timestep_new.simulation_id == self.sim_id)
+            return link_filter & (timestep_new.simulation_id == self.sim_id)
 
 
 class MultiHopMajorProgenitorsStrategy(MultiHopAllProgenitorsStrategy):
     """Finds the major progenitor for a halo at every step"""
 
-    def _supplement_halolink_query_with_filter(self, query, table):
-        query = super()._supplement_halolink_query_with_filter(query, table)
-        return query.order_by(self.timestep_new.time_gyr.desc(), table.c.weight.desc(), self.halo_new.halo_number). \
-            limit(1)
+    def _single_link_per_hop_ordering(self, timestep_new, halo_new, weight):
+        return [timestep_new.time_gyr.desc(), weight.desc(), halo_new.halo_number]
+
+    def _single_link_per_hop_sort_keys(self, time_new, halo_number_new, weight):
+        return [-time_new, -weight, halo_number_new]
 
 class MultiHopMostRecentMergerStrategy(MultiHopAllProgenitorsStrategy):
     """Finds the halos involved in the most recent merger into the major progenitor branch of the halo"""
 
+    def _engine_applicable(self, engine):
+        # hopping must stop as soon as a merger is found, which requires the iterative engine
+        return engine == 'iterative'
+
     def _hopping_finished(self, filtered_count):
         self._last_filtered_count = filtered_count
         return filtered_count != 1
@@ -65,8 +71,12 @@ class MultiHopMajorDescendantsStrategy(MultiHopStrategy):
                                                                target=halo_from.timestep.simulation,
                                                                **kwargs)
 
-    def _supplement_halolink_query_with_filter(self, query, table):
-        query = super()._supplement_halolink_query_with_filter(query, table)
-        return query.filter(self.timestep_new.simulation_id == self.sim_id). \
-            order_by(self.timestep_new.time_gyr, table.c.weight.desc(), self.halo_new.halo_number). \
-            limit(1)
+    def _generate_link_filter(self, timestep_old, timestep_new, weight):
+        link_filter = super()._generate_link_filter(timestep_old, timestep_new, weight)
+        return link_filter & (timestep_new.simulation_id == self.sim_id)
+
+    def _single_link_per_hop_ordering(self, timestep_new, halo_new, weight):
+        return [timestep_new.time_gyr, weight.desc(), halo_new.halo_number]
+
+    def _single_link_per_hop_sort_keys(self, time_new, halo_number_new, weight):
+        return [time_new, -weight, halo_number_new]
@@ -50,6 +50,10 @@ class MultiSourceMultiHopStrategy(MultiHopStrategy):
         super().__init__(halos_from[0], **kwargs)
         self._all_halo_from = halos_from
 
+    def _engine_applicable(self, engine):
+        # the search halts as soon as any source reaches the target, which requires the iterative engine
+        return engine == 'iterative'
+
     def _infer_direction(self, halos_from, target):
         if isinstance(target, core.simulation.Simulation):
             return "across"
@@ -123,6 +127,14 @@ class MultiSourceMultiHopStrategy(MultiHopStrategy):
         else:
             return [x.source_id for x in results]
 
+    def nhops(self):
+        """Returns the number of hops taken to reach each result returned by all().
+
+        Only available if the strategy was constructed with one_match_per_input=False."""
+        if self._return_only_highest_weights:
+            raise ValueError("nhops() is only available when one_match_per_input is False")
+        return [x.nhops for x in self._get_query_all()]
+
     def _generate_query(self, halo_ids_only):
 
         if self._return_only_highest_weights:
@@ -167,7 +179,7 @@ class MultiSourceAllMajorProgenitorsStrategy(MultiSourceMultiHopStrategy):
 
     def __init__(self, halos_from, **kwargs):
         super().__init__(halos_from, None, one_match_per_input=False, directed='backwards',
-                         include_startpoint=True)
+                         include_startpoint=True, **kwargs)
 
     def _should_halt(self):
         return False
@@ -176,7 +188,7 @@ class MultiSourceAllMajorDescendantsStrategy(MultiSourceMultiHopStrategy):
 
     def __init__(self, halos_from, **kwargs):
         super().__init__(halos_from, None, one_match_per_input=False, directed='forwards',
-                         include_startpoint=True)
+                         include_startpoint=True, **kwargs)
 
     def _should_halt(self):
         return False
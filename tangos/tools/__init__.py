@@ -66,10 +66,12 @@ class GenericTangosTool(metaclass=abc.ABCMeta):
 from . import (
     add_simulation,
     ahf_merger_tree_importer,
+    array_format_migrator,
     changa_bh_importer,
     consistent_trees_importer,
     crosslink,
     db_importer,
+    membership_builder,
     merger_tree_patcher,
     property_deleter,
     property_importer,
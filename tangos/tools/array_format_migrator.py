@@ -0,0 +1,61 @@
+from sqlalchemy import bindparam, select
+
+from .. import core
+from ..core import data_attribute_mapper
+from ..log import logger
+from . import GenericTangosTool
+
+
+class ArrayFormatMigrator(GenericTangosTool):
+    tool_name = 'migrate-arrays'
+    tool_description = 'Rewrite array properties stored in the older pickled formats into the native array format. ' \
+                       'This is a one-way migration: older versions of tangos cannot read the native format'
+    parallel = False
+
+    @classmethod
+    def add_parser_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', type=int, default=1000,
+                            help='The number of rows to read, convert and write back in each transaction')
+
+    def process_options(self, options):
+        self.options = options
+
+    def run_calculation_loop(self):
+        for table in core.HaloProperty.__table__, core.SimulationProperty.__table__:
+            self.migrate_table(table)
+
+    def migrate_table(self, table):
+        session = core.get_default_session()
+        connection = session.connection()
+        update = table.update().where(table.c.id == bindparam('b_id')).values(data_array=bindparam('b_data_array'))
+
+        logger.info("Migrating arrays in table %s", table.name)
+        last_id = None
+        num_read = 0
+        num_converted = 0
+        while True:
+            # keyset pagination on the primary key, so that each batch is an efficient index range scan
+            batch_query = select(table.c.id, table.c.data_array).where(table.c.data_array.isnot(None))
+            if last_id is not None:
+                batch_query = batch_query.where(table.c.id > last_id)
+            rows = connection.execute(batch_query.order_by(table.c.id).limit(self.options.batch_size)).all()
+            if len(rows)==0:
+                break
+            last_id = rows[-1][0]
+
+            updates = []
+            for row_id, packed in rows:
+                repacked = data_attribute_mapper.repack_array_in_native_format(packed)
+                if repacked is not None:
+                    updates.append({'b_id': row_id, 'b_data_array': repacked})
+
+            if len(updates)>0:
+                connection.execute(update, updates)
+            session.commit()
+            connection = session.connection()
+
+            num_read += len(rows)
+            num_converted += len(updates)
+            logger.info("  ... %d rows read, %d converted", num_read, num_converted)
+
+        logger.info("Finished table %s: %d of %d array rows converted", table.name, num_converted, num_read)
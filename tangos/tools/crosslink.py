@@ -11,6 +11,7 @@ from tangos import core, parallel_tasks
 from tangos.log import logger
 
 from .. import config
+from ..input_handlers import particle_matching
 from . import GenericTangosTool
 
 
@@ -37,6 +38,11 @@ class GenericLinker(GenericTangosTool):
                             help='Process in reverse order (low-z first)')
         parser.add_argument('--dmonly', action='store_true',
                             help='only match halos based on DM particles. Much more memory efficient, but currently only works for Rockstar halos')
+        parser.add_argument('--engine', action='store', choices=['bridge', 'membership'], default='bridge',
+                            help="Specify how particles in common are counted. 'bridge' (default) uses the input handler's "
+                                 "bridge between the snapshots, which loads them in full; 'membership' reads only "
+                                 "the particle IDs in each object, from the membership cache if it has been built, "
+                                 "using much less memory")
 
     def run_calculation_loop(self):
         parallel_tasks.database.synchronize_creator_object()
@@ -53,7 +59,8 @@ class GenericLinker(GenericTangosTool):
         for s_x, s in pair_list:
             logger.info("Linking %r and %r",s_x,s)
             if self.args.force or self.need_crosslink_ts(s_x, s, object_type):
-                self.crosslink_ts(s_x, s, 0, self.args.hmax, self.args.dmonly, object_typecode=object_type)
+                self.crosslink_ts(s_x, s, 0, self.args.hmax, self.args.dmonly, object_typecode=object_type,
+                                  engine=self.args.engine)
 
     def _generate_timestep_pairs(self):
         raise NotImplementedError("No implementation found for generating the timestep pairs")
@@ -107,35 +114,39 @@ class GenericLinker(GenericTangosTool):
         halos_map = {h.finder_id: h for h in halos}
         return halos_map
 
-    def crosslink_ts(self, ts1, ts2, halo_min=0, halo_max=None, dmonly=False, threshold=config.default_linking_threshold, object_typecode=0):
+    def crosslink_ts(self, ts1, ts2, halo_min=0, halo_max=None, dmonly=False, threshold=config.default_linking_threshold, object_typecode=0,
+                     engine='bridge'):
         """Link the halos of two timesteps together
 
         :type ts1 tangos.core.TimeStep
-        :type ts2 tangos.core.TimeStep"""
+        :type ts2 tangos.core.TimeStep
+        :param engine: 'bridge' to match using the output handler's match_objects_bidirectional (which counts the
+                       particles in common with its create_bridge), or 'membership'
+                       to match the particle IDs of each object (see get_object_membership) without loading
+                       the snapshots"""
         logger.info("Gathering halo information for %r and %r", ts1, ts2)
         halos1 = self.make_finder_id_to_halo_map(ts1, object_typecode)
         halos2 = self.make_finder_id_to_halo_map(ts2, object_typecode)
 
         same_d_id = self._get_linkname_dictionaryitem()
 
+        object_typetag = core.halo.SimulationObjectBase.object_typetag_from_code(object_typecode)
         output_handler_1 = ts1.simulation.get_output_handler()
         output_handler_2 = ts2.simulation.get_output_handler()
-        if type(output_handler_1).match_objects != type(output_handler_2).match_objects:
-            logger.error("Timesteps %r and %r cannot be crosslinked; they are using incompatible file readers",
-                         ts1, ts2)
-            return
-
-        # keep the files alive throughout (so they are not garbage-collected after the first match_objects):
-        snap1 = ts1.load()
-        snap2 = ts2.load()
 
         try:
-            cat = output_handler_1.match_objects(ts1.extension, ts2.extension, halo_min, halo_max, dmonly, threshold,
-                                                 core.halo.SimulationObjectBase.object_typetag_from_code(object_typecode),
-                                                 output_handler_for_ts2=output_handler_2)
-            back_cat = output_handler_2.match_objects(ts2.extension, ts1.extension, halo_min, halo_max, dmonly, threshold,
-                                                      core.halo.SimulationObjectBase.object_typetag_from_code(object_typecode),
-                                                      output_handler_for_ts2= output_handler_1)
+            if engine == 'membership':
+                cat, back_cat = self._match_by_membership(ts1, ts2, output_handler_1, output_handler_2, halo_min,
+                                                          halo_max, dmonly, threshold, object_typetag)
+            else:
+                if type(output_handler_1).match_objects != type(output_handler_2).match_objects:
+                    logger.error("Timesteps %r and %r cannot be crosslinked; they are using incompatible file readers",
+                                 ts1, ts2)
+                    return
+
+                cat, back_cat = output_handler_1.match_objects_bidirectional(
+                    ts1.extension, ts2.extension, halo_min, halo_max, dmonly, threshold, object_typetag,
+                    output_handler_for_ts2=output_handler_2)
         except Exception as e:
             if isinstance(e, KeyboardInterrupt):
                 raise
@@ -156,6 +167,14 @@ class GenericLinker(GenericTangosTool):
             self.session.commit()
         logger.info("Finished committing total of %d links for %r and %r", len(items)+len(items_back), ts1, ts2)
 
+    def _match_by_membership(self, ts1, ts2, output_handler_1, output_handler_2, halo_min, halo_max, dmonly,
+                             threshold, object_typetag):
+        membership_1 = output_handler_1.get_object_membership(ts1.extension, object_typetag, dmonly)
+        membership_2 = output_handler_2.get_object_membership(ts2.extension, object_typetag, dmonly)
+        cat, back_cat = particle_matching.match_memberships(membership_1, membership_2, threshold)
+        return particle_matching.restrict_to_range(cat, halo_min, halo_max), \
+               particle_matching.restrict_to_range(back_cat, halo_min, halo_max)
+
     def _get_linkname_dictionaryitem(self):
         with parallel_tasks.ExclusiveLock("create_db_objects_from_catalog"):
             same_d_id = core.dictionary.get_or_create_dictionary_item(self.session, "ptcls_in_common")
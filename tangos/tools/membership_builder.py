@@ -0,0 +1,62 @@
+import os
+
+from .. import core, parallel_tasks
+from ..input_handlers import membership_cache
+from ..log import logger
+from . import GenericTangosTool
+
+
+class MembershipBuilder(GenericTangosTool):
+    tool_name = 'build-membership'
+    tool_description = 'Build the on-disk cache of which particles belong to which objects, for use in linking'
+
+    @classmethod
+    def add_parser_arguments(self, parser):
+        parser.add_argument('--sims', '--for', action='store', nargs='*',
+                            metavar='simulation_name',
+                            help='Specify a simulation (or multiple simulations) to run on')
+        parser.add_argument('--type', action='store', type=str, dest='typetag', default='halo',
+                            help="Specify the object type to run on by tag name (e.g. halo, group)")
+        parser.add_argument('--dmonly', action='store_true',
+                            help='Include only DM particles (for use with link --dmonly)')
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild the cache for timesteps where it already exists')
+        parser.add_argument('--backwards', action='store_true',
+                            help='Process in reverse order (low-z first)')
+
+    def process_options(self, options):
+        self.options = options
+
+    def run_calculation_loop(self):
+        base_sim = core.sim_query_from_name_list(self.options.sims)
+
+        for x in base_sim:
+            timesteps = core.get_default_session().query(core.timestep.TimeStep).filter_by(
+                simulation_id=x.id, available=True).order_by(core.timestep.TimeStep.redshift.desc()).all()
+
+            if self.options.backwards:
+                timesteps = timesteps[::-1]
+
+            handler = x.get_output_handler()
+
+            for ts in parallel_tasks.distributed(timesteps):
+                self.build_for_timestep(handler, ts)
+
+    def build_for_timestep(self, handler, ts):
+        typetag, dm_only = self.options.typetag, self.options.dmonly
+        path = membership_cache.cache_path(handler, ts.extension, typetag, dm_only)
+        if os.path.exists(path) and not self.options.force:
+            logger.info("Membership cache for %r already exists", ts)
+            return
+
+        try:
+            membership = handler.get_object_membership_without_caching(ts.extension, typetag, dm_only)
+        except Exception as e:
+            if isinstance(e, KeyboardInterrupt):
+                raise
+            logger.exception("Unable to build membership cache for %r", ts)
+            return
+
+        membership_cache.save(handler, ts.extension, typetag, dm_only, membership)
+        logger.info("Stored membership of %d particles in %d %ss for %r", len(membership.particle_ids),
+                    len(membership), typetag, ts)
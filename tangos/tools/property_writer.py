@@ -3,6 +3,7 @@ import copy
 import pdb
 import random
 import sys
+import threading
 import time
 import traceback
 
@@ -12,7 +13,7 @@ import sqlalchemy.exc
 import sqlalchemy.orm
 
 from .. import config, core, live_calculation, parallel_tasks, properties
-from ..cached_writer import insert_list
+from ..cached_writer import flush_commits_on_server, insert_list
 from ..log import logger
 from ..parallel_tasks import accumulative_statistics
 from ..parallel_tasks.message import Message
@@ -30,19 +31,91 @@ class FileListMessage(Message):
 class ObjectsListMessage(Message):
     pass
 
+class TimestepPrefetcher:
+    """Loads the data for a timestep in a background thread, while calculations proceed on the current timestep.
+
+    The prefetched data is held until the timestep is taken, so that the handler's cache returns it rather than
+    reading it from disk again."""
+
+    def __init__(self, load_mode, object_typetag, memory_budget):
+        self._load_mode = load_mode
+        self._object_typetag = object_typetag
+        self._memory_budget = memory_budget
+        self._timestep_id = None
+        self._thread = None
+        self._prefetched = None
+
+    def start(self, db_timestep, current_db_timestep=None):
+        """Begin loading db_timestep in the background, unless it and current_db_timestep would exceed the budget"""
+        self.discard()
+        handler = db_timestep.simulation.get_output_handler()
+        if self._memory_budget is not None:
+            estimate = handler.estimate_timestep_memory(db_timestep.extension)
+            if current_db_timestep is not None:
+                estimate += current_db_timestep.simulation.get_output_handler().estimate_timestep_memory(
+                    current_db_timestep.extension)
+            if estimate > self._memory_budget:
+                logger.info("Not prefetching %r; estimated memory %.1f GB exceeds the budget of %.1f GB",
+                            db_timestep, estimate/1024**3, self._memory_budget/1024**3)
+                return
+
+        self._timestep_id = db_timestep.id
+        # the session is not thread-safe, so the thread must not touch db_timestep; pass it only plain values
+        self._thread = threading.Thread(target=self._prefetch, args=(handler, db_timestep.extension,
+                                                                     repr(db_timestep)), daemon=True)
+        self._thread.start()
+
+    def _prefetch(self, handler, extension, description):
+        logger.debug("Start prefetching %s", description)
+        try:
+            self._prefetched = handler.prefetch_timestep(extension, mode=self._load_mode,
+                                                         object_typetag=self._object_typetag)
+        except Exception:
+            # the timestep will be loaded again, and any error reported, when it is actually needed
+            logger.debug("Prefetching %s failed", description, exc_info=True)
+        else:
+            logger.debug("Finished prefetching %s", description)
+
+    def take(self, db_timestep):
+        """Wait for any prefetch of db_timestep to finish, and return the data that must be kept alive for it to
+        remain cached (or None if it was not prefetched)"""
+        if self._timestep_id != db_timestep.id:
+            return None
+        self._thread.join()
+        prefetched = self._prefetched
+        self._reset()
+        return prefetched
+
+    def discard(self):
+        """Wait for any prefetch in progress to finish, and release its data"""
+        if self._thread is not None:
+            self._thread.join()
+        self._reset()
+
+    def _reset(self):
+        self._timestep_id = None
+        self._thread = None
+        self._prefetched = None
+
+
 class PropertyWriter(GenericTangosTool):
     tool_name = "write"
     tool_description = "Calculate properties and write them into the tangos database"
 
     def __init__(self):
         self.redirect = terminalcontroller.redirect
-        self._writer_timeout = config.PROPERTY_WRITER_MAXIMUM_TIME_BETWEEN_COMMITS
-        self._writer_minimum = config.PROPERTY_WRITER_MINIMUM_TIME_BETWEEN_COMMITS
+        self._commit_policy = None
+        self._object_list_cursor = None
+        self._object_list_exhausted = False
+        self._num_objects_this_timestep = None
         self._current_timestep = None
         self._current_timestep_id = None
         self._current_timestep_particle_data = None
         self._current_object_id = None
         self._current_object = None
+        self._current_timestep_prefetched = None
+        self._next_timestep = None
+        self._prefetcher = None
 
     @classmethod
     def add_parser_arguments(self, parser):
@@ -77,6 +150,17 @@ class PropertyWriter(GenericTangosTool):
                                  "  --load-mode server-partial:    a server process figures out the indices to load, which are then passed to the partial loader" \
                                  "  --load-mode all:               each processor loads all the data (default, and often fine for zoom simulations)." \
                                  "  --load-mode server-shared-mem: a server process manages the data, passing to other processes via shared memory")
+        parser.add_argument('--halo-parallel', action='store_true',
+                            help="When running in parallel with load-mode partial, work on one timestep at a time "
+                                 "with the objects distributed between processes, rather than distributing whole "
+                                 "timesteps. Each process loads only the data for its own objects. Not available "
+                                 "with load-mode all, where every process would hold the whole snapshot; use "
+                                 "load-mode server-shared-mem to share a single copy instead. (Server load modes "
+                                 "always work this way.)")
+        parser.add_argument('--prefetch', action='store_true',
+                            help="While calculating properties for one timestep, load the next in a background thread. "
+                                 "Only effective when running sequentially, and subject to the memory budget set by "
+                                 "config.PROPERTY_WRITER_PREFETCH_MEMORY_BUDGET")
         parser.add_argument('--type', action='store', type=str, dest='htype',
                             help="Secify the object type to run on by tag name (or integer). Can be halo, group, or BH.")
         parser.add_argument('--hmin', action='store', type=int, default=0,
@@ -158,9 +242,9 @@ class PropertyWriter(GenericTangosTool):
         if parallel_tasks.backend is None:
             # Go sequentially
             ma_files = self.timesteps_to_process
-        elif self.options.load_mode is not None and self.options.load_mode.startswith('server'):
-            # In the case of loading from a centralised server, each node works on the _same_ timestep --
-            # parallelism is then implemented at the halo level
+        elif self._is_halo_parallel():
+            # In the case of loading from a centralised server, or if requested by --halo-parallel, each node works
+            # on the _same_ timestep -- parallelism is then implemented at the halo level
             ma_files = parallel_tasks.synchronized(self.timesteps_to_process, allow_resume=not self.options.no_resume,
                                                    resumption_id='parallel-timestep-iterator')
         else:
@@ -169,9 +253,9 @@ class PropertyWriter(GenericTangosTool):
                                                   resumption_id='parallel-timestep-iterator')
         return ma_files
 
-    def _get_parallel_object_iterator(self, items):
-        if self.options.load_mode is not None and self.options.load_mode.startswith('server'):
-            # Only in 'server' mode is parallelism undertaken at the halo level. See also
+    def _get_parallel_object_iterator(self, items, costs=None):
+        if self._is_halo_parallel():
+            # Only in 'server' mode, or with --halo-parallel, is parallelism undertaken at the halo level. See also
             # _get_parallel_timestep_iterator.
 
             assert parallel_tasks.backend.size()>1, "Cannot use this load mode outside of a parallel session"
@@ -180,10 +264,14 @@ class PropertyWriter(GenericTangosTool):
             # before all nodes have generated their local work lists
             parallel_tasks.barrier()
 
-            return parallel_tasks.distributed(items, allow_resume=False)
+            return parallel_tasks.distributed(items, allow_resume=False, costs=costs, adaptive_chunks=True)
         else:
             return items
 
+    def _estimate_object_costs(self):
+        """Estimate the relative cost of calculating properties for each object, from its particle count"""
+        return [(o.NDM or 0) + (o.NStar or 0) + (o.NGas or 0) for o in self._objects_this_timestep]
+
     def parse_command_line(self, argv=None):
         parser = self._get_parser_obj()
         self.process_options(parser.parse_args(argv))
@@ -196,6 +284,10 @@ class PropertyWriter(GenericTangosTool):
         if self.options.load_mode=='all':
             self.options.load_mode=None
 
+        if self.options.halo_parallel and self.options.load_mode is None:
+            raise ValueError("--halo-parallel would load the whole snapshot in every process; use it with "
+                             "--load-mode partial, or use --load-mode server-shared-mem to share a single copy")
+
         if self.options.verbose:
             self.redirect.enabled = False
 
@@ -209,8 +301,15 @@ class PropertyWriter(GenericTangosTool):
         else:
             self._include = None
 
+    def _is_halo_parallel(self):
+        """Returns True if all processes work on the same timestep, with the objects distributed between them"""
+        if self.options.load_mode is not None and self.options.load_mode.startswith('server'):
+            return True
+        return self.options.halo_parallel and parallel_tasks.backend is not None
+
     def _is_lead_rank(self):
-        return parallel_tasks.backend is None or parallel_tasks.backend.rank()==1 or self.options.load_mode is None
+        return parallel_tasks.backend is None or parallel_tasks.backend.rank()==1 or \
+            not self._should_share_query_results()
 
     def _log_once_per_timestep(self, *args):
         if self._is_lead_rank():
@@ -231,13 +330,42 @@ class PropertyWriter(GenericTangosTool):
 
             obj.all_properties.clear()
             obj.all_links.clear()
+            obj._collection_indices = {}
 
 
 
 
     def _build_object_list(self, db_timestep):
-        object_query = self._get_object_list_query(db_timestep)
-        self._objects_this_timestep = object_query.all()
+        """Query the next window of objects in the timestep, following on from the previous window (if any).
+
+        Sets _objects_this_timestep to None once all objects have been returned."""
+        if self._object_list_exhausted:
+            self._objects_this_timestep = None
+            return
+
+        # The window is first chosen by querying only the keys of the objects. Limiting the query that joins to the
+        # existing properties instead would count the joined property rows, rather than the objects.
+        window_size = config.PROPERTY_WRITER_OBJECT_WINDOW_SIZE
+        SimulationObjectBase = core.halo.SimulationObjectBase
+        key_query = core.get_default_session().query(SimulationObjectBase.halo_number, SimulationObjectBase.id).\
+            filter(self._get_object_window_filter(db_timestep, self._object_list_cursor, None)).\
+            order_by(SimulationObjectBase.halo_number, SimulationObjectBase.id)
+        if window_size is not None:
+            key_query = key_query.limit(window_size)
+        keys = key_query.all()
+
+        self._object_list_exhausted = window_size is None or len(keys) < window_size
+        if len(keys) == 0:
+            self._objects_this_timestep = None
+            return
+
+        last_key = tuple(keys[-1])
+        self._objects_this_timestep = self._get_object_list_query(db_timestep, self._object_list_cursor, last_key).all()
+        self._object_list_cursor = last_key
+
+    def _count_objects(self, db_timestep):
+        return core.get_default_session().query(core.halo.SimulationObjectBase.id).filter(
+            self._get_object_filter(db_timestep)).count()
 
     def _filter_object_list(self):
         if self._include:
@@ -276,7 +404,7 @@ class PropertyWriter(GenericTangosTool):
                 logger.warning("Particle IDs for tracker %r not found in the database", tracker.halo_number)
                 tracker._tracker = None
 
-    def _get_object_list_query(self, db_timestep):
+    def _get_object_filter(self, db_timestep):
         object_filter = core.halo.SimulationObjectBase.timestep == db_timestep
         if self.options.htype is not None:
             object_filter = sqlalchemy.and_(object_filter, core.halo.SimulationObjectBase.object_typecode
@@ -285,6 +413,28 @@ class PropertyWriter(GenericTangosTool):
             object_filter = sqlalchemy.and_(object_filter, core.halo.SimulationObjectBase.halo_number >= self.options.hmin)
         if self.options.hmax is not None:
             object_filter = sqlalchemy.and_(object_filter, core.halo.SimulationObjectBase.halo_number <= self.options.hmax)
+        return object_filter
+
+    def _get_object_window_filter(self, db_timestep, after_key, up_to_key):
+        """Filter for the objects in the timestep with (halo_number, id) greater than after_key and no greater than
+        up_to_key. Either bound may be None. Objects of different types can share a halo_number, so the id breaks
+        ties."""
+        SimulationObjectBase = core.halo.SimulationObjectBase
+        object_filter = self._get_object_filter(db_timestep)
+        if after_key is not None:
+            halo_number, id = after_key
+            object_filter = sqlalchemy.and_(object_filter, sqlalchemy.or_(
+                SimulationObjectBase.halo_number > halo_number,
+                sqlalchemy.and_(SimulationObjectBase.halo_number == halo_number, SimulationObjectBase.id > id)))
+        if up_to_key is not None:
+            halo_number, id = up_to_key
+            object_filter = sqlalchemy.and_(object_filter, sqlalchemy.or_(
+                SimulationObjectBase.halo_number < halo_number,
+                sqlalchemy.and_(SimulationObjectBase.halo_number == halo_number, SimulationObjectBase.id <= id)))
+        return object_filter
+
+    def _get_object_list_query(self, db_timestep, after_key=None, up_to_key=None):
+        object_filter = self._get_object_window_filter(db_timestep, after_key, up_to_key)
         needed_properties = self._required_and_calculated_property_names()
         # it's important that anything we need from the database is loaded now, as if it's
         # lazy-loaded later when we have relinquished the lock, SQLite may get upset
@@ -292,7 +442,8 @@ class PropertyWriter(GenericTangosTool):
                       options(sqlalchemy.orm.joinedload(core.halo.SimulationObjectBase.timestep),
                               sqlalchemy.orm.joinedload(core.halo.SimulationObjectBase.timestep, core.TimeStep.simulation),
                               sqlalchemy.orm.raiseload("*")).
-                      order_by(core.halo.SimulationObjectBase.halo_number).filter(object_filter))
+                      order_by(core.halo.SimulationObjectBase.halo_number, core.halo.SimulationObjectBase.id).
+                      filter(object_filter))
 
         logger.debug('Gathering existing properties for all halos in timestep %r', db_timestep)
         halo_query = live_calculation.MultiCalculation(*needed_properties).supplement_halo_query(halo_query)
@@ -347,24 +498,14 @@ class PropertyWriter(GenericTangosTool):
         self._existing_properties_this_timestep = existing_properties
 
 
-    def _is_commit_needed(self, end_of_timestep):
-        if len(self._pending_properties)==0:
-            return False
-        elif end_of_timestep:
-            return True
-        elif time.time() - self._last_commit_time > self._writer_timeout:
-            return True
-        else:
-            return False
-
-
     def _commit_results_if_needed(self, end_of_timestep=False):
-        need_to_commit = self._is_commit_needed(end_of_timestep)
+        trigger = self._commit_policy.trigger(end_of_timestep)
 
-        if need_to_commit:
-            self._commit_results()
+        if trigger is not None:
+            with self.timing_monitor(trigger):
+                self._commit_results()
 
-        if need_to_commit or end_of_timestep:
+        if trigger is not None or end_of_timestep:
             self.tracker.report_to_log_or_server(logger)
             self.timing_monitor.report_to_log_or_server(logger)
 
@@ -372,10 +513,18 @@ class PropertyWriter(GenericTangosTool):
             message.update_performance_stats()
 
     def _commit_results(self):
-        commit_on_server = self.options.load_mode and self.options.load_mode.startswith('server')
+        # in halo-parallel modes, only the lead rank keeps a database connection (see run_calculation_loop), and
+        # the results from all ranks are queued on the server to be committed together
+        commit_on_server = self._is_halo_parallel()
         insert_list(self._pending_properties, self._current_timestep_id, commit_on_server)
         self._pending_properties = []
-        self._last_commit_time = time.time()
+        self._commit_policy.reset()
+
+    def _flush_commits_on_server_if_needed(self):
+        # The synchronized timestep iterator has just passed a barrier, so the results of every rank have reached
+        # the server; the lead rank makes sure they are committed before it queries the database again
+        if self._is_halo_parallel() and self._is_lead_rank():
+            flush_commits_on_server()
 
     def _queue_results_for_later_commit(self, db_object, names, results, existing_properties_data):
         for n, r in zip(names, results):
@@ -385,6 +534,7 @@ class PropertyWriter(GenericTangosTool):
                     logger.info("Debug mode - not creating property %r for %r with value %r", n, db_object, r)
                 else:
                     self._pending_properties.append((proxy_object.ProxyObjectFromDatabaseId(db_object.id), n, r))
+                    self._commit_policy.add(r)
 
     def _required_and_calculated_property_names(self):
         needed = []
@@ -410,6 +560,7 @@ class PropertyWriter(GenericTangosTool):
     def _unload_timestep(self):
         self._current_object = None
         self._current_halo_id = None
+        self._current_timestep_prefetched = None
         with check_deleted(self._current_timestep_particle_data):
             self._current_timestep_particle_data=None
             self._current_timestep_id = None
@@ -424,6 +575,9 @@ class PropertyWriter(GenericTangosTool):
             # rows in the background
             self._unload_timestep()
 
+            if self._prefetcher is not None:
+                self._current_timestep_prefetched = self._prefetcher.take(db_timestep)
+
             if self._must_load_timestep_particles():
                 self._current_timestep_particle_data = db_timestep.load(mode=self.options.load_mode)
 
@@ -445,6 +599,16 @@ class PropertyWriter(GenericTangosTool):
             self._current_timestep_id = db_timestep.id
             self._current_timestep = db_timestep
 
+        self._start_prefetching_next_timestep()
+
+    def _start_prefetching_next_timestep(self):
+        if self._prefetcher is None or self._next_timestep is None:
+            return
+        if not self._should_load_particles() or \
+                (self.options.load_mode is not None and self.options.load_mode.startswith('server')):
+            return
+        self._prefetcher.start(self._next_timestep, self._current_timestep)
+
     def _clear_timestep_region_cache(self):
         if self._current_timestep_particle_data is None:
             return
@@ -588,37 +752,77 @@ class PropertyWriter(GenericTangosTool):
             if prop.region_specification is not properties.PropertyCalculation.region_specification:
                 # assume overriding means the class isn't just going to be returning None!
                 num_region_props += 1
-        num_objs = len(self._objects_this_timestep)
-        return num_region_props * num_objs
+        return num_region_props * self._num_objects_this_timestep
 
     def _transmit_objects_list(self):
         if not self._should_share_query_results():
             return
         assert self._is_lead_rank()
-        message = ObjectsListMessage((self._existing_properties_this_timestep, self._objects_this_timestep))
-        for i in range(2, parallel_tasks.backend.size()):
-            message.send(i)
+        message = ObjectsListMessage((self._existing_properties_this_timestep, self._objects_this_timestep,
+                                      self._num_objects_this_timestep))
+        message.broadcast(self._ranks_receiving_query_results())
 
     def _transmit_file_list(self):
         if not self._should_share_query_results():
             return
         assert self._is_lead_rank()
         message = FileListMessage(self.timesteps_to_process)
-        for i in range(2, parallel_tasks.backend.size()):
-            message.send(i)
+        message.broadcast(self._ranks_receiving_query_results())
 
     def _receive_file_list(self):
         assert self._should_share_query_results() and not self._is_lead_rank()
-        result = FileListMessage.receive(1).contents
+        result = FileListMessage.receive_broadcast(1, self._ranks_receiving_query_results()).contents
         return result
 
+    def _ranks_receiving_query_results(self):
+        # all ranks other than the server (rank 0) and the lead rank (rank 1)
+        return list(range(2, parallel_tasks.backend.size()))
+
     def _should_share_query_results(self):
-        return parallel_tasks.backend is not None and self.options.load_mode is not None
+        return parallel_tasks.backend is not None and (self.options.load_mode is not None or self.options.halo_parallel)
 
     def _receive_objects_list(self):
-        assert parallel_tasks.backend is not None and self.options.load_mode is not None
+        assert self._should_share_query_results()
         assert not self._is_lead_rank()
-        self._existing_properties_this_timestep, self._objects_this_timestep = ObjectsListMessage.receive(1).contents
+        self._existing_properties_this_timestep, self._objects_this_timestep, self._num_objects_this_timestep = \
+            ObjectsListMessage.receive_broadcast(1, self._ranks_receiving_query_results()).contents
+
+    def _iterate_object_windows(self, db_timestep):
+        """Yield once for each window of objects in the timestep, having set _objects_this_timestep and
+        _existing_properties_this_timestep to the objects in that window.
+
+        Objects are queried in windows of config.PROPERTY_WRITER_OBJECT_WINDOW_SIZE, so that the memory needed does
+        not grow with the size of the halo catalogue. Where query results are shared, the lead rank makes the
+        queries and transmits each window to the other ranks."""
+        self._object_list_cursor = None
+        self._object_list_exhausted = False
+        while True:
+            if self._is_lead_rank():
+                with parallel_tasks.lock.SharedLock("insert_list"):
+                    logger.debug("Start object list query")
+                    if self._object_list_cursor is None:
+                        self._num_objects_this_timestep = self._count_objects(db_timestep)
+                    self._build_object_list(db_timestep)
+                    if self._objects_this_timestep is not None:
+                        self._build_existing_properties()
+                        self._filter_object_list()
+                        self._attach_track_data_to_trackers()
+                        core.get_default_session().expunge_all()
+                        self._make_transient(self._objects_this_timestep)
+                    else:
+                        self._existing_properties_this_timestep = None
+                    logger.debug("End object list query")
+
+                self._transmit_objects_list()
+            else:
+                logger.debug("Get object list from remote process")
+                self._receive_objects_list()
+                logger.debug("Success!")
+
+            if self._objects_this_timestep is None:
+                return
+
+            yield
 
 
     def run_timestep_calculation(self, db_timestep):
@@ -642,27 +846,8 @@ class PropertyWriter(GenericTangosTool):
         if self.options.with_prerequisites:
             self._add_prerequisites_to_calculator_instances(db_timestep)
 
-        if self._is_lead_rank():
-            with parallel_tasks.lock.SharedLock("insert_list"):
-                logger.debug("Start object list query")
-                self._build_object_list(db_timestep)
-                self._build_existing_properties()
-                self._filter_object_list()
-                self._attach_track_data_to_trackers()
-                core.get_default_session().expunge_all()
-                self._make_transient(self._objects_this_timestep)
-                logger.debug("End object list query")
-
-            self._transmit_objects_list()
-        else:
-            logger.debug("Get object list from remote process")
-            self._receive_objects_list()
-            logger.debug("Success!")
-
-        self._log_once_per_timestep("Successfully gathered existing properties; calculating halo properties now...")
-
-        self._log_once_per_timestep("  %d halos to consider; %d calculation routines for each of them, resulting in %d properties per halo",
-                                    len(self._objects_this_timestep), len(self._property_calculator_instances),
+        self._log_once_per_timestep("  %d calculation routines for each halo, resulting in %d properties per halo",
+                                    len(self._property_calculator_instances),
                                     sum([1 if isinstance(x.names, str) else len(x.names) for x in self._property_calculator_instances])
                                     )
 
@@ -671,22 +856,28 @@ class PropertyWriter(GenericTangosTool):
             x_type = type(x)
             self._log_once_per_timestep(f"    {x_type.__module__}.{x_type.__qualname__}")
 
-        self._set_current_timestep(db_timestep)
+        for _ in self._iterate_object_windows(db_timestep):
+            self._log_once_per_timestep("Successfully gathered existing properties for %d halos; calculating halo properties now...",
+                                        len(self._objects_this_timestep))
 
-        for idx in self._get_parallel_object_iterator(range(len(self._objects_this_timestep))):
-            db_halo = self._objects_this_timestep[idx]
-            existing_properties = self._existing_properties_this_timestep[idx]
+            self._set_current_timestep(db_timestep)
 
-            db_halo.timestep = db_timestep
-            existing_properties.timestep = db_timestep
+            for idx in self._get_parallel_object_iterator(range(len(self._objects_this_timestep)),
+                                                          self._estimate_object_costs()):
+                db_halo = self._objects_this_timestep[idx]
+                existing_properties = self._existing_properties_this_timestep[idx]
 
-            self.run_object_calculation(db_halo, existing_properties)
+                db_halo.timestep = db_timestep
+                existing_properties.timestep = db_timestep
+
+                self.run_object_calculation(db_halo, existing_properties)
 
         self._log_once_per_timestep("Done with %r", db_timestep)
 
         self._commit_results_if_needed(end_of_timestep=True)
 
         self._objects_this_timestep = None
+        self._existing_properties_this_timestep = None
 
         self._unload_timestep()
 
@@ -723,12 +914,97 @@ class PropertyWriter(GenericTangosTool):
         self.timing_monitor = timing_monitor.TimingMonitor(allow_parallel=True)
         self.tracker = CalculationSuccessTracker(allow_parallel=True)
 
-        self._last_commit_time = time.time()
+        self._commit_policy = CommitPolicy(config.PROPERTY_WRITER_MAXIMUM_PENDING_ROWS,
+                                           config.PROPERTY_WRITER_MAXIMUM_PENDING_BYTES,
+                                           config.PROPERTY_WRITER_MAXIMUM_TIME_BETWEEN_COMMITS,
+                                           config.PROPERTY_WRITER_MINIMUM_TIME_BETWEEN_COMMITS)
         self._pending_properties = []
 
-        for f_obj in self._get_parallel_timestep_iterator():
-            self.run_timestep_calculation(f_obj)
+        if self.options.prefetch and parallel_tasks.backend is None:
+            self._prefetcher = TimestepPrefetcher(self.options.load_mode, self.options.htype or 'halo',
+                                                  config.PROPERTY_WRITER_PREFETCH_MEMORY_BUDGET)
+        elif self.options.prefetch:
+            # with a parallel iterator, the next timestep for this rank is only known once the current one is
+            # finished, so there is nothing to prefetch
+            logger.warning("--prefetch has no effect when running in parallel")
 
+        timesteps = self._get_parallel_timestep_iterator()
+        try:
+            for i, f_obj in enumerate(timesteps):
+                if self._prefetcher is not None:
+                    self._next_timestep = timesteps[i+1] if i+1 < len(timesteps) else None
+                self._flush_commits_on_server_if_needed()
+                self.run_timestep_calculation(f_obj)
+            self._flush_commits_on_server_if_needed()
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.discard()
+                self._prefetcher = None
+            self._next_timestep = None
+
+
+
+class CommitTrigger:
+    """Base class for the reasons that the property writer commits its results.
+
+    The trigger classes are passed to the TimingMonitor, so that the time spent committing is reported separately
+    for each reason."""
+    timing_monitor = None
+
+class CommitEndOfTimestep(CommitTrigger):
+    pass
+
+class CommitPendingRows(CommitTrigger):
+    pass
+
+class CommitPendingBytes(CommitTrigger):
+    pass
+
+class CommitElapsedTime(CommitTrigger):
+    pass
+
+class CommitPolicy:
+    """Keeps track of the results waiting to be committed, and decides when they should be"""
+
+    def __init__(self, maximum_rows, maximum_bytes, maximum_time, minimum_time=0):
+        self._maximum_rows = maximum_rows
+        self._maximum_bytes = maximum_bytes
+        self._maximum_time = maximum_time
+        self._minimum_time = minimum_time
+        self.reset()
+
+    def reset(self):
+        self.num_rows = 0
+        self.num_bytes = 0
+        self._last_commit_time = time.time()
+
+    def add(self, value):
+        self.num_rows += 1
+        self.num_bytes += self._estimate_encoded_size(value)
+
+    @staticmethod
+    def _estimate_encoded_size(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        else:
+            return 8
+
+    def trigger(self, end_of_timestep):
+        """Returns the CommitTrigger subclass describing why a commit is needed now, or None if it is not"""
+        if self.num_rows == 0:
+            return None
+        elif end_of_timestep:
+            return CommitEndOfTimestep
+
+        time_since_commit = time.time() - self._last_commit_time
+        if self.num_rows >= self._maximum_rows and time_since_commit >= self._minimum_time:
+            return CommitPendingRows
+        elif self.num_bytes >= self._maximum_bytes:
+            return CommitPendingBytes
+        elif time_since_commit > self._maximum_time:
+            return CommitElapsedTime
+        else:
+            return None
 
 
 class CalculationSuccessTracker(accumulative_statistics.StatisticsAccumulatorBase):
@@ -28,6 +28,18 @@ class ProxyObjectBase(metaclass=abc.ABCMeta):
         """
         pass
 
+    def resolve_id(self, session):
+        """Return the database ID of the object this proxy points to (or None if it cannot be found).
+
+        Subclasses override this where the ID is available without instantiating the ORM object.
+
+        :type session: sqlalchemy.orm.Session
+        """
+        obj = self.resolve(session)
+        if obj is None:
+            return None
+        return obj.id
+
     def relative_to_timestep_id(self, existing_timestep_id):
         """Return a proxy object resolved relative to an existing timestep, specified by database ID"""
         return self
@@ -50,6 +62,9 @@ class ProxyObjectFromDatabaseId(ProxyObjectBase):
     def resolve(self, session):
         return session.query(core.SimulationObjectBase).filter_by(id=self._dbid).first()
 
+    def resolve_id(self, session):
+        return self._dbid
+
 class ProxyObjectFromFinderIdAndTimestep(ProxyObjectBase):
     """A proxy object that resolves into the object with given finder ID in the specified timestep"""
     def __init__(self, finder_id, typetag, timestep_id):
@@ -75,6 +90,11 @@ class ProxyObjectFromFinderIdAndTimestepCache(ProxyObjectBase):
             raise ProxyResolutionException("The session for the cache must match the session for the object resolution")
         return self._timestep_cache.resolve_from_finder_id(self._finder_id, self._typetag)
 
+    def resolve_id(self, session):
+        if session!=self._timestep_cache.session:
+            raise ProxyResolutionException("The session for the cache must match the session for the object resolution")
+        return self._timestep_cache.resolve_id_from_finder_id(self._finder_id, self._typetag)
+
 class IncompleteProxyObjectFromFinderId(ProxyObjectBase):
     """A proxy object that stores an object's finder ID and type, but requires the timestep still to be specified.
 
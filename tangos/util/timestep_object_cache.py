@@ -29,6 +29,22 @@ class TimestepObjectCache:
         if not hasattr(self, "_map_finder_id") or not hasattr(self, "_map_finder_offset"):
             self._initialise_cache()
 
+    def _initialise_id_cache(self):
+        rows = self.session.query(core.SimulationObjectBase.id, core.SimulationObjectBase.finder_id,
+                                  core.SimulationObjectBase.object_typecode).filter_by(timestep_id=self._timestep_id)
+
+        self._map_finder_id_to_db_id = {}
+        typetags = {}
+        for db_id, finder_id, typecode in rows:
+            if typecode not in typetags:
+                typetags[typecode] = core.SimulationObjectBase.object_typetag_from_code(typecode)
+                self._map_finder_id_to_db_id[typetags[typecode]] = {}
+            self._map_finder_id_to_db_id[typetags[typecode]][finder_id] = db_id
+
+    def _ensure_id_cache(self):
+        if not hasattr(self, "_map_finder_id_to_db_id"):
+            self._initialise_id_cache()
+
     def resolve_from_finder_offset(self, finder_offset, typetag):
         self._ensure_cache()
         try:
@@ -42,3 +58,11 @@ class TimestepObjectCache:
             return self._map_finder_id[typetag][finder_id]
         except KeyError:
             return None
+
+    def resolve_id_from_finder_id(self, finder_id, typetag):
+        """Return the database ID of the object with the given finder ID, without loading any ORM objects"""
+        self._ensure_id_cache()
+        try:
+            return self._map_finder_id_to_db_id[typetag][finder_id]
+        except KeyError:
+            return None
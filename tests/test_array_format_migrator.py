@@ -0,0 +1,58 @@
+import pickle
+import zlib
+
+import numpy as np
+import numpy.testing as npt
+from pytest import fixture
+
+import tangos
+from tangos import core, testing
+from tangos.testing import simulation_generator
+from tangos.tools import array_format_migrator
+
+
+def _pickled(data):
+    dumped = pickle.dumps(data)
+    if len(dumped)>1000:
+        return b"ZX" + zlib.compress(dumped)
+    else:
+        return b"PX" + dumped
+
+@fixture
+def legacy_database():
+    testing.init_blank_db_for_testing()
+    generator = simulation_generator.SimulationGeneratorForTests()
+    generator.add_timestep()
+    generator.add_objects_to_timestep(5)
+    generator.add_properties_to_halos(test_array = lambda i: np.arange(i*100, dtype=np.float64),
+                                      test_scalar = lambda i: float(i))
+
+    # rewrite arrays in the old pickled formats, as written by earlier versions of tangos
+    session = core.get_default_session()
+    for prop in session.query(core.HaloProperty).filter(core.HaloProperty.data_array.isnot(None)):
+        prop.data_array = _pickled(np.arange(prop.halo.halo_number*100, dtype=np.float64))
+    session.commit()
+
+    yield
+
+    tangos.core.close_db()
+
+def _array_formats():
+    session = core.get_default_session()
+    return {row[0][:2] for row in session.query(core.HaloProperty.data_array).
+                                          filter(core.HaloProperty.data_array.isnot(None))}
+
+def test_migrate_arrays(legacy_database):
+    assert _array_formats() == {b"PX", b"ZX"}
+
+    tool = array_format_migrator.ArrayFormatMigrator()
+    tool.parse_command_line(["--batch-size", "2"])
+    tool.run_calculation_loop()
+
+    assert _array_formats() == {b"NX"}
+
+    session = core.get_default_session()
+    session.expire_all()
+    for i in range(1,6):
+        npt.assert_equal(tangos.get_halo("sim/ts1/%d"%i)['test_array'], np.arange(i*100, dtype=np.float64))
+        assert tangos.get_halo("sim/ts1/%d"%i)['test_scalar'] == float(i)
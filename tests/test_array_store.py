@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import tangos
+from tangos import config, core, log, parallel_tasks, properties, testing
+from tangos.core import array_store
+from tangos.input_handlers import output_testing
+from tangos.tools import add_simulation, property_writer
+
+
+class DummyLargeArrayProperty(properties.PropertyCalculation):
+    names = "dummy_large_array", "dummy_small_array"
+
+    def calculate(self, data, entry):
+        return np.arange(10000, dtype=np.float32)*entry.halo_number, np.arange(3)*entry.halo_number
+
+
+@pytest.fixture
+def sidecar_database(tmp_path):
+    parallel_tasks.use('null')
+    testing.init_blank_db_for_testing()
+    config.base = os.path.join(os.path.dirname(__file__), "test_simulations")
+    manager = add_simulation.SimulationAdderUpdater(output_testing.TestInputHandler("dummy_sim_1"))
+    with log.LogCapturer():
+        manager.scan_simulation_and_add_all_descendants()
+
+    old_folder, old_threshold = config.array_store_folder, config.array_store_threshold_bytes
+    config.array_store_folder = str(tmp_path)
+    config.array_store_threshold_bytes = 1000
+    yield tmp_path
+    config.array_store_folder, config.array_store_threshold_bytes = old_folder, old_threshold
+    array_store.close_all()
+    core.close_db()
+
+def _run_writer():
+    writer = property_writer.PropertyWriter()
+    writer.parse_command_line(["dummy_large_array", "--no-resume"])
+    with log.LogCapturer():
+        writer.run_calculation_loop()
+
+def test_large_arrays_stored_in_sidecar(sidecar_database):
+    _run_writer()
+
+    assert os.path.exists(sidecar_database / ("dummy_sim_1" + array_store.SIDECAR_EXTENSION))
+
+    halo = tangos.get_halo("dummy_sim_1/step.1/3")
+    large = halo.get_objects("dummy_large_array")[0]
+    small = halo.get_objects("dummy_small_array")[0]
+    assert large.data_array.startswith(array_store.REFERENCE_HEADER)
+    assert not small.data_array.startswith(array_store.REFERENCE_HEADER)
+
+    npt.assert_equal(halo['dummy_large_array'], np.arange(10000, dtype=np.float32)*3)
+    assert halo['dummy_large_array'].dtype == np.float32
+    assert halo['dummy_large_array'].flags.writeable
+    npt.assert_equal(halo['dummy_small_array'], np.arange(3)*3)
+
+    large_arrays, = tangos.get_timestep("dummy_sim_1/step.1").calculate_all("dummy_large_array",
+                                                                              order_by_halo_number=True)
+    npt.assert_equal(large_arrays[:, 1], np.arange(1, len(large_arrays)+1))
+
+def test_sidecar_requires_folder(sidecar_database):
+    _run_writer()
+    config.array_store_folder = None
+    with pytest.raises(OSError):
+        tangos.get_halo("dummy_sim_1/step.1/3")['dummy_large_array']
+
+def test_sidecar_memmap_views(sidecar_database, monkeypatch):
+    _run_writer()
+    monkeypatch.setattr(config, 'array_store_return_memmap', True)
+    large = tangos.get_halo("dummy_sim_1/step.1/3")['dummy_large_array']
+    npt.assert_equal(large, np.arange(10000, dtype=np.float32)*3)
+    assert not large.flags.writeable
+
+def test_sidecar_truncated_after_failed_transaction(sidecar_database):
+    _run_writer()
+    sidecar = sidecar_database / ("dummy_sim_1" + array_store.SIDECAR_EXTENSION)
+    size = os.path.getsize(sidecar)
+
+    with pytest.raises(RuntimeError):
+        with array_store.writing_for_simulation("dummy_sim_1"):
+            assert array_store.store_if_appropriate(np.zeros(10000)) is not None
+            raise RuntimeError("commit failed")
+
+    assert os.path.getsize(sidecar) == size
+    npt.assert_equal(tangos.get_halo("dummy_sim_1/step.1/3")['dummy_large_array'],
+                     np.arange(10000, dtype=np.float32)*3)
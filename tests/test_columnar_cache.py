@@ -0,0 +1,98 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+import sqlalchemy
+
+import tangos
+import tangos.testing as testing
+import tangos.testing.simulation_generator
+from tangos import config, core
+from tangos.live_calculation import columnar_cache
+
+
+def setup_module():
+    testing.init_blank_db_for_testing()
+
+    generator = tangos.testing.simulation_generator.SimulationGeneratorForTests()
+    generator.add_timestep()
+    generator.add_objects_to_timestep(5)
+    generator.add_bhs_to_timestep(3)
+    generator.add_properties_to_halos(Mvir=lambda i: 10.0*i, n_subhalos=lambda i: i % 2)
+    generator.add_properties_to_bhs(BH_mass=lambda i: 100.0*i)
+
+    # one halo is missing Mstar, and one has an array in place of a scalar property
+    generator.add_properties_to_halos(Mstar=lambda i: 1.0*i if i!=3 else None)
+    tangos.get_object("sim/ts1/halo_1")['profile'] = np.arange(10.0)
+
+def teardown_module():
+    core.close_db()
+
+@pytest.fixture
+def cache_enabled():
+    old_value = config.enable_columnar_property_cache
+    config.enable_columnar_property_cache = True
+    columnar_cache.invalidate()
+    yield
+    config.enable_columnar_property_cache = old_value
+
+def _calculate_with_and_without_cache(*args, **kwargs):
+    ts = tangos.get_timestep("sim/ts1")
+    with_cache = ts.calculate_all(*args, **kwargs)
+    config.enable_columnar_property_cache = False
+    without_cache = ts.calculate_all(*args, **kwargs)
+    config.enable_columnar_property_cache = True
+    return with_cache, without_cache
+
+@pytest.mark.parametrize("query", [("Mvir",), ("Mvir", "Mstar"), ("Mstar", "n_subhalos"), ("BH_mass",),
+                                   ("Mvir", "BH_mass")])
+@pytest.mark.parametrize("order_by_halo_number", [True, False])
+def test_cache_matches_orm(cache_enabled, query, order_by_halo_number):
+    with_cache, without_cache = _calculate_with_and_without_cache(*query, order_by_halo_number=order_by_halo_number)
+    assert len(with_cache) == len(without_cache)
+    for a, b in zip(with_cache, without_cache):
+        assert a.dtype == b.dtype
+        npt.assert_equal(a, b)
+
+def test_cache_object_type(cache_enabled):
+    with_cache, without_cache = _calculate_with_and_without_cache("BH_mass", object_type='BH')
+    npt.assert_equal(with_cache, without_cache)
+    with_cache, without_cache = _calculate_with_and_without_cache("Mvir", object_type='halo')
+    npt.assert_equal(with_cache, without_cache)
+
+def test_cache_avoids_repeated_queries(cache_enabled):
+    ts = tangos.get_timestep("sim/ts1")
+    ts.calculate_all("Mvir", "Mstar")
+    with testing.SqlExecutionTracker() as ctr:
+        Mvir, Mstar = ts.calculate_all("Mvir", "Mstar")
+    assert ctr.count_statements_containing("haloproperties.data_float") == 0
+    npt.assert_equal(Mvir, [10.0, 20.0, 40.0, 50.0])
+
+def test_cache_falls_back_for_arrays_and_live_calculations(cache_enabled):
+    ts = tangos.get_timestep("sim/ts1")
+    assert columnar_cache.get_cache().calculate_all(ts, ["profile"]) is None
+    profile, = ts.calculate_all("profile")
+    npt.assert_equal(profile, [np.arange(10.0)])
+    Mvir, hn = ts.calculate_all("Mvir", "halo_number()")
+    npt.assert_equal(hn, [1, 2, 3, 4, 5])
+
+def test_cache_invalidated_on_commit(cache_enabled):
+    ts = tangos.get_timestep("sim/ts1")
+    Mstar, = ts.calculate_all("Mstar")
+    assert len(Mstar) == 4
+    tangos.get_object("sim/ts1/halo_3")['Mstar'] = 3.0
+    core.get_default_session().commit()
+    Mstar, = ts.calculate_all("Mstar")
+    npt.assert_equal(Mstar, [1.0, 2.0, 3.0, 4.0, 5.0])
+
+def test_cache_invalidated_by_deletion_in_another_process(cache_enabled):
+    ts = tangos.get_timestep("sim/ts1")
+    Mstar_before, = ts.calculate_all("Mstar")
+
+    # delete a property (other than the latest) without going through any session in this process
+    halo_id = tangos.get_object("sim/ts1/halo_2").id
+    name_id = core.dictionary.get_dict_id("Mstar")
+    with core.get_default_engine().begin() as connection:
+        connection.execute(sqlalchemy.delete(core.HaloProperty).where(core.HaloProperty.halo_id == halo_id,
+                                                                      core.HaloProperty.name_id == name_id))
+    Mstar, = ts.calculate_all("Mstar")
+    npt.assert_equal(Mstar, Mstar_before[Mstar_before != 2.0])
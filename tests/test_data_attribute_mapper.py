@@ -5,9 +5,11 @@ import zlib
 
 import numpy as np
 import pynbody
+import pytest
 from pytest import raises as assert_raises
 
 import tangos.core.data_attribute_mapper as dam
+from tangos import config
 
 
 class _TestTarget:
@@ -106,17 +108,97 @@ def test_struct_time():
 
 def test_array_pack_format():
     target = _TestTarget()
-    test_data=np.array([1,2,3])
+    test_data=[1,2,3]
     target.data=test_data
     assert target.data_array.startswith(b"PX")
     assert target.data_array.endswith(pickle.dumps(test_data))
 
-    test_data=np.arange(2000)
+    test_data=pynbody.array.SimArray(np.arange(2000), "kpc")
     target.data=test_data
     assert target.data_array.startswith(b"ZX")
     assert target.data_array.endswith(zlib.compress(pickle.dumps(test_data)))
     assert np.allclose(target.data, test_data)
 
+@pytest.fixture
+def native_format(monkeypatch):
+    monkeypatch.setattr(config, 'array_native_format', True)
+
+def test_native_format_not_written_by_default():
+    target = _TestTarget()
+    test_data = np.array([1,2,3])
+    target.data = test_data
+    assert target.data_array.startswith(b"PX")
+    assert (target.data == test_data).all()
+
+def test_native_array_pack_format(native_format):
+    target = _TestTarget()
+    test_data = np.array([1,2,3])
+    target.data = test_data
+    assert target.data_array.startswith(b"NX\x01R")
+    assert target.data_array.endswith(test_data.astype('<i8').tobytes())
+
+    test_data = np.arange(2000)
+    target.data = test_data
+    assert target.data_array.startswith(b"NX\x01Z")
+    assert len(target.data_array) < test_data.nbytes
+
+@pytest.mark.parametrize("length", range(8))
+def test_native_array_length_distinct_from_old_format(native_format, length):
+    target = _TestTarget()
+    target.data = np.arange(length, dtype=np.int8)
+    assert len(target.data_array) % 8 != 0
+    assert (target.data == np.arange(length)).all()
+
+@pytest.mark.parametrize("test_data", [np.arange(10, dtype=np.float32),
+                                       np.random.normal(size=(300, 3)),
+                                       np.arange(5000, dtype='>i4'),
+                                       np.array([1+2j, 3-4j]),
+                                       np.array([True, False]),
+                                       np.zeros((0, 4))])
+def test_native_array_round_trip(native_format, test_data):
+    target = _TestTarget()
+    target.data = test_data
+    assert target.data_array.startswith(b"NX")
+    result = target.data
+    assert result.shape == test_data.shape
+    assert result.dtype == test_data.dtype.newbyteorder('=')
+    assert result.flags.writeable
+    assert (result == test_data).all()
+
+def test_pickled_formats_still_readable():
+    test_data = np.arange(2000)
+    target = _TestTarget()
+    target.data_array = b"PX" + pickle.dumps(test_data)
+    assert (target.data == test_data).all()
+    target.data_array = b"ZX" + zlib.compress(pickle.dumps(test_data))
+    assert (target.data == test_data).all()
+
+def _targets_with_data(*data):
+    targets = [_TestTarget() for _ in data]
+    for t, d in zip(targets, data):
+        t.data = d
+    return targets
+
+def test_get_stacked(native_format):
+    targets = _targets_with_data(np.arange(2000, dtype='>f8').reshape(1000,2), np.zeros((1000,2)),
+                                 np.ones((1000,2), dtype='>f8'))
+    targets[1].data_array = b"ZX" + zlib.compress(pickle.dumps(np.zeros((1000, 2), dtype='>f8')))
+    mapper = dam.DataAttributeMapper(targets[0])
+    result = mapper.get_stacked(targets)
+    assert result.shape == (3, 1000, 2)
+    assert result.dtype == np.dtype('f8')
+    for i,t in enumerate(targets):
+        assert (result[i] == t.data).all()
+
+@pytest.mark.parametrize("test_data", [(np.arange(10), np.arange(11)),
+                                       (np.arange(10), np.arange(10.0)),
+                                       (np.arange(10), [1,2,3]),
+                                       (np.arange(10), pynbody.array.SimArray(np.arange(10), "kpc"))])
+def test_get_stacked_heterogeneous(test_data):
+    targets = _targets_with_data(*test_data)
+    mapper = dam.DataAttributeMapper(targets[0])
+    assert mapper.get_stacked(targets) is None
+
 def test_none():
     target = _TestTarget()
     assert target.data is None
@@ -169,6 +251,14 @@ def test_old_format():
     target.data_array = data.tobytes()
     assert np.allclose(data,target.data)
 
+@pytest.mark.parametrize("header", [b"NX\x01R", b"NX\x01Z", b"MX\x01{", b"NXR"])
+def test_old_format_resembling_newer_headers(header):
+    data = np.frombuffer(header + bytes(range(20, 36-len(header))), dtype=np.float64)
+    target = _TestTarget()
+    target.data_array = data.tobytes()
+    assert target.data_array.startswith(header)
+    assert np.array_equal(data, target.data, equal_nan=True)
+
 def test_empty_container():
     target = _TestTarget()
     assert target.data is None
@@ -1,6 +1,7 @@
 import os
 import time
 
+import numpy as np
 import pytest
 from numpy import testing as npt
 from pytest import fixture
@@ -65,6 +66,14 @@ class DummyPropertyCausingException(properties.PropertyCalculation):
     def calculate(self, data, entry):
         raise RuntimeError("Test of exception handling")
 
+class DummyPropertyRecordingPid(properties.PropertyCalculation):
+    names = "dummy_property_recording_pid",
+    requires_particle_data = True
+
+    def calculate(self, data, entry):
+        time.sleep(0.01) # so that one process cannot take all the objects before the other starts
+        return os.getpid(),
+
 class DummyPropertyWithReconstruction(properties.PropertyCalculation):
     names = "dummy_property_with_reconstruction",
     requries_particle_data = False
@@ -135,6 +144,26 @@ def test_parallel_writing(fresh_database, load_mode):
 
     _assert_properties_as_expected()
 
+def test_halo_parallel_writing(fresh_database):
+    parallel_tasks.use('multiprocessing-3')
+    run_writer_with_args("dummy_property", "dummy_property_recording_pid", "--load-mode=partial",
+                         "--halo-parallel", parallel=True)
+    _assert_properties_as_expected()
+
+    # both worker processes should have calculated properties for objects within the first timestep
+    pids = db.get_timestep("dummy_sim_1/step.1").calculate_all("dummy_property_recording_pid")[0]
+    assert len(pids) == 10
+    assert len(set(pids)) == 2
+
+@pytest.mark.parametrize('load_mode', [None, 'all'])
+def test_halo_parallel_refuses_loading_all(fresh_database, load_mode):
+    # every process would hold its own copy of the snapshot
+    args = ["dummy_property", "--halo-parallel"]
+    if load_mode is not None:
+        args.append("--load-mode="+load_mode)
+    with pytest.raises(ValueError):
+        run_writer_with_args(*args)
+
 def test_property_gathering_across_processes(fresh_database):
     parallel_tasks.use('multiprocessing-5')
     results = run_writer_with_args('dummy_property',  parallel=True)
@@ -537,3 +566,157 @@ def test_include_only_keeps_existing_properties_aligned(fresh_database):
     hn, echoed = db.get_timestep("dummy_sim_1/step.1").calculate_all("halo_number()",
                                                                     "echoed_halo_number")
     npt.assert_equal(echoed, hn)
+
+class DummyArrayProperty(DummyProperty):
+    names = "dummy_array_property",
+
+    def calculate(self, data, entry):
+        return np.arange(5)*data.halo,
+
+@pytest.mark.parametrize('bulk_core_insert', [True, False])
+def test_insert_modes(fresh_database, bulk_core_insert):
+    old_value = tangos.config.PROPERTY_WRITER_BULK_CORE_INSERT
+    tangos.config.PROPERTY_WRITER_BULK_CORE_INSERT = bulk_core_insert
+    try:
+        run_writer_with_args("dummy_property", "dummy_array_property", "dummy_link")
+    finally:
+        tangos.config.PROPERTY_WRITER_BULK_CORE_INSERT = old_value
+
+    _assert_properties_as_expected()
+    npt.assert_equal(db.get_halo("dummy_sim_1/step.1/2")['dummy_array_property'], np.arange(5)*2)
+    assert db.get_default_session().query(db.core.HaloLink).count() == 15
+    db.testing.assert_halolists_equal([db.get_halo(2)['dummy_link']], [db.get_halo(1)])
+    assert db.get_halo(2).all_properties[0].creator_id == db.get_halo(2).all_links[0].creator_id
+
+@pytest.mark.parametrize('memory_budget', [None, 0])
+def test_prefetch(fresh_database, monkeypatch, memory_budget):
+    import threading
+    monkeypatch.setattr(tangos.config, 'PROPERTY_WRITER_PREFETCH_MEMORY_BUDGET', memory_budget)
+
+    loading_threads = {}
+    original_load = output_testing.TestInputHandler.load_timestep_without_caching
+    def load_timestep_without_caching(self, ts_extension, mode=None):
+        loading_threads.setdefault(ts_extension, []).append(threading.current_thread())
+        return original_load(self, ts_extension, mode)
+    monkeypatch.setattr(output_testing.TestInputHandler, 'load_timestep_without_caching',
+                        load_timestep_without_caching)
+
+    run_writer_with_args("dummy_property", "--prefetch")
+    _assert_properties_as_expected()
+
+    timesteps = db.get_simulation("dummy_sim_1").timesteps
+    # every timestep is loaded exactly once...
+    assert sorted(loading_threads.keys()) == sorted(ts.extension for ts in timesteps)
+    assert all(len(threads) == 1 for threads in loading_threads.values())
+
+    # ...and, unless the budget prevents it, all but the first are loaded in the background
+    loaded_in_background = [threads[0] is not threading.main_thread() for threads in loading_threads.values()]
+    if memory_budget is None:
+        assert sum(loaded_in_background) == len(timesteps)-1
+    else:
+        assert sum(loaded_in_background) == 0
+
+def test_prefetch_thread_does_not_use_session(fresh_database, monkeypatch):
+    import threading
+    from types import SimpleNamespace
+
+    # hold back the prefetch thread until the main thread has moved on
+    deferred_threads = []
+    class DeferredThread(threading.Thread):
+        def start(self):
+            deferred_threads.append(self)
+    monkeypatch.setattr(property_writer, 'threading', SimpleNamespace(Thread=DeferredThread))
+
+    session = db.get_default_session()
+    timestep = db.get_timestep("dummy_sim_1/step.2")
+    prefetcher = property_writer.TimestepPrefetcher(None, 'halo', None)
+    prefetcher.start(timestep)
+
+    # the session is not thread-safe, so the prefetch thread must not need the timestep object
+    session.expire(timestep)
+    session.expunge(timestep)
+    threading.Thread.start(deferred_threads[0])
+    assert prefetcher.take(db.get_timestep("dummy_sim_1/step.2")) is not None
+
+@pytest.mark.parametrize('budget', ['rows', 'bytes'])
+def test_commit_budgets(fresh_database, monkeypatch, budget):
+    if budget == 'rows':
+        monkeypatch.setattr(tangos.config, 'PROPERTY_WRITER_MAXIMUM_PENDING_ROWS', 4)
+        monkeypatch.setattr(tangos.config, 'PROPERTY_WRITER_MINIMUM_TIME_BETWEEN_COMMITS', 0)
+    else:
+        # an array property of 5 int64 elements takes 40 bytes
+        monkeypatch.setattr(tangos.config, 'PROPERTY_WRITER_MAXIMUM_PENDING_BYTES', 80)
+
+    res = run_writer_with_args("dummy_property", "dummy_array_property")
+
+    _assert_properties_as_expected()
+    npt.assert_equal(db.get_halo("dummy_sim_1/step.1/2")['dummy_array_property'], np.arange(5)*2)
+
+    # the timing monitor reports the time spent on commits for each reason they were triggered
+    assert "CommitEndOfTimestep" in res
+    if budget == 'rows':
+        assert "CommitPendingRows" in res
+    else:
+        assert "CommitPendingBytes" in res
+
+def test_commit_policy():
+    policy = property_writer.CommitPolicy(maximum_rows=3, maximum_bytes=100, maximum_time=1000)
+    assert policy.trigger(end_of_timestep=True) is None
+
+    policy.add(1.0)
+    assert policy.trigger(end_of_timestep=False) is None
+    assert policy.trigger(end_of_timestep=True) is property_writer.CommitEndOfTimestep
+
+    policy.add(np.zeros(100, dtype=np.uint8))
+    assert policy.num_bytes == 108
+    assert policy.trigger(end_of_timestep=False) is property_writer.CommitPendingBytes
+
+    policy.add(2.0)
+    assert policy.trigger(end_of_timestep=False) is property_writer.CommitPendingRows
+
+    policy.reset()
+    policy.add(1.0)
+    policy._last_commit_time -= 2000
+    assert policy.trigger(end_of_timestep=False) is property_writer.CommitElapsedTime
+
+    # the row budget is only applied once the minimum time has elapsed; the byte budget always applies
+    policy = property_writer.CommitPolicy(maximum_rows=1, maximum_bytes=100, maximum_time=1000, minimum_time=10)
+    policy.add(1.0)
+    assert policy.trigger(end_of_timestep=False) is None
+    policy._last_commit_time -= 20
+    assert policy.trigger(end_of_timestep=False) is property_writer.CommitPendingRows
+    policy.reset()
+    policy.add(np.zeros(100, dtype=np.uint8))
+    assert policy.trigger(end_of_timestep=False) is property_writer.CommitPendingBytes
+
+@pytest.mark.parametrize('load_mode', [None, 'server'])
+def test_object_windows(fresh_database, monkeypatch, load_mode):
+    monkeypatch.setattr(tangos.config, 'PROPERTY_WRITER_OBJECT_WINDOW_SIZE', 3)
+    num_halos = db.get_timestep("dummy_sim_1/step.1").halos.count()
+
+    def run_writer(*args):
+        if load_mode is None:
+            return run_writer_with_args(*args)
+        parallel_tasks.use('multiprocessing-3')
+        try:
+            return run_writer_with_args(*args, "--load-mode="+load_mode, parallel=True)
+        finally:
+            parallel_tasks.use('null')
+
+    res = run_writer("dummy_property")
+    run_writer("another_dummy_property", "--include", "dummy_property<5")
+
+    assert "Successfully gathered existing properties for 3 halos" in res
+    npt.assert_equal(np.sort(db.get_timestep("dummy_sim_1/step.1").calculate_all("dummy_property")[0]),
+                     np.arange(1, num_halos+1))
+
+    dp, _ = db.get_timestep("%/step.1").calculate_all("dummy_property", "another_dummy_property")
+    assert (dp < 5).all()
+    assert len(dp) == 4
+
+    # now that several properties are stored for each halo, the windows must still hold 3 halos each (rather than
+    # 3 rows of halos joined to their properties), and no halos may be skipped
+    res = run_writer("dummy_property", "another_dummy_property", "--force")
+    assert "Successfully gathered existing properties for 3 halos" in res
+    dp, _ = db.get_timestep("%/step.1").calculate_all("dummy_property", "another_dummy_property")
+    assert len(dp) == num_halos
@@ -1,3 +1,5 @@
+from types import SimpleNamespace
+
 import numpy as np
 
 import tangos
@@ -10,6 +12,7 @@ import tangos.testing.simulation_generator
 
 __author__ = 'app'
 
+import pytest
 from pytest import raises as assert_raises
 
 import tangos
@@ -406,3 +409,113 @@ def test_single_match_from_multiple_routes():
     # The multiple routes here are sim3/ts1/1 -> sim2/ts1/1, sim2/ts1/2 -> sim/ts1/1
     h = tangos.get_halo("sim3/ts1/1")
     testing.assert_halolists_equal([h.calculate("match('sim')")], [tangos.get_halo("sim/ts1/1")])
+
+def _results_and_weights(strategy_class, halo, **kwargs):
+    results, weights = strategy_class(tangos.get_item(halo), **kwargs).all_and_weights()
+    return [r.path for r in results], list(weights)
+
+@pytest.mark.parametrize("strategy_class, halo, kwargs",
+                         [(halo_finding.MultiHopStrategy, "sim/ts3/1",
+                           {'nhops_max': 2, 'directed': 'backwards', 'order_by': ["time_asc", "weight"]}),
+                          (halo_finding.MultiHopStrategy, "sim/ts3/1",
+                           {'nhops_max': 2, 'directed': 'backwards', 'order_by': ["time_asc", "weight"],
+                            'combine_routes': False}),
+                          (halo_finding.MultiHopStrategy, "sim/ts1/1",
+                           {'nhops_max': 5, 'directed': 'forwards', 'include_startpoint': True}),
+                          (halo_finding.MultiHopMajorProgenitorsStrategy, "sim/ts3/1", {'include_startpoint': True}),
+                          (halo_finding.MultiHopMajorProgenitorsStrategy, "sim/ts3/5", {'include_startpoint': True}),
+                          (halo_finding.MultiHopMajorDescendantsStrategy, "sim/ts1/2", {'include_startpoint': True}),
+                          (halo_finding.MultiHopAllProgenitorsStrategy, "sim/ts3/1", {}),
+                          (halo_finding.MultiHopAllProgenitorsStrategy, "sim/ts3/4", {'nhops_max': 1})])
+@pytest.mark.parametrize("engine", ["recursive", "graph"])
+def test_engine_matches_iterative(strategy_class, halo, kwargs, engine):
+    iterative = _results_and_weights(strategy_class, halo, engine='iterative', **kwargs)
+    results = _results_and_weights(strategy_class, halo, engine=engine, **kwargs)
+    assert results == iterative
+
+@pytest.mark.parametrize("engine", ["recursive", "graph"])
+def test_engine_matches_iterative_when_strongest_route_fails_reverse_filter(engine):
+    # Add routes from sim/ts3/2 to sim/ts1/5 via both sim/ts2/3 and sim/ts2/4. The strongest route (via sim/ts2/3)
+    # has no reverse link, so the iterative engine discards sim/ts1/5 at the second hop rather than falling back
+    # to the weaker route.
+    session = tangos.get_default_session()
+    relation = session.query(tangos.core.halo_data.HaloLink).first().relation
+    orphan = tangos.get_item("sim/ts1/5")
+    new_links = [tangos.core.halo_data.HaloLink(tangos.get_item("sim/ts2/3"), orphan, relation, 0.5),
+                 tangos.core.halo_data.HaloLink(tangos.get_item("sim/ts2/4"), orphan, relation, 0.5),
+                 tangos.core.halo_data.HaloLink(orphan, tangos.get_item("sim/ts2/4"), relation, 0.5)]
+    session.add_all(new_links)
+    session.commit()
+    try:
+        kwargs = {'nhops_max': 2, 'directed': 'backwards', 'min_onehop_reverse_weight': 0.02,
+                  'order_by': ["time_asc", "weight"]}
+        iterative = _results_and_weights(halo_finding.MultiHopStrategy, "sim/ts3/2", engine='iterative', **kwargs)
+        assert "sim/ts1/halo_5" not in iterative[0]
+        results = _results_and_weights(halo_finding.MultiHopStrategy, "sim/ts3/2", engine=engine, **kwargs)
+        assert results == iterative
+    finally:
+        for link in new_links:
+            session.delete(link)
+        session.commit()
+
+def test_engine_selection(monkeypatch):
+    strategy = halo_finding.MultiHopStrategy(tangos.get_item("sim/ts1/1"), directed='forwards', engine='recursive')
+    assert strategy._engine == 'recursive'
+
+    with assert_raises(ValueError):
+        # routes may loop back on themselves
+        halo_finding.MultiHopStrategy(tangos.get_item("sim/ts2/2"), directed='across', engine='recursive')
+
+    with assert_raises(ValueError):
+        halo_finding.MultiHopMostRecentMergerStrategy(tangos.get_item("sim/ts3/1"), engine='recursive')
+
+    with assert_raises(ValueError):
+        # graph engine only walks within a simulation
+        halo_finding.MultiHopStrategy(tangos.get_item("sim/ts1/1"), directed='forwards', one_simulation=False,
+                                      engine='graph')
+
+    with assert_raises(ValueError):
+        halo_finding.MultiHopStrategy(tangos.get_item("sim/ts1/1"), engine='unknown')
+
+    # when the recursive engine is the default, strategies that cannot use it revert to the iterative engine
+    monkeypatch.setattr(tangos.config, 'multihop_engine', 'recursive')
+    strategy = halo_finding.MultiHopMostRecentMergerStrategy(tangos.get_item("sim/ts3/1"))
+    assert strategy._engine == 'iterative'
+    testing.assert_halolists_equal(strategy.all(), ["sim/ts2/1","sim/ts2/2"])
+
+@pytest.mark.parametrize("dialect_name, version, is_mariadb, supported",
+                         [("sqlite", (3, 24, 0), False, False),
+                          ("sqlite", (3, 40, 1), False, True),
+                          ("postgresql", (16, 2), False, True),
+                          ("mysql", (5, 7, 44), False, False),
+                          ("mysql", (8, 0, 36), False, True),
+                          ("mysql", (10, 6, 16), True, True),
+                          ("mariadb", (10, 1, 48), True, False)])
+def test_recursive_engine_database_support(dialect_name, version, is_mariadb, supported):
+    # the engine equivalence tests above run against the database chosen by TANGOS_TESTING_DB_BACKEND; this checks
+    # which servers the recursive engine is offered on
+    strategy = halo_finding.MultiHopStrategy(tangos.get_item("sim/ts1/1"), directed='forwards')
+    dialect = SimpleNamespace(name=dialect_name, server_version_info=version, is_mariadb=is_mariadb)
+    strategy._connection = SimpleNamespace(dialect=dialect)
+    assert strategy._engine_applicable('recursive') == supported
+
+def test_graph_engine_temp_table_and_invalidation():
+    halo = tangos.get_item("sim/ts1/5")
+    strategy = halo_finding.MultiHopMajorDescendantsStrategy(halo, include_startpoint=True, engine='graph')
+    with strategy.temp_table() as table:
+        testing.assert_halolists_equal(thl.halo_query(table).all(), ["sim/ts1/5"])
+
+    session = tangos.get_default_session()
+    relation = session.query(tangos.core.halo_data.HaloLink).first().relation
+    new_link = tangos.core.halo_data.HaloLink(halo, tangos.get_item("sim/ts2/5"), relation, 1.0)
+    session.add(new_link)
+    session.commit()
+    try:
+        results = halo_finding.MultiHopMajorDescendantsStrategy(halo, include_startpoint=True, engine='graph').all()
+        testing.assert_halolists_equal(results, ["sim/ts1/5", "sim/ts2/5", "sim/ts3/4"])
+    finally:
+        session.delete(new_link)
+        session.commit()
+
+    results = halo_finding.MultiHopMajorDescendantsStrategy(halo, include_startpoint=True, engine='graph').all()
+    testing.assert_halolists_equal(results, ["sim/ts1/5"])
@@ -1,13 +1,15 @@
 import os
 import os.path
 
+import numpy as np
+
 from pytest import raises as assert_raises
 
 import tangos
 import tangos as db
 from tangos import live_calculation, log, parallel_tasks, testing
 from tangos.core.halo_data import link
-from tangos.input_handlers import output_testing
+from tangos.input_handlers import output_testing, particle_matching
 from tangos.tools import add_simulation, crosslink
 
 
@@ -57,6 +59,28 @@ def test_crosslinking():
         result = db.get_halo('dummy_sim_2/step.3/1').calculate('match("dummy_sim_1").dbid()')
 
 
+def test_match_memberships():
+    # particles 0-9 in object 0 and 10-19 in object 1 become split 15/5 between two objects, numbered 5 and 6
+    membership_1 = particle_matching.ObjectMembership.from_group_array(np.arange(30)[::-1],
+                                                                       np.repeat([-1, 1, 0], 10), [1, 2])
+    membership_2 = particle_matching.ObjectMembership.from_group_array(np.arange(25),
+                                                                       np.repeat([0, 1, -1], [15, 5, 5]), [5, 6])
+    forward, backward = particle_matching.match_memberships(membership_1, membership_2, 0.005)
+    # equal matches are listed in the same order as by pynbody's fuzzy_match_halos
+    assert forward == {1: [(5, 1.0)], 2: [(6, 0.5), (5, 0.5)]}
+    assert backward == {5: [(1, 10/15), (2, 5/15)], 6: [(2, 1.0)]}
+
+    forward, backward = particle_matching.match_memberships(membership_1, membership_2, 0.5)
+    assert forward == {1: [(5, 1.0)], 2: []}
+
+def test_membership_crosslink_engine():
+    cl = crosslink.CrossLinker()
+    cl.parse_command_line(["dummy_sim_2", "dummy_sim_1", "--engine", "membership"])
+    with log.LogCapturer() as lc:
+        cl.crosslink_ts(db.get_timestep("dummy_sim_1/step.1"), db.get_timestep("dummy_sim_2/step.1"),
+                        engine='membership')
+    assert "Object membership is not available for TestInputHandler" in lc.get_output()
+
 def test_link_repr():
     h1 = db.get_halo('dummy_sim_1/step.1/1')
     h2 = db.get_halo('dummy_sim_1/step.1/2')
@@ -300,3 +300,42 @@ def test_faulty_multi_calculation():
 
     dbid1, mass, dbid2 = calc.values(halos)
     assert (dbid1 == dbid2).all()
+
+def test_extraction_from_eagerly_loaded_collections():
+    calculation = lc.MultiCalculation("dummy_property_3", "BH")
+    session = tangos.core.Session()
+    try:
+        query = session.query(tangos.core.halo.SimulationObjectBase).filter_by(id=tangos.get_halo("sim/ts1/1").id)
+        halo, = calculation.supplement_halo_query(query).all()
+
+        property_id = tangos.core.get_dict_id("dummy_property_3")
+        link_id = tangos.core.get_dict_id("BH")
+        getter = extraction_patterns.HaloPropertyValueGetter()
+        link_getter = extraction_patterns.HaloLinkTargetGetter()
+
+        assert getter.use_fixed_cache(halo)
+        assert getter.cache_contains(halo, property_id)
+        assert getter.get_from_cache(halo, property_id) == [-2.5]
+        assert [bh.halo_number for bh in link_getter.get_from_cache(halo, link_id)] == [1, 2]
+        assert not getter.cache_contains(halo, link_id)
+
+        # the index must notice if the underlying collection changes
+        halo.all_properties.clear()
+        assert not getter.cache_contains(halo, property_id)
+        assert link_getter.cache_contains(halo, link_id)
+    finally:
+        session.close()
+
+def test_make_numpy_array_from_common_rows():
+    stacked = np.array(np.arange(20.0).reshape((5,4)))
+    rows = np.empty(5, dtype=object)
+    for i in range(5):
+        rows[i] = stacked[i]
+
+    assert lc.Calculation._make_numpy_array(rows) is stacked
+
+    subset = lc.Calculation._make_numpy_array(rows[[0,2,3]])
+    assert (subset == stacked[[0,2,3]]).all()
+
+    rows[1] = stacked[1].copy()
+    assert (lc.Calculation._make_numpy_array(rows) == stacked).all()
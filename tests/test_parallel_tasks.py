@@ -5,7 +5,7 @@ import pytest
 
 import tangos
 import tangos.testing.simulation_generator
-from tangos import parallel_tasks as pt, testing
+from tangos import cached_writer, parallel_tasks as pt, testing
 from tangos.log import logger
 from tangos.parallel_tasks import testing as pt_testing
 
@@ -623,3 +623,297 @@ def test_iteration_state_from_string():
     assert iteration_state2.next_job(0) == 1
     assert iteration_state2.next_job(0) == 3
     assert iteration_state2.next_job(0) == 4
+
+def test_iteration_state_job_order_from_costs():
+    from tangos.parallel_tasks.jobs import IterationState
+
+    iteration_state = IterationState.from_context(5, backend_size=3)
+    iteration_state.set_job_order(IterationState.job_order_from_costs([10, 50, 20, 50, 0]))
+    assert iteration_state.next_job(1) == 1
+    assert iteration_state.next_job(2) == 3
+    assert iteration_state.next_job(1) == 2
+    assert iteration_state.next_job(1) == 0
+    assert iteration_state.next_job(2) == 4
+    assert iteration_state.next_job(1) is None
+    assert iteration_state.next_job(2) is None
+    assert iteration_state.finished()
+
+def _test_distributed_with_costs():
+    for i in pt.distributed(list(range(6)), costs=[3, 1, 4, 1, 5, 9]):
+        pt_testing.log(f"Job {i}")
+
+def test_distributed_with_costs():
+    pt.use("multiprocessing-2")
+    pt_testing.initialise_log()
+    pt.launch(_test_distributed_with_costs)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert log == ["Job 5", "Job 4", "Job 2", "Job 0", "Job 1", "Job 3"]
+
+def test_iteration_state_adaptive_chunks(monkeypatch):
+    from tangos.parallel_tasks.jobs import IterationState
+    monkeypatch.setattr(tangos.config, 'job_chunk_maximum_seconds', 1.0)
+
+    iteration_state = IterationState.from_context(1000, backend_size=3)
+    iteration_state.set_adaptive_chunks(True)
+
+    # no timing information yet, so a single job is handed out
+    assert iteration_state.next_jobs(1, current_time=0.0) == [0]
+
+    # jobs take 0.1s, so chunks of up to 10 are allowed
+    chunk = iteration_state.next_jobs(1, current_time=0.1)
+    assert chunk == list(range(1, 11))
+    assert iteration_state.count_complete() == 1
+
+    # jobs now take 0.001s; the estimate adapts, and the chunks grow until limited by the number of jobs
+    # remaining (guided scheduling)
+    handed_out = [0] + chunk
+    t = 0.1
+    chunk_sizes = []
+    while (chunk := iteration_state.next_jobs(1, current_time=t)) is not None:
+        remaining = 1000 - len(handed_out)
+        handed_out += chunk
+        chunk_sizes.append(len(chunk))
+        t += 0.001*len(chunk)
+        assert len(chunk) <= max(remaining//4, 1)
+    assert chunk_sizes[1] > chunk_sizes[0] > 10
+    assert max(chunk_sizes) > 100
+
+    # all jobs are handed out exactly once
+    assert sorted(handed_out) == list(range(1000))
+    assert iteration_state.next_jobs(2, current_time=t) is None
+    assert iteration_state.finished()
+
+def _test_distributed_with_adaptive_chunks():
+    for i in pt.distributed(list(range(200)), adaptive_chunks=True):
+        pt_testing.log(f"Job {i}")
+
+def test_distributed_with_adaptive_chunks():
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_distributed_with_adaptive_chunks)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert sorted(log) == sorted([f"Job {i}" for i in range(200)])
+
+def test_iteration_state_completion_log(tmp_path, monkeypatch):
+    from tangos.parallel_tasks.jobs import IterationState
+
+    monkeypatch.setattr(IterationState, "_resume_state_folder_path", classmethod(lambda cls: tmp_path))
+    monkeypatch.setattr(IterationState, "_resume_state_path_this_run", tmp_path / "tangos_resume_state_000000.pickle",
+                        raising=False)
+    monkeypatch.setattr(IterationState, "_this_run_iteration_states", {})
+    monkeypatch.setattr(IterationState, "_this_run_log_numbers", {})
+    monkeypatch.setattr(IterationState, "_log_records_since_compaction", 0)
+
+    iteration_state = IterationState.from_context(100, argv="test", stack_hash="abc", backend_size=2)
+    snapshot_path = tmp_path / "tangos_resume_state_000000.pickle"
+    log_path = snapshot_path.with_suffix(".log")
+
+    # the first completion writes a snapshot; subsequent ones are appended to the log
+    iteration_state.mark_complete(0)
+    assert snapshot_path.exists() and not log_path.exists()
+    snapshot_size = snapshot_path.stat().st_size
+    for job in range(1, 51):
+        iteration_state.mark_complete(job)
+    assert snapshot_path.stat().st_size == snapshot_size
+    assert log_path.exists()
+
+    # each completion appends only a small record
+    assert log_path.stat().st_size < 50 * 50
+
+    resumed = IterationState.from_context(100, argv="test", stack_hash="abc", allow_resume=True, backend_size=2)
+    assert resumed == iteration_state
+    assert resumed.count_complete() == 51
+
+    # a second loop causes the log to be compacted into a new snapshot of both loops
+    other_iteration_state = IterationState.from_context(10, argv="test", stack_hash="def", backend_size=2)
+    other_iteration_state.mark_complete(3)
+    assert not log_path.exists()
+    assert IterationState.from_context(100, argv="test", stack_hash="abc", allow_resume=True,
+                                       backend_size=2).count_complete() == 51
+    assert IterationState.from_context(10, argv="test", stack_hash="def", allow_resume=True,
+                                       backend_size=2).count_complete() == 1
+
+    # a partly-written final record (e.g. if the process was killed) is ignored
+    iteration_state.mark_complete(51)
+    with open(log_path, "ab") as f:
+        f.write(b"\x80\x04\x95")
+    resumed = IterationState.from_context(100, argv="test", stack_hash="abc", allow_resume=True, backend_size=2)
+    assert resumed.count_complete() == 52
+
+def _test_send_large_arrays():
+    import numpy as np
+    import pynbody
+    if pt.backend.rank()==1:
+        pt.backend.send_numpy_array(pynbody.array.SimArray(np.arange(100000.0), "kpc"), 2)
+        pt.backend.send({'plain': np.arange(100000), 'small': np.arange(3)}, 2, tag=5)
+    elif pt.backend.rank()==2:
+        received = pt.backend.receive_numpy_array(1)
+        pt_testing.log(f"{type(received).__name__} {received.units} {received.sum()} {received.flags.writeable}")
+        received = pt.backend.receive(1, tag=5)
+        pt_testing.log(f"{received['plain'].sum()} {received['small'].tolist()}")
+    pt.barrier()
+
+def test_send_large_arrays():
+    from tangos.parallel_tasks.backends import multiprocessing as mp_backend
+
+    # large buffers are sent via shared memory, which must be released once received
+    segments_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    assert 100000*8 >= mp_backend.OUT_OF_BAND_THRESHOLD_BYTES
+
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_send_large_arrays)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert log == ["SimArray kpc 4999950000.0 True", "4999950000 [0, 1, 2]"]
+
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) - segments_before == set()
+
+def test_large_buffers_received_in_place():
+    import mmap
+
+    import numpy as np
+
+    from tangos.parallel_tasks.backends import multiprocessing as mp_backend
+
+    received = mp_backend._loads(mp_backend._dumps(np.arange(100000)))
+    assert received.sum() == 4999950000
+
+    # the received array refers directly to the shared memory, rather than to a copy of it
+    base = received
+    while not isinstance(base, memoryview):
+        base = base.base
+    assert isinstance(base.obj, mmap.mmap)
+
+    # the segment is closed once the array has been released
+    del received, base
+    assert len(mp_backend._released_segments) == 1
+    mp_backend._close_released_segments()
+    assert len(mp_backend._released_segments) == 0
+
+def _test_direct_messages_between_workers():
+    import numpy as np
+    other = 3 - pt.backend.rank()
+    # Raw messages would be misinterpreted if they arrived while the other worker is still receiving messages from
+    # the server (e.g. the reply to the startup barrier). So each worker first waits for the other to signal that
+    # it has started, using the numpy tag which is never picked up when receiving server messages.
+    pt.backend.send_numpy_array(np.array([pt.backend.rank()]), other)
+    assert pt.backend.receive_numpy_array(other)[0] == other
+    # both workers send to each other at once, including a message too large to pass in one socket buffer
+    for i in range(20):
+        pt.backend.send(i, other, tag=7)
+    pt.backend.send(list(range(200000)), other, tag=8)
+    received = [pt.backend.receive(other, tag=7) for i in range(20)]
+    large = pt.backend.receive(other, tag=8)
+    pt_testing.log(f"{received == list(range(20))} {large == list(range(200000))}")
+    pt.barrier()
+
+def test_direct_messages_between_workers():
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_direct_messages_between_workers)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert log == ["True True"]*2
+
+
+def _test_exclusive_lock_delay():
+    pt.barrier()
+    with pt.ExclusiveLock("lock", 2.0):
+        time.sleep(0.2) # ensure the other process is queueing for the lock
+
+@pytest.mark.parametrize("server_database", [True, False])
+def test_exclusive_lock_delay(monkeypatch, server_database):
+    if server_database:
+        monkeypatch.setattr(pt.lock, "_database_needs_filesystem_delay", lambda: False)
+    pt.use("multiprocessing-3")
+    start = time.time()
+    pt.launch(_test_exclusive_lock_delay)
+    elapsed = time.time() - start
+    if server_database:
+        assert elapsed < 2.0
+    else:
+        assert elapsed > 2.0
+
+def test_lock_wait_histogram():
+    histogram = pt.lock.LockWaitHistogram([0.1, 1.0])
+    for wait in [0.05, 0.5, 0.6, 3.0]:
+        histogram.add(wait)
+    assert histogram.counts == [1, 2, 1]
+    assert histogram.num_grants == 4
+    assert histogram.max_wait == 3.0
+    assert histogram._bin_labels() == ["<0.1s", "0.1s-1s", ">1s"]
+
+
+def _test_commit_on_server():
+    rank = pt.backend.rank()
+    halo = tangos.get_halo(rank)
+    cached_writer.insert_list([(halo, 'queued_test_property', float(rank))], halo.timestep_id, True)
+    pt.barrier()
+    if rank==1:
+        # the lists from both processes are committed together
+        pt_testing.log(f"Flushed {cached_writer.flush_commits_on_server()}")
+
+def test_commit_on_server():
+    pt.use("multiprocessing-3")
+    pt_testing.initialise_log()
+    pt.launch(_test_commit_on_server)
+    assert pt_testing.get_log(remove_process_ids=True) == ["Flushed 2"]
+    for i in (1, 2):
+        assert tangos.get_halo(i)['queued_test_property'] == float(i)
+
+
+def _test_commit_on_server_without_flush():
+    rank = pt.backend.rank()
+    halo = tangos.get_halo(rank)
+    cached_writer.insert_list([(halo, 'unflushed_test_property', float(rank))], halo.timestep_id, True)
+
+def test_commit_on_server_flushed_at_exit():
+    pt.use("multiprocessing-3")
+    pt.launch(_test_commit_on_server_without_flush)
+    for i in (1, 2):
+        assert tangos.get_halo(i)['unflushed_test_property'] == float(i)
+
+def _test_commit_on_server_before_job_complete():
+    rank = pt.backend.rank()
+    for job in pt.synchronized([0, 1], allow_resume=True, resumption_id='commit-on-server'):
+        halo = tangos.get_halo(rank)
+        if job==0:
+            cached_writer.insert_list([(halo, 'synchronized_test_property', float(rank))], halo.timestep_id, True)
+        elif rank==1:
+            # job 0 has been recorded as complete by the time job 1 starts, so its results must be committed
+            tangos.core.get_default_session().expire_all()
+            pt_testing.log(f"Found {[tangos.get_halo(i).get('synchronized_test_property') for i in (1, 2)]}")
+
+def test_commit_on_server_before_job_complete():
+    pt.use("multiprocessing-3")
+    pt.jobs.IterationState.clear_resume_state()
+    pt_testing.initialise_log()
+    pt.launch(_test_commit_on_server_before_job_complete)
+    pt.jobs.IterationState.clear_resume_state()
+    assert pt_testing.get_log(remove_process_ids=True) == ["Found [1.0, 2.0]"]
+
+class _BroadcastTestMessage(pt.message.Message):
+    pass
+
+def _test_broadcast():
+    import numpy as np
+    destinations = [2, 3]
+    for contents in ["small", np.arange(100000)]:
+        if pt.backend.rank()==1:
+            _BroadcastTestMessage(contents).broadcast(destinations)
+        else:
+            received = _BroadcastTestMessage.receive_broadcast(1, destinations).contents
+            pt_testing.log(f"received {np.sum(received) if isinstance(received, np.ndarray) else received}")
+    pt.barrier()
+
+def test_broadcast():
+    segments_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+    pt.use("multiprocessing-4")
+    pt_testing.initialise_log()
+    pt.launch(_test_broadcast)
+    log = pt_testing.get_log(remove_process_ids=True)
+    assert sorted(log) == ["received 4999950000"]*2 + ["received small"]*2
+
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) - segments_before == set()
@@ -193,6 +193,28 @@ def test_calculate_for_progenitors_bh():
     objs, = h.calculate_for_progenitors("dbid()")
     testing.assert_halolists_equal(objs, ['sim/ts3/BH_1', 'sim/ts2/BH_1', 'sim/ts1/BH_1'])
 
+def test_calculate_all_for_progenitors():
+    ts = tangos.get_timestep("sim/ts3")
+    mvir, = ts.calculate_all_for_progenitors("Mvir", object_type='halo')
+    npt.assert_allclose(mvir, [[9, 5, 1], [10, 6, 2], [11, 7, 3]])
+    for i, histories in enumerate(mvir):
+        npt.assert_allclose(histories, ts[i+1].calculate_for_progenitors("Mvir")[0])
+
+def test_calculate_all_for_progenitors_padding():
+    ts = tangos.get_timestep("sim/ts3")
+    masses, paths = ts.calculate_all_for_progenitors("hole_mass", "path()", object_type='BH')
+    npt.assert_allclose(masses, [[100, 100, 100]] + [[m, np.nan, np.nan] for m in (200, 300, 400)])
+    assert list(paths[0]) == ['sim/ts3/BH_1', 'sim/ts2/BH_1', 'sim/ts1/BH_1']
+    assert paths.dtype == object
+    assert all(x is None for x in paths[1:, 1:].flat)
+
+def test_calculate_all_for_progenitors_efficiency():
+    ts = tangos.get_timestep("sim/ts3")
+    with testing.SqlExecutionTracker(db.core.get_default_engine()) as track:
+        ts.calculate_all_for_progenitors("Mvir", object_type='halo')
+    # one query per hop, not per halo per hop
+    assert track.count_statements_containing("insert into multihoplink_prelim") <= 3
+
 def test_match_gather():
     ts1_halos, ts3_halos = tangos.get_timestep("sim/ts1").calculate_all('dbid()', 'match("sim/ts3").dbid()')
     testing.assert_halolists_equal(ts1_halos, ['sim/ts1/1','sim/ts1/2','sim/ts1/3', 'sim/ts1/1.1'])
@@ -64,7 +64,7 @@ def test_get_shared_array():
         shared_array[2] = 100
         pt.barrier()
     elif pt.backend.rank()==2:
-        shared_array = pt.pynbody_server.transfer_array.receive_array(2, True)
+        shared_array = pt.pynbody_server.transfer_array.receive_array(1, True)
         assert shared_array[2]==2
         pt.barrier()
         # now the other process should be changing the value
@@ -85,7 +85,7 @@ def test_get_shared_array_slice():
         shared_array[3] = 100
         pt.barrier()
     elif pt.backend.rank()==2:
-        shared_array = pt.pynbody_server.transfer_array.receive_array(2, True)
+        shared_array = pt.pynbody_server.transfer_array.receive_array(1, True)
         assert len(shared_array)==3
         assert shared_array[1] == 3
         pt.barrier()
@@ -4,12 +4,13 @@ import os
 import numpy as np
 import numpy.testing as npt
 import pynbody
+import pytest
 
 import tangos
 import tangos as db
 import tangos.input_handlers.pynbody as pynbody_outputs
 import tangos.tools.add_simulation as add
-from tangos import config, log, testing
+from tangos import config, log, parallel_tasks, testing
 
 
 def setup_module():
@@ -119,6 +120,31 @@ def test_partial_load_tracker_halo():
     assert len(pynbody_h)==4
     assert pynbody_h.ancestor is pynbody_h
 
+def test_tracker_selection_matches_isin():
+    f = output_manager.load_timestep("tiny.000640")
+    index = pynbody_outputs._ParticleIdIndex.for_snapshot(f)
+    assert pynbody_outputs._ParticleIdIndex.for_snapshot(f) is index # shared by all trackers in the timestep
+
+    rng = np.random.default_rng(1)
+    requested = np.concatenate((rng.choice(f['iord'], 50), [f['iord'][0]]*3, [-1, 10**12]))
+    expected = np.sort(np.hstack([f[fam][np.isin(f[fam]['iord'], requested)].get_index_list(f)
+                                  for fam in (pynbody.family.dm, pynbody.family.star, pynbody.family.gas)]))
+    npt.assert_equal(index.indices_of(requested), expected)
+    assert len(index.indices_of([])) == 0
+
+def test_prefetch_timestep():
+    prefetched = output_manager.prefetch_timestep("tiny.000640")
+    f, h = prefetched
+    assert output_manager.load_timestep("tiny.000640") is f
+    assert output_manager.get_catalogue("tiny.000640", "halo") is h
+
+    # trackers have no catalogue to construct
+    assert output_manager.prefetch_timestep("tiny.000640", object_typetag='tracker') is f
+
+def test_estimate_timestep_memory():
+    estimate = output_manager.estimate_timestep_memory("tiny.000640")
+    assert estimate > os.path.getsize(output_manager._extension_to_filename("tiny.000640"))
+
 def test_load_persistence():
     add_test_simulation_to_db()
     f = db.get_timestep("test_tipsy/tiny.000640").load()
@@ -198,6 +224,82 @@ def test_load_region():
        11550437, 11740437, 12270437, 12590437, 12600437, 12920437,
        13380437, 13710437]).all()
 
+def _assert_matches_equal(matches, expected):
+    assert matches.keys() == expected.keys()
+    for k in expected:
+        assert [m[0] for m in matches[k]] == [m[0] for m in expected[k]]
+        npt.assert_allclose([m[1] for m in matches[k]], [m[1] for m in expected[k]])
+
+@pytest.mark.parametrize("threshold", [0.005, 0.2])
+def test_match_objects_bidirectional(threshold):
+    forward, backward = output_manager.match_objects_bidirectional("tiny.000640", "tiny.000832", 0, None,
+                                                                   threshold=threshold)
+    _assert_matches_equal(forward, output_manager.match_objects("tiny.000640", "tiny.000832", 0, None,
+                                                                threshold=threshold))
+    _assert_matches_equal(backward, output_manager.match_objects("tiny.000832", "tiny.000640", 0, None,
+                                                                 threshold=threshold))
+
+def test_match_objects_bidirectional_uses_handler_bridge(monkeypatch):
+    bridges = []
+    def create_bridge(f1, f2):
+        bridges.append(f1.bridge(f2))
+        return bridges[-1]
+    monkeypatch.setattr(output_manager, "create_bridge", create_bridge)
+
+    forward, backward = output_manager.match_objects_bidirectional("tiny.000640", "tiny.000832", 0, None,
+                                                                   fuzzy_match_kwa={'use_halo_indexes': True})
+    assert len(bridges)==1
+    _assert_matches_equal(forward, output_manager.match_objects("tiny.000640", "tiny.000832", 0, None,
+                                                                fuzzy_match_kwa={'use_halo_indexes': True}))
+    assert 0 in backward
+
+def test_match_objects_bidirectional_restricted_range():
+    forward, backward = output_manager.match_objects_bidirectional("tiny.000640", "tiny.000832", 5, 10)
+    assert len(forward)==0
+    assert list(backward.keys()) == list(range(5, 11))
+
+@pytest.mark.parametrize("dm_only", [False, True])
+def test_match_by_object_membership(dm_only):
+    from tangos.input_handlers import particle_matching
+    forward, backward = particle_matching.match_memberships(
+        output_manager.get_object_membership("tiny.000640", dm_only=dm_only),
+        output_manager.get_object_membership("tiny.000832", dm_only=dm_only), 0.005)
+    expected_forward, expected_backward = output_manager.match_objects_bidirectional("tiny.000640", "tiny.000832",
+                                                                                     -np.inf, None, dm_only=dm_only)
+    _assert_matches_equal(forward, expected_forward)
+    _assert_matches_equal(backward, expected_backward)
+
+def test_membership_cache(tmp_path, monkeypatch):
+    from tangos.input_handlers import membership_cache
+    from tangos.tools import membership_builder
+
+    add_test_simulation_to_db()
+    parallel_tasks.use('null')
+    monkeypatch.setattr(config, "membership_cache_folder", str(tmp_path))
+    uncached = output_manager.get_object_membership("tiny.000832")
+
+    builder = membership_builder.MembershipBuilder()
+    builder.parse_command_line(["--for", "test_tipsy"])
+    with log.LogCapturer():
+        builder.run_calculation_loop()
+    assert os.path.exists(membership_cache.cache_path(output_manager, "tiny.000832", "halo", False))
+
+    def _should_not_be_called(*args):
+        raise AssertionError("Membership should have been read from the cache")
+    monkeypatch.setattr(output_manager, "get_object_membership_without_caching", _should_not_be_called)
+
+    cached = output_manager.get_object_membership("tiny.000832")
+    assert isinstance(cached.particle_ids, np.memmap)
+    for name in "particle_ids", "object_index", "object_numbers":
+        assert (getattr(cached, name) == getattr(uncached, name)).all()
+
+    for index in 1, 27:
+        ids = cached.particle_ids_of(index)
+        assert len(ids) > 0
+        assert (np.sort(ids) == np.sort(uncached.particle_ids_of(index))).all()
+        assert (cached.object_index_of(ids) == index).all()
+    assert cached.object_index_of([-5]) == -1
+
 def test_load_region_uses_cache():
     add_test_simulation_to_db()
     filt1 = pynbody.filt.Sphere(2000,[1000,1000,1000])